@@ -20,17 +20,50 @@ from __future__ import print_function
 VERSION     = "Reporta v0.01"           # Version number to be displayed
 PYQT_DISPLAY = True                     # Enable pyqt graphics
 
-import sys, time, rp_arm as arm, rp_swd as swd, rp_ftd2xx as driver
-if PYQT_DISPLAY:
-    import rp_pyqt as pyqt
+import sys, time, argparse, rp_arm as arm, rp_ftd2xx as driver
+
+# Without graphics, or with --headless, run the command-line interface,
+# before anything imports PyQt
+if __name__ == "__main__" and (not PYQT_DISPLAY or "--headless" in sys.argv[1:]):
+    import rp_cli
+    sys.exit(rp_cli.main([arg for arg in sys.argv[1:] if arg != "--headless"]))
+
+import rp_pyqt as pyqt
 try:
     import Queue
 except:
     import queue as Queue
+try:
+    import rp_ring, rp_capture
+except ImportError:
+    rp_ring = rp_capture = None
+try:
+    import rp_wave
+except ImportError:
+    rp_wave = None
+try:
+    import rp_heatmap
+except ImportError:
+    rp_heatmap = None
+import rp_tune, rp_stats
 
-POLL_DELAY  = 0.01
+POLL_IDLE   = 0.1                       # Delay if nothing to poll (sec)
 PORT_NAME   = "PB"                      # Name of port to be read
 PORT_ADDR   = arm.GPIOB+arm.GPIO_IDR    # Address or port to be read
+PORT_RATE   = 100                       # Port sample rate (samples/sec)
+ELF_FILE    = None                      # Firmware ELF file (None if not used)
+POLL_SYMBOLS= []                        # ELF variables to be polled, e.g. "state.pts[0]"
+POLL_DEPTH  = arm.POLL_DEPTH            # Pipeline depth (1 to disable)
+IO_THREAD   = True                      # Use separate thread for USB I/O
+RING_SIZE   = 100000                    # Poll samples kept in history (0 if none)
+CAPTURE_FILE= None                      # File to record poll samples (None if not)
+REPLAY_SPEED= 10.0                      # Speed of capture file replay
+LINK_TUNE   = False                     # Use cached or auto-tuned link settings
+STATS_PANEL = False                     # Display performance statistics
+STATS_FILE  = None                      # File for JSON statistics on exit (None if not)
+PROFILE     = False                     # Enable sampling profiler
+WAVE_PINS   = ["PB%u" % n for n in (0,1,3,10,11,12,13,14,15)] # Waveform traces
+HEAT_MAP    = False                     # Display RAM activity heatmap
 
 # Class to poll hardware. Parent is the display window
 class PollTask(pyqt.QtCore.QThread):
@@ -39,31 +72,134 @@ class PollTask(pyqt.QtCore.QThread):
         self.parent = parent
         pyqt.QtCore.QThread.__init__(self)
         self.running = True
-        self.value = None
+        self.capture = None
+        self.heat = None
+        if CAPTURE_FILE and rp_capture:
+            self.capture = rp_capture.CaptureWriter(CAPTURE_FILE, dev.poll_vars)
 
-    # Thread to poll hardware
+    # Thread to poll hardware: poll the variables that are due in a
+    # single batch, pipelined with the decoding of earlier batches.
+    # Outstanding batches are completed before sleeping until the next
+    # deadline, so pipelining only adds latency when running flat-out
+    # The heatmap region (if any) is read a chunk at a time while nothing
+    # is in flight, until the next deadline
     def run(self):
+        if IO_THREAD:
+            return self.run_io_thread()
+        while self.running:
+            batches = []
+            pvs = arm.poll_due_vars(dev, time.time())
+            if pvs:
+                batches += arm.poll_pipeline(dev, pvs, POLL_DEPTH)
+            due = arm.poll_next_due(dev)
+            delay = POLL_IDLE if due is None else due - time.time()
+            if delay > 0:
+                batches += arm.poll_drain(dev)
+            for batch in batches:
+                self.new_batch(batch)
+            while self.heat and delay > 0 and self.heat.scan(dev):
+                delay = POLL_IDLE if due is None else due - time.time()
+            if delay > 0:
+                time.sleep(delay if due is None else max(due - time.time(), 0))
+
+    # Poll hardware using a separate USB I/O thread, so that USB transfers
+    # overlap with decoding and display. Up to POLL_DEPTH batches are in
+    # flight; responses are decoded as they arrive, while waiting for the
+    # next deadline
+    def run_io_thread(self):
+        worker = driver.IoWorker(dev)
+        worker.start()
+        inflight = 0
         while self.running:
-            arm.poll_send_requests(dev)
-            arm.poll_get_responses(dev)
-            for pv in arm.poll_vars:
-                if pv.value != self.value:
-                    valstr = ("%08X" % pv.value) if pv.value is not None else "?"
-                    print("%8s %08X = %s" % (pv.name, pv.addr, valstr))
-                    self.parent.graph_updater.emit("%s=%s" % (pv.name, valstr))
-                    self.value = pv.value
-            time.sleep(POLL_DELAY)
+            pvs = arm.poll_due_vars(dev, time.time())
+            if pvs:
+                while inflight >= max(POLL_DEPTH, 1):
+                    self.new_batch(arm.poll_collect(worker))
+                    inflight -= 1
+                arm.poll_submit(dev, worker, pvs)
+                inflight += 1
+            due = arm.poll_next_due(dev)
+            delay = POLL_IDLE if due is None else due - time.time()
+            try:
+                while inflight and delay > 0:
+                    self.new_batch(arm.poll_collect(worker, delay))
+                    inflight -= 1
+                    delay = POLL_IDLE if due is None else due - time.time()
+            except Queue.Empty:
+                pass
+            while self.heat and not inflight and delay > 0 and self.heat.scan(dev):
+                delay = POLL_IDLE if due is None else due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        worker.stop()
+
+    # Handle a completed poll batch: record it, and display the values
+    def new_batch(self, batch):
+        if self.capture:
+            self.capture.add_batch(batch)
+        self.show_values(batch)
+
+    # Pass the values from a poll batch to the display, which is updated
+    # with the latest values at the display refresh rate
+    def show_values(self, batch):
+        for pv, val in zip(batch.pvs, batch.values):
+            self.parent.coalescer.update(pv.name, val)
+
+    # Stop the running thread, and close the capture file
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.wait()
+        if self.capture:
+            self.capture.close()
+            self.capture = None
+
+# Class to replay a capture file to the display window
+class ReplayTask(pyqt.QtCore.QThread):
+    def __init__(self, fname, parent=None):
+        super(ReplayTask, self).__init__(parent)
+        self.parent = parent
+        self.reader = rp_capture.CaptureReader(fname)
+        self.running = True
+
+    # Thread to send the recorded values to the display, through the
+    # coalescer, in the same way as the poll task
+    def run(self):
+        rp_capture.capture_replay(self.reader, self.parent.coalescer.update,
+                                  speed=REPLAY_SPEED, stop=lambda: not self.running)
+        print("Replay complete")
 
     # Stop the running thread
     def stop(self):
         if self.running:
             self.running = False
             self.wait()
+            self.reader.close()
 
+# Get the command-line options, leaving the rest for Qt
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=VERSION)
+    parser.add_argument("--replay", metavar="FILE",
+                        help="replay a capture file, instead of polling")
+    args, qt_args = parser.parse_known_args()
+    sys.argv = sys.argv[:1] + qt_args
+
+if __name__ == "__main__" and args.replay:
+    if not rp_capture:
+        sys.exit("Can't replay: capture needs numpy")
+    app = pyqt.QtWidgets.QApplication(sys.argv)
+    win = pyqt.MyWindow()
+    win.show()
+    print(VERSION + "\nReplaying %s\n" % args.replay)
+    replaytask = ReplayTask(args.replay, win)
+    win.close_handler = replaytask.stop
+    replaytask.start()
+    app.exec_()
+
+elif __name__ == "__main__":
     #driver.VERBOSE = True
-    #swd.VERBOSE = True
-    dev = driver.open()
+    #arm.swd.VERBOSE = True
+    dev = arm.open()
     if not dev:
         print("Can't open FTDI device")
     else:
@@ -72,37 +208,37 @@ if __name__ == "__main__":
         driver.spi_init(dev)
         if not driver.check_sync(dev):
             print("Sync failed: check device supports MPSSE")
-        elif not PYQT_DISPLAY:
-            arm.swd.swd_reset(dev)                          # Reset SWD interface
-            print("DP ident: %s" % arm.cpu_swd_start(dev))  # Start up SWD
-            print("AP ident: %s" % arm.cpu_ap_ident(dev))   # Get banked AP ID register
-            arm.ap_config(dev, 32);                         # Configure AP RAM accesses
-            val = arm.cpu_mem_read32(dev, TEST_ADDR)        # Read 32-bit value at address
-            print(("Addr %08X read failed" % TEST_ADDR) if val is None else
-                  ("Addr %08X value %X" % (TEST_ADDR, val)))
-            print("Polling")
-            arm.poll_add_var("ZERO", 0)
-            arm.poll_add_var("TESTADDR", TEST_ADDR)
-            for n in range(0, 4):
-                arm.poll_send_requests(dev)
-                arm.poll_get_responses(dev)
-                for pv in arm.poll_vars:
-                    valstr = ("%08X" % pv.value) if pv.value is not None else "?"
-                    print("%8s %08X = %s" % (pv.name, pv.addr, valstr))
-                    time.sleep(0.2)
-            if not driver.check_sync(dev):
-                print("Sync failed")
         else:
             app = pyqt.QtWidgets.QApplication(sys.argv)
             win = pyqt.MyWindow()
+            if STATS_PANEL:
+                win.widget.layout().addWidget(pyqt.StatsPanel(), 10)
+            if STATS_FILE:
+                rp_stats.dump_on_exit(STATS_FILE)
+            if PROFILE:
+                rp_stats.profile_start()
             win.show()
             print(VERSION + "\n")
             arm.swd.swd_reset(dev)                          # Reset SWD interface
             print("DP ident: %s" % arm.cpu_swd_start(dev))  # Start up SWD
             print("AP ident: %s" % arm.cpu_ap_ident(dev))   # Get banked AP ID register
             arm.ap_config(dev, 32);                         # Configure AP RAM accesses
-            arm.poll_add_var(PORT_NAME, PORT_ADDR)
+            if LINK_TUNE:
+                print("Link: %s" % rp_tune.profile_str(rp_tune.link_setup(dev)))
+            arm.poll_add_var(dev, PORT_NAME, PORT_ADDR, PORT_RATE)
+            if ELF_FILE:
+                import rp_elf
+                index = rp_elf.ElfIndex(ELF_FILE)
+                for name in POLL_SYMBOLS:
+                    arm.poll_add_symbol(dev, index, name, PORT_RATE)
+            if rp_ring and RING_SIZE:
+                dev.ring = rp_ring.SampleRing([pv.name for pv in dev.poll_vars], RING_SIZE)
+                if rp_wave and WAVE_PINS:
+                    win.widget.layout().insertWidget(1, rp_wave.WaveView(dev.ring, WAVE_PINS), 20)
             polltask = PollTask(win)
+            if rp_heatmap and HEAT_MAP:
+                polltask.heat = rp_heatmap.RamHeat()
+                win.widget.layout().addWidget(rp_heatmap.HeatView(polltask.heat), 20)
             win.close_handler = polltask.stop
             polltask.start()
             app.exec_()
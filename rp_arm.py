@@ -14,9 +14,25 @@
 
 from __future__ import print_function
 from ctypes import Structure, Union, c_uint
-import rp_swd as swd, rp_ftd2xx as driver
+import time
+from array import array
+from collections import deque
+import rp_swd as swd, rp_ftd2xx as driver, rp_stats
 
-poll_vars = []      # List of variables to be polled
+POLL_RATE   = 100               # Default polling rate (samples/sec)
+POLL_MAXVARS= 64                # Max variables to be polled in one cycle
+POLL_DEPTH  = 2                 # Default pipeline depth (cycles in flight)
+ORUN_DETECT = True              # Enable overrun detection for batches
+                                # (if disabled, a write that gets a WAIT
+                                # leaves its data phase to be misread)
+SWD_RETRIES = 4                 # Max retries of a batch after WAIT response
+MEM_GROUP_WORDS = 64            # Max words in a block transfer replay group
+POLL_GAP_WORDS = 1              # Max unused words read to join two poll runs
+POLL_GAP_LIMIT = 0x40000000     # Gaps only read below this (code & SRAM)
+POLL_PLANS  = 64                # Max number of cached poll plans
+
+POLL_CYCLE  = rp_stats.stage("poll_cycle")  # Request to decode; items are vars
+REPLAYS     = rp_stats.counter("replay")
 
 # STM32F1 address values for testing
 GPIOA       = 0x40010800        # Address of GPIO Ports A - E on STM32F1
@@ -38,6 +54,13 @@ DPORT_STATUS        = 0x4
 DPORT_SELECT        = 0x8   # Select
 DPORT_RDBUFF        = 0xc   # Read buffer
 
+# DP control/status and abort register bits
+DP_CTRL_ORUNDETECT  = 0x01  # Overrun detection mode
+DP_CTRL_STICKYORUN  = 0x02  # Overrun has occurred
+DP_CTRL_STICKYERR   = 0x20  # AP transaction error
+DP_CTRL_PWRUP_REQ   = 0x50000000 # System & debug powerup request
+DP_ABORT_CLEAR      = 0x1e  # Clear all sticky error flags
+
 # Access Port (AHB-AP) registers, high nybble is bank number
 # See ARM DDI 0337E: Cortex M3 Technical Reference Manual page 11-38
 APORT_CSW           = 0x0   # Control status word
@@ -49,6 +72,7 @@ APORT_BANK2         = 0x18
 APORT_BANK3         = 0x1c
 APORT_DEBUG_ROM_ADDR= 0xf8   # Address of debug ROM
 APORT_IDENT         = 0xfc   # AP identification
+AP_TAR_WRAP         = 0x400  # Auto-increment is only guaranteed within 1K
 
 # AHB-AP Select Register
 class AP_SELECT_REG(Structure):
@@ -59,7 +83,6 @@ class AP_SELECT_REG(Structure):
 class AP_SELECT(Union):
     _fields_ = [("reg",   AP_SELECT_REG),
                 ("value", c_uint)]
-ap_select = AP_SELECT()
 
 # AHB-AP Control Status Word Register
 class AP_CSW_REG(Structure):
@@ -77,33 +100,120 @@ class AP_CSW_REG(Structure):
 class AP_CSW(Union):
     _fields_ = [("reg",   AP_CSW_REG),
                 ("value", c_uint)]
-ap_csw = AP_CSW()
+
+# Class to shadow the values in the DP SELECT, AP CSW and TAR registers,
+# so that writes which don't change the state can be skipped
+# A value of None means unknown, e.g. after a line reset or error
+class ApShadow(object):
+    def __init__(self):
+        self.invalidate()
+
+    # Mark all the register values as unknown
+    def invalidate(self):
+        self.select = self.csw = self.tar = None
+
+    # Update TAR after a number of DRW accesses, allowing for
+    # auto-increment, which wraps within a 1K block
+    def drw_access(self, count=1):
+        if self.csw is None:
+            self.tar = None
+        elif self.tar is not None and (self.csw >> 4) & 3 == 1:
+            inc = count << (self.csw & 7)
+            self.tar = ((self.tar & ~(AP_TAR_WRAP-1)) |
+                        ((self.tar + inc) & (AP_TAR_WRAP-1)))
+
+# Class for a probe session: an open device, with the register values and
+# poll state for its target CPU, so several probes can be used at once
+class Probe(driver.Device):
+    def __init__(self, handle):
+        driver.Device.__init__(self, handle)
+        self.select, self.csw = AP_SELECT(), AP_CSW()
+        self.shadow = ApShadow()
+        self.mem_group = MEM_GROUP_WORDS # Max words in block transfer group
+        self.poll_vars = []             # List of variables to be polled
+        self.poll_plans = {}            # Cached poll plans, keyed by variable set
+        self.poll_pending = deque()     # Poll batches sent, awaiting responses
+        self.poll_collected = deque()   # Poll batches received from I/O thread
+        self.poll_count = 0             # Number of poll cycles sent
+        self.ring = None                # Optional ring buffer for poll samples
+
+# Open a probe, return None if failed
+def open(idx=0):
+    return driver.open(idx, Probe)
 
 # Select AP bank, do read cycle
 def ap_banked_read(h, addr):
-    ap_select.reg.APBANKSEL = addr >> 4;
-    swd.swd_wr(h, swd.SWD_DP, DPORT_SELECT, ap_select.value)
+    ap_bank_select(h, addr >> 4)
     swd.swd_rd(h, swd.SWD_AP, addr&0xf)
     return swd.swd_rd(h, swd.SWD_AP, addr&0xf)
 
-# Select AP bank
+# Select AP bank, if not already selected
 def ap_bank_select(h, bank):
-    ap_select.reg.APBANKSEL = bank;
-    swd.swd_wr(h, swd.SWD_DP, DPORT_SELECT, ap_select.value)
+    h.select.reg.APBANKSEL = bank;
+    if h.shadow.select != h.select.value:
+        r = swd.swd_wr(h, swd.SWD_DP, DPORT_SELECT, h.select.value)
+        h.shadow.select = h.select.value if r is not None and r.ok() else None
 
 # Configure AP memory accesses: zero bank, and set CSW reg
+# Returns the CSW write request, None if no write was needed
 def ap_config(h, size, inc=False):
     ap_bank_select(h, 0)
-    ap_csw.reg.MasterType = 1
-    ap_csw.reg.HProt1 = 1
-    ap_csw.reg.AddrInc = 1 if inc else 0
-    ap_csw.reg.Size = 0 if size==8 else 1 if size==16 else 2
-    return swd.swd_wr(h, swd.SWD_AP, APORT_CSW, ap_csw.value)
+    ap_csw_set(h, size, inc)
+    return ap_csw_write(h)
 
-# Set AP memory address
+# Set the CSW value for AP memory accesses, without writing it
+def ap_csw_set(h, size, inc=False):
+    h.csw.reg.MasterType = 1
+    h.csw.reg.HProt1 = 1
+    h.csw.reg.AddrInc = 1 if inc else 0
+    h.csw.reg.Size = 0 if size==8 else 1 if size==16 else 2
+
+# Queue a write of the CSW value to the AP, if it has changed
+# Without overrun detection, an earlier queued write may have been
+# skipped after a WAIT, while later requests succeed, so the value is
+# always written
+# Return list of requests, empty if no write was needed
+def ap_csw_reqs(h):
+    if ORUN_DETECT and h.shadow.csw == h.csw.value:
+        return []
+    h.shadow.csw = h.csw.value
+    return [swd.swd_wr(h, swd.SWD_AP, APORT_CSW, h.csw.value, True, False)]
+
+# Restore the AP CSW value saved from the shadow before a transfer changed
+# it; if the value in the AP wasn't known (e.g. it was never configured),
+# it is left as set by the transfer
+def ap_csw_restore(h, csw):
+    if csw is not None:
+        h.csw.value = csw
+        ap_csw_write(h)
+
+# Write the CSW value to the AP, if it has changed
+def ap_csw_write(h):
+    if h.shadow.csw == h.csw.value:
+        return None
+    r = swd.swd_wr(h, swd.SWD_AP, APORT_CSW, h.csw.value)
+    h.shadow.csw = h.csw.value if r is not None and r.ok() else None
+    return r
+
+# Set AP memory address, if it has changed
 def ap_addr(h, addr):
-    swd.swd_wr(h, swd.SWD_AP, APORT_TAR, addr)
+    if h.shadow.tar != addr:
+        r = swd.swd_wr(h, swd.SWD_AP, APORT_TAR, addr)
+        swd.swd_idle_bytes(h, 2)
+        h.shadow.tar = addr if r is not None and r.ok() else None
+
+# Queue a write to the AP memory address, if it has changed
+# Without overrun detection, an earlier queued access may have been
+# skipped after a WAIT, while later requests succeed, so the shadow value
+# can't be trusted, and the address is always written
+# Return list of requests, empty if no write was needed
+def ap_addr_reqs(h, addr):
+    if ORUN_DETECT and h.shadow.tar == addr:
+        return []
+    h.shadow.tar = addr
+    req = swd.swd_wr(h, swd.SWD_AP, APORT_TAR, addr, True, False)
     swd.swd_idle_bytes(h, 2)
+    return [req]
 
 # Display the bit values of a register
 def disp_reg_bitvals(u):
@@ -111,59 +221,494 @@ def disp_reg_bitvals(u):
         print("%-12s %X" % (r[0], getattr(u.reg, r[0])))
 
 # Start up the CPU SWD interface, return CPU ID or error message if failed
+# If ORUN_DETECT is set, overrun detection is enabled, so that after
+# a WAIT response, all following transactions fail until it is cleared
 def cpu_swd_start(h):
+    ctrl = DP_CTRL_PWRUP_REQ | (DP_CTRL_ORUNDETECT if ORUN_DETECT else 0)
+    h.shadow.invalidate()
     id = swd.swd_rd(h, swd.SWD_DP, DPORT_IDCODE)    # Read ID code
-    swd.swd_wr(h, swd.SWD_DP, DPORT_ABORT, 0x1e)    # Clear errors
-    swd.swd_wr(h, swd.SWD_DP, DPORT_CTRL,  0x5<<28) # Powerup request
+    swd.swd_wr(h, swd.SWD_DP, DPORT_ABORT, DP_ABORT_CLEAR) # Clear errors
+    swd.swd_wr(h, swd.SWD_DP, DPORT_CTRL, ctrl)     # Powerup request
     r = swd.swd_rd(h, swd.SWD_DP, DPORT_STATUS)     # Get status
-    return ("no ack" if id.ack.value!=swd.SWD_ACK_OK else
-            "no powerup" if r.data.value>>28!=0xf else
-            "%08X" % id.data.value)
+    return ("no ack" if id is None or id.ack!=swd.SWD_ACK_OK else
+            "no powerup" if r is None or r.data>>28!=0xf else
+            "%08X" % id.data)
 
 # Get AP ident, return string
 def cpu_ap_ident(h):
     r = ap_banked_read(h, APORT_IDENT)
-    return ("no ack" if r.ack.value!=swd.SWD_ACK_OK else
-            "%08X" % r.data.value)
+    return ("no ack" if r.ack!=swd.SWD_ACK_OK else
+            "%08X" % r.data)
+
+# Check the decoded responses to a batch of requests
+# Without overrun detection, requests after a WAIT still succeed, but a
+# DRW read that got a WAIT breaks the sequence of posted reads, and the
+# data phase of a write that got a WAIT isn't expected by the target, so
+# all the requests after the first failure are marked as failed, and
+# will be resent. Return False if any request failed
+def swd_batch_check(reqs):
+    for i, req in enumerate(reqs):
+        if not req.ok():
+            if not ORUN_DETECT:
+                for r in reqs[i+1:]:
+                    r.ack = swd.SWD_ACK_WAIT if r.ok() else r.ack
+            return False
+    return True
+
+# Return index of first group of requests with a failure, None if all OK
+def swd_first_failure(groups, start=0):
+    for n in range(start, len(groups)):
+        for req in groups[n]:
+            if not req.ok():
+                return n
+    return None
+
+# Class to replay a batch of request groups after a failure
+# Each group must be self-contained, and build(h, n) must queue the
+# requests for group n and return them. The sticky error flags are cleared,
+# and the TAR & CSW shadow values invalidated, so the groups are resent with
+# their register writes. Only the failed groups are resent, starting with
+# the first: one group at first, then a window that doubles each time all
+# the groups sent succeed, and drops back to one after a failure, so a high
+# WAIT rate doesn't cause the rest of the batch to be resent repeatedly.
+# A group that gets a WAIT is retried up to SWD_RETRIES times, and any
+# other failure is retried once, before it is left as failed
+class Replay(object):
+    def __init__(self, groups, build):
+        self.groups, self.build = groups, build
+        self.n, self.tries = swd_first_failure(groups), 1
+        self.window = 1
+        self.clear = self.n is not None
+        self.ok = True
+        self.h = None
+        self.sent, self.reqs = [], []
+
+    # Return retry limit for the first failed request in the current group
+    def limit(self):
+        req = [r for r in self.groups[self.n] if not r.ok()][0]
+        return SWD_RETRIES if req.ack == swd.SWD_ACK_WAIT else 1
+
+    # Return True if there are requests to be sent
+    # If a group is left as failed, the TAR value is unknown
+    def pending(self):
+        while self.n is not None and self.tries > self.limit():
+            self.ok = False
+            self.h.shadow.tar = None
+            self.n, self.tries = swd_first_failure(self.groups, self.n+1), 1
+            self.window = 1
+        return self.n is not None or self.clear
+
+    # Queue the error clear and the groups to be resent, return requests
+    # A queued CSW write may also have been discarded, so the CSW shadow
+    # value is invalidated, and a group that sets CSW will write it again
+    def send(self, h):
+        REPLAYS.n += 1
+        self.h = h
+        h.shadow.tar = h.shadow.csw = None
+        self.reqs = [swd.swd_wr(h, swd.SWD_DP, DPORT_ABORT, DP_ABORT_CLEAR, True, False)]
+        self.sent = []
+        n = self.n
+        while n is not None and len(self.sent) < self.window:
+            self.groups[n] = self.build(h, n)
+            self.reqs += self.groups[n]
+            self.sent.append(n)
+            n = swd_first_failure(self.groups, n+1)
+        self.clear = False
+        return self.reqs
+
+    # Check the responses to a replay, once they have been decoded
+    def check(self):
+        if self.n is not None:
+            n = swd_first_failure(self.groups, self.n)
+            self.tries = self.tries + 1 if n == self.n else 1
+            self.window = self.window * 2 if n is None or n > self.sent[-1] else 1
+            self.n = n
+            self.clear = n is not None
+
+# Replay groups of requests after a failure, return True if all succeeded
+def swd_replay(h, groups, build):
+    rp = Replay(groups, build)
+    while rp.pending():
+        reqs = rp.send(h)
+        swd.spi_read_bitvals(h, reqs)
+        swd_batch_check(reqs)
+        rp.check()
+    return rp.ok
 
 # Do an immediate read of a 32-bit CPU memory location
 def cpu_mem_read32(h, addr):
-    ap_addr(h, addr)                          # Address to read
-    swd.swd_rd(h, swd.SWD_AP, APORT_DRW)      # Dummy read cycle
-    r = swd.swd_rd(h, swd.SWD_AP, APORT_DRW)  # Read data
-    return r.data.value if r.ack.value==swd.SWD_ACK_OK else None
+    ap_addr(h, addr)                            # Address to read
+    swd.swd_rd(h, swd.SWD_AP, APORT_DRW)        # Start read cycle
+    r = swd.swd_rd(h, swd.SWD_DP, DPORT_RDBUFF) # Read data
+    h.shadow.drw_access(1)
+    if r.ack != swd.SWD_ACK_OK:
+        h.shadow.tar = None
+        return None
+    return r.data
+
+# Split a memory range into blocks that don't cross a 1K boundary, and
+# are small enough to be replayed. Return list of (address, number of words)
+def mem_blocks(addr, nwords, maxwords=MEM_GROUP_WORDS):
+    blocks = []
+    while nwords > 0:
+        n = min(nwords, maxwords,
+                (AP_TAR_WRAP - (addr & (AP_TAR_WRAP-1))) // 4)
+        blocks.append((addr, n))
+        addr += n * 4
+        nwords -= n
+    return blocks
+
+# Queue requests to read a block of memory using auto-increment
+# AP reads are posted, so the first DRW read is a dummy, and the last
+# value is read from RDBUFF. Return list of requests; the values are
+# in the last nwords requests
+def mem_read_group(h, addr, nwords):
+    reqs = ap_addr_reqs(h, addr)
+    for i in range(0, nwords):
+        reqs.append(swd.swd_rd(h, swd.SWD_AP, APORT_DRW, True, False))
+    reqs.append(swd.swd_rd(h, swd.SWD_DP, DPORT_RDBUFF, True, False))
+    h.shadow.drw_access(nwords)
+    return reqs
 
-# Storage class for variable to be polled
+# Queue requests to write a block of memory using auto-increment
+# Return list of requests; the data writes are the last len(data) requests
+def mem_write_group(h, addr, data):
+    reqs = ap_addr_reqs(h, addr)
+    for val in data:
+        reqs.append(swd.swd_wr(h, swd.SWD_AP, APORT_DRW, val, True, False))
+    h.shadow.drw_access(len(data))
+    return reqs
+
+# Transfer a list of memory blocks (address, number of words), given a
+# function make(h, addr, nwords) that queues the requests for a block
+# The groups are sent as a single batch, and replayed after a failure.
+# A block that still fails is split in half and sent again, down to single
+# words, so a high WAIT rate reduces the group size, rather than failing;
+# single words are resent until SWD_RETRIES attempts make no progress.
+# The device group size is halved if blocks had to be split, and doubled
+# (up to MEM_GROUP_WORDS) if the first attempt succeeded, so later
+# transfers start with a group size that suits the WAIT rate
+# Each group starts with a CSW write if the CSW value isn't known to be
+# set, e.g. after the write failed, or in a replay
+# If inc is False, all the blocks are at the same address (for sampling)
+# Returns list of (address, number of words, requests) in address order
+def mem_transfer(h, blocks, make, inc=True):
+    done, first, stalls = [], True, 0
+    build = lambda h, a, n: ap_csw_reqs(h) + make(h, a, n)
+    while blocks:
+        groups = [build(h, a, n) for a, n in blocks]
+        reqs = [req for group in groups for req in group]
+        swd.spi_read_bitvals(h, reqs)
+        swd_batch_check(reqs)
+        if first and swd_first_failure(groups) is None:
+            h.mem_group = min(h.mem_group * 2, MEM_GROUP_WORDS)
+        swd_replay(h, groups, lambda h, i, blocks=blocks: build(h, *blocks[i]))
+        retry, ndone = [], len(done)
+        for (a, n), group in zip(blocks, groups):
+            if all([req.ok() for req in group]) or (n == 1 and stalls >= SWD_RETRIES):
+                done.append((a, n, group))
+            elif n == 1:
+                retry.append((a, n))
+            else:
+                retry += [(a, n // 2), (a + (n // 2) * 4 if inc else a, n - n // 2)]
+        if first and retry:
+            h.mem_group = max(h.mem_group // 2, 1)
+        stalls = stalls + 1 if len(done) == ndone and all([n == 1 for a, n in retry]) else 0
+        blocks, first = retry, False
+    return sorted(done, key=lambda d: d[0])
+
+# Read a block of 32-bit CPU memory locations using address auto-increment
+# The reads are sent as a single batch, split into groups that only need
+# a TAR write at the start of a 1K block, or when replayed after a failure
+# Returns an array of 32-bit values, or None if any read failed
+def cpu_mem_read_block(h, addr, nwords):
+    csw = h.shadow.csw
+    ap_bank_select(h, 0)
+    ap_csw_set(h, 32, True)
+    data, ok = array('I'), True
+    for a, n, group in mem_transfer(h, mem_blocks(addr, nwords, h.mem_group), mem_read_group):
+        ok = ok and all([req.ok() for req in group])
+        data.extend([req.data for req in group[-n:]])
+    ap_csw_restore(h, csw)
+    return data if ok else None
+
+# Read a 32-bit location repeatedly without address increment, to sample
+# a free-running register such as the DWT PC sampler. The reads are sent
+# as a single batch, in groups that can be replayed; only the first group
+# needs a TAR write. Returns an array of the values from the groups that
+# succeeded, so a group that fails after retries is dropped
+def cpu_mem_sample(h, addr, nsamples):
+    csw = h.shadow.csw
+    ap_bank_select(h, 0)
+    ap_csw_set(h, 32, False)
+    blocks = [(addr, min(h.mem_group, nsamples - i))
+              for i in range(0, nsamples, h.mem_group)]
+    data = array('I')
+    for a, n, group in mem_transfer(h, blocks, mem_read_group, False):
+        if all([req.ok() for req in group]):
+            data.extend([req.data for req in group[-n:]])
+    ap_csw_restore(h, csw)
+    return data
+
+# Write a sequence of 32-bit values to CPU memory using auto-increment
+# All writes are queued in one transmit buffer, in groups that only need
+# a TAR write at the start of a 1K block, then the acks are read back in
+# bulk at the end, and the failed groups are replayed
+# Returns a list of the addresses that failed, empty if all succeeded;
+# writes are posted, so a bus fault is reported against the next address
+def cpu_mem_write_block(h, addr, data):
+    csw = h.shadow.csw
+    ap_bank_select(h, 0)
+    ap_csw_set(h, 32, True)
+    data = list(data)
+    make = lambda h, a, n: mem_write_group(h, a, data[(a-addr)//4:(a-addr)//4 + n])
+    failed = []
+    for a, n, group in mem_transfer(h, mem_blocks(addr, len(data), h.mem_group), make):
+        tar_ok = all([req.ok() for req in group[:-n]])
+        for i, req in enumerate(group[-n:]):
+            if not (tar_ok and req.ok()):
+                failed.append(a + i*4)
+    ap_csw_restore(h, csw)
+    return failed
+
+# Fill a block of CPU memory with a 32-bit value
+# Returns a list of the addresses that failed, empty if all succeeded
+def cpu_mem_fill(h, addr, nwords, value):
+    return cpu_mem_write_block(h, addr, [value] * nwords)
+
+# Storage class for variable to be polled, with sample rate and priority
+# A variable of 1 to 4 bytes is within a 32-bit word; its value is
+# extracted from the word using the shift and mask
 class Pollvar(object):
-    def __init__(self, name, addr):
-        self.name, self.addr = name, addr
+    def __init__(self, name, addr, rate=POLL_RATE, priority=0, size=4):
+        if not 1 <= size <= 4 - (addr & 3):
+            raise ValueError("%s: %u bytes at %08X isn't within a word" % (name, size, addr))
+        self.name, self.addr, self.size = name, addr, size
+        self.shift = (addr & 3) * 8
+        self.mask = (1 << (size * 8)) - 1
+        self.period = 1.0 / rate
+        self.priority = priority
+        self.due = 0.0
         self.value = None
 
+    # Return the value of the variable, given the word containing it
+    def extract(self, word):
+        return (word >> self.shift) & self.mask
+
 # Add variable to the polling list
-def poll_add_var(name, addr):
-    poll_vars.append(Pollvar(name, addr))
+def poll_add_var(h, name, addr, rate=POLL_RATE, priority=0, size=4):
+    h.poll_vars.append(Pollvar(name, addr, rate, priority, size))
+    h.poll_plans.clear()
 
-# Send out poll requests
-def poll_send_requests(h):
-    for pv in poll_vars:
-        swd.swd_wr(h, swd.SWD_AP, APORT_TAR, pv.addr, True, False)
-        swd.swd_idle_bytes(h, 2)
-        swd.swd_rd(h, swd.SWD_AP, APORT_DRW, True, False)
-        swd.swd_rd(h, swd.SWD_AP, APORT_DRW, True, False)
+# Add a variable from an ELF file index to the polling list, given its name
+# with optional member & index selectors (e.g. 'state.pts[2]'). Structs and
+# arrays are expanded into their items, and an item that spans more than
+# one 32-bit word is split into 'name', 'name+4' etc.
+# Return list of the variables added; raise ValueError if not found
+def poll_add_symbol(h, index, name, rate=POLL_RATE, priority=0):
+    pvs = []
+    for path, addr, size in index.expand(name):
+        a = addr
+        while a < addr + size:
+            n = min(4 - (a & 3), addr + size - a)
+            pvs.append(Pollvar(path if a == addr else "%s+%u" % (path, a - addr),
+                               a, rate, priority, n))
+            a += n
+    h.poll_vars += pvs
+    h.poll_plans.clear()
+    return pvs
+
+# Return the variables that are due to be polled, highest priority first,
+# and advance their deadlines. If there are too many, the lowest-priority
+# variables are left until the next cycle. If a deadline has been missed
+# by more than one period, the missed samples are skipped
+def poll_due_vars(h, now, maxvars=POLL_MAXVARS):
+    due = [pv for pv in h.poll_vars if pv.due <= now]
+    due.sort(key=lambda pv: (-pv.priority, pv.due))
+    due = due[:maxvars]
+    for pv in due:
+        pv.due += pv.period
+        if pv.due < now:
+            pv.due = now + pv.period
+    return due
+
+# Return the time of the next poll deadline, None if nothing to poll
+def poll_next_due(h):
+    return min([pv.due for pv in h.poll_vars]) if h.poll_vars else None
+
+# Class for a plan of the reads needed to poll a set of variables
+# The words containing the variables are read once, in address order,
+# as runs that can use address auto-increment. Each run is (addr, nwords),
+# and needs a TAR write and RDBUFF read, so runs separated by a small gap
+# are joined, if the gap is in memory that can be read without side-effects
+# slots has the (run, word) index of each variable
+class PollPlan(object):
+    def __init__(self, pvs):
+        self.runs, words = [], {}
+        for addr in sorted(set([pv.addr & ~3 for pv in pvs])):
+            start, n = self.runs[-1] if self.runs else (None, 0)
+            gap = (addr - start) // 4 - n if start is not None else None
+            if (gap is not None and gap <= (POLL_GAP_WORDS if addr < POLL_GAP_LIMIT else 0)
+                    and n + gap < MEM_GROUP_WORDS and
+                    (addr ^ start) & ~(AP_TAR_WRAP-1) == 0):
+                self.runs[-1] = start, n + gap + 1
+            else:
+                self.runs.append((addr, 1))
+            words[addr] = len(self.runs) - 1, (addr - self.runs[-1][0]) // 4
+        self.slots = dict([(pv, words[pv.addr & ~3]) for pv in pvs])
+        self.inc = any([n > 1 for addr, n in self.runs])
+
+# Return the poll plan for a set of variables; plans are cached, so a
+# plan is only made when the set of variables changes
+def poll_plan(h, pvs):
+    key = frozenset(pvs)
+    plan = h.poll_plans.get(key)
+    if plan is None:
+        if len(h.poll_plans) >= POLL_PLANS:
+            h.poll_plans.clear()
+        plan = h.poll_plans[key] = PollPlan(pvs)
+    return plan
+
+# Class for the requests sent in one poll cycle, and the values returned
+# There is a group of requests for each run in the plan, so the batch can
+# be replayed from the first failure; reqs is the list initially sent
+class PollBatch(object):
+    def __init__(self, cycle, pvs, plan):
+        self.cycle, self.pvs, self.plan = cycle, pvs, plan
+        self.time = time.time()
+        self.groups, self.reqs = [], []
+        self.values = []
+        self.received = self.done = False
+        self.replay = None
 
-# Get poll responses
+# Queue the requests to poll a run of words, return list of requests
+# CSW is written if the auto-increment setting has changed, and TAR if the
+# address has changed; the values are in the last nwords requests
+def poll_group(h, run, inc=False):
+    h.csw.reg.AddrInc = 1 if inc else 0
+    return ap_csw_reqs(h) + mem_read_group(h, *run)
+
+# Return a function to rebuild the request group for a run in a batch
+def poll_rebuild(batch):
+    return lambda h, n: poll_group(h, batch.plan.runs[n], batch.plan.inc)
+
+# Create a batch of poll requests for the given variables (default all
+# variables), and add them to the transmit buffer
+def poll_make_batch(h, pvs=None):
+    pvs = list(h.poll_vars if pvs is None else pvs)
+    batch = PollBatch(h.poll_count, pvs, poll_plan(h, pvs))
+    h.poll_count += 1
+    for run in batch.plan.runs:
+        batch.groups.append(poll_group(h, run, batch.plan.inc))
+        batch.reqs += batch.groups[-1]
+    return batch
+
+# Replay a poll batch after a failure
+def poll_replay(h, batch):
+    return swd_replay(h, batch.groups, poll_rebuild(batch))
+
+# Send out poll requests for the given variables (default all variables)
+# The batch is added to the pending list, so the responses can be decoded
+def poll_send_requests(h, pvs=None):
+    batch = poll_make_batch(h, pvs)
+    h.poll_pending.append(batch)
+    return batch
+
+# Get responses for the oldest pending poll batch, using a single read,
+# and add them to the ring buffer (if any). If it failed, the responses
+# to the other pending batches are read (as they will also have failed)
+# before it is replayed
 def poll_get_responses(h):
-    for pv in poll_vars:
-        swd.swd_wr(h, swd.SWD_AP, APORT_TAR, pv.addr, False, True)
-        swd.swd_rd(h, swd.SWD_AP, APORT_DRW, False, True)
-        req = swd.swd_rd(h, swd.SWD_AP, APORT_DRW, False, True)
-        pv.value = req.data.value if (req.data is not None and
-                    req.ack.value==swd.SWD_ACK_OK) else None
+    batch = h.poll_pending.popleft()
+    if not batch.received:
+        swd.spi_read_bitvals(h, batch.reqs)
+        swd_batch_check(batch.reqs)
+    if swd_first_failure(batch.groups) is not None:
+        for b in h.poll_pending:
+            if not b.received:
+                swd.spi_read_bitvals(h, b.reqs)
+                swd_batch_check(b.reqs)
+                b.received = True
+        poll_replay(h, batch)
+    poll_values(batch)
+    if h.ring is not None:
+        h.ring.add_batch(batch)
+    return batch
+
+# Get the values from a decoded poll batch
+# Values are extracted from the words read, and stored in the variables,
+# and in the batch in the same order as its variables; None if failed
+def poll_values(batch):
+    words = []
+    for (addr, n), group in zip(batch.plan.runs, batch.groups):
+        ok = all([req.ok() for req in group])
+        words.append([req.data for req in group[-n:]] if ok else None)
+    for pv in batch.pvs:
+        run, i = batch.plan.slots[pv]
+        pv.value = pv.extract(words[run][i]) if words[run] is not None else None
+    batch.values = [pv.value for pv in batch.pvs]
+    batch.done = True
+    POLL_CYCLE.add(time.time() - batch.time, len(batch.pvs))
+    return batch
+
+# Send a batch of poll requests through a USB I/O worker thread
+def poll_submit(h, worker, pvs=None):
+    batch = poll_make_batch(h, pvs)
+    worker.submit(driver.take_txdata(h), swd.spi_resp_len(batch.reqs), batch)
+    return batch
+
+# Get and decode the next poll batch from a USB I/O worker thread
+# If a batch has failed, replays are sent through the worker, and
+# batches are held back until the earlier ones are complete
+# Batches are added to the ring buffer (if any) in cycle order
+# Raises Queue.Empty if a timeout is given and there is no response
+def poll_collect(worker, timeout=None):
+    h = worker.d
+    while not (h.poll_collected and h.poll_collected[0].done):
+        batch, data = worker.get(timeout)
+        if batch.replay is None:
+            swd.spi_decode_bitvals(batch.reqs, data)
+            swd_batch_check(batch.reqs)
+            h.poll_collected.append(batch)
+            if swd_first_failure(batch.groups) is not None:
+                batch.replay = Replay(batch.groups, poll_rebuild(batch))
+        else:
+            swd.spi_decode_bitvals(batch.replay.reqs, data)
+            swd_batch_check(batch.replay.reqs)
+            batch.replay.check()
+        if batch.replay is not None and batch.replay.pending():
+            reqs = batch.replay.send(h)
+            worker.submit(driver.take_txdata(h), swd.spi_resp_len(reqs), batch)
+        else:
+            poll_values(batch)
+    batch = h.poll_collected.popleft()
+    if h.ring is not None:
+        h.ring.add_batch(batch)
+    return batch
+
+# Pipelined polling: send the requests for a new cycle to the device, then
+# decode the oldest cycles until no more than depth-1 are left in flight
+# This keeps the device busy while responses are decoded
+# Returns a list of the completed batches, which may be empty
+def poll_pipeline(h, pvs=None, depth=POLL_DEPTH):
+    poll_send_requests(h, pvs)
+    driver.write_flush(h)
+    done = []
+    while len(h.poll_pending) >= max(depth, 1):
+        done.append(poll_get_responses(h))
+    return done
+
+# Decode all the outstanding poll cycles, return list of batches
+def poll_drain(h):
+    done = []
+    while h.poll_pending:
+        done.append(poll_get_responses(h))
+    return done
 
 if __name__ == "__main__":
     #driver.VERBOSE = True
     swd.VERBOSE = True
-    dev = driver.open()
+    dev = open()
     if not dev:
         print("Can't open FTDI device")
     else:
@@ -180,6 +725,9 @@ if __name__ == "__main__":
             val = cpu_mem_read32(dev, TEST_ADDR)        # Read 32-bit value at address
             print(("Addr %08X read failed" % TEST_ADDR) if val is None else
                   ("Addr %08X value %X" % (TEST_ADDR, val)))
+            vals = cpu_mem_read_block(dev, GPIOB, 8)    # Read block of values
+            print(("Addr %08X block read failed" % GPIOB) if vals is None else
+                  ("Addr %08X values %s" % (GPIOB, " ".join(["%X" % v for v in vals]))))
         driver.close(dev)
 
 # EOF
@@ -0,0 +1,217 @@
+# Throughput benchmarks for Iosoft Reporta project, using emulated hardware
+# Reports samples/sec, USB bytes per SWD transaction, and host CPU time
+# per sample (excluding time spent in the emulation itself)
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import sys, os, time, json, argparse
+import rp_emul, rp_arm as arm, rp_swd as swd, rp_ftd2xx as driver
+
+timer = getattr(time, "perf_counter", time.time)
+cpu_timer = getattr(time, "process_time", time.clock if hasattr(time, "clock") else time.time)
+
+BENCH_SECS      = 2.0       # Default duration of each timed benchmark
+BENCH_VARS      = 8         # Default number of poll variables
+BENCH_WORDS     = 5120      # Words in block read/write (20K STM32F1 SRAM)
+BENCH_GUI_UPDATES = 2000    # Number of GUI updates
+
+# Open and initialise an emulated device, with given USB latency (sec)
+# and probability of a WAIT response to an AP access
+def bench_open(latency=0.0, wait_prob=0.0):
+    driver.EMULATE = True
+    rp_emul.EMU_LATENCY = latency
+    rp_emul.EMU_WAIT_PROB = wait_prob
+    d = arm.open()
+    driver.spi_init(d)
+    swd.swd_reset(d)
+    arm.cpu_swd_start(d)
+    arm.ap_config(d, 32)
+    return d
+
+# Class to measure the resources used by a benchmark
+class Measure(object):
+    def __init__(self, d, name):
+        self.d, self.name = d, name
+        self.samples = 0
+
+    def __enter__(self):
+        d = self.d
+        self.start = (timer(), cpu_timer(), d.emu_time, d.txbytes,
+                      d.rxbytes, d.target.transactions, d.nreads)
+        return self
+
+    def __exit__(self, *args):
+        d = self.d
+        end = (timer(), cpu_timer(), d.emu_time, d.txbytes,
+               d.rxbytes, d.target.transactions, d.nreads)
+        diff = [b - a for a, b in zip(self.start, end)]
+        self.secs, cpu, emu, self.txbytes, self.rxbytes, self.trans, self.reads = diff
+        self.cpu = max(cpu - emu, 0)
+
+    # Return dictionary of results
+    def results(self):
+        n = max(self.samples, 1)
+        return {"name": self.name, "samples": self.samples,
+                "samples_per_sec": self.samples / self.secs if self.secs else 0,
+                "bytes_per_trans": (self.txbytes + self.rxbytes) / float(max(self.trans, 1)),
+                "trans_per_sample": self.trans / float(n),
+                "reads_per_sample": self.reads / float(n),
+                "cpu_us_per_sample": 1e6 * self.cpu / n}
+
+# Set up a number of poll variables of the given size (bytes)
+def bench_poll_vars(d, nvars, size=4):
+    del d.poll_vars[:]
+    for n in range(0, nvars):
+        arm.poll_add_var(d, "V%u" % n, arm.GPIOB + arm.GPIO_IDR if n == 0 else
+                         0x20000000 + n*size, size=4 if n == 0 else size)
+
+# Benchmark the polling of a number of variables
+def bench_poll(d, nvars=BENCH_VARS, secs=BENCH_SECS, size=4):
+    bench_poll_vars(d, nvars, size)
+    with Measure(d, "poll %u vars" % nvars if size == 4 else
+                 "poll %u %u-byte vars" % (nvars, size)) as m:
+        end = timer() + secs
+        while timer() < end:
+            arm.poll_send_requests(d)
+            arm.poll_get_responses(d)
+            m.samples += nvars
+    return m
+
+# Benchmark pipelined polling of a number of variables
+def bench_poll_pipeline(d, nvars=BENCH_VARS, secs=BENCH_SECS, depth=arm.POLL_DEPTH):
+    bench_poll_vars(d, nvars)
+    with Measure(d, "poll %u vars depth %u" % (nvars, depth)) as m:
+        end = timer() + secs
+        while timer() < end:
+            for batch in arm.poll_pipeline(d, None, depth):
+                m.samples += len(batch.values)
+        for batch in arm.poll_drain(d):
+            m.samples += len(batch.values)
+    return m
+
+# Benchmark polling using a separate USB I/O thread
+def bench_poll_io_thread(d, nvars=BENCH_VARS, secs=BENCH_SECS, depth=arm.POLL_DEPTH):
+    bench_poll_vars(d, nvars)
+    worker = driver.IoWorker(d)
+    worker.start()
+    with Measure(d, "poll %u vars I/O thread" % nvars) as m:
+        end, inflight = timer() + secs, 0
+        while timer() < end or inflight:
+            if inflight >= depth or timer() >= end:
+                m.samples += len(arm.poll_collect(worker).values)
+                inflight -= 1
+            else:
+                arm.poll_submit(d, worker)
+                inflight += 1
+    worker.stop()
+    return m
+
+# Benchmark block read of CPU memory
+def bench_block_read(d, nwords=BENCH_WORDS):
+    with Measure(d, "block read %u words" % nwords) as m:
+        data = arm.cpu_mem_read_block(d, 0x20000000, nwords)
+        m.samples = len(data) if data is not None else 0
+    return m
+
+# Benchmark block write of CPU memory
+def bench_block_write(d, nwords=BENCH_WORDS):
+    with Measure(d, "block write %u words" % nwords) as m:
+        failed = arm.cpu_mem_fill(d, 0x20000000, nwords, 0)
+        m.samples = nwords - len(failed)
+    return m
+
+# Benchmark PC sampling using repeated reads of the DWT PC sample register
+def bench_pc_sample(d, secs=BENCH_SECS, batch=1024):
+    with Measure(d, "PC sample batch %u" % batch) as m:
+        end = timer() + secs
+        while timer() < end:
+            m.samples += len(arm.cpu_mem_sample(d, 0xE000101C, batch))
+    return m
+
+# Benchmark GUI port updates, if PyQt is available
+def bench_gui(d, nupdates=BENCH_GUI_UPDATES):
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    try:
+        import rp_pyqt as pyqt
+    except ImportError:
+        return None
+    app = pyqt.QtWidgets.QApplication.instance() or pyqt.QtWidgets.QApplication(sys.argv)
+    widget = pyqt.MyWidget()
+    with Measure(d, "GUI %u port updates" % nupdates) as m:
+        for n in range(0, nupdates):
+            widget.update_graph("PB=%X" % (n & 0xffff))
+            m.samples += 1
+        app.processEvents()
+    sys.stdout = sys.__stdout__
+    return m
+
+# Benchmark GUI port updates using integer values, if PyQt is available
+def bench_gui_ports(d, nupdates=BENCH_GUI_UPDATES):
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    try:
+        import rp_pyqt as pyqt
+    except ImportError:
+        return None
+    app = pyqt.QtWidgets.QApplication.instance() or pyqt.QtWidgets.QApplication(sys.argv)
+    widget = pyqt.MyWidget()
+    port = pyqt.port_id("PB")
+    with Measure(d, "GUI %u int port updates" % nupdates) as m:
+        for n in range(0, nupdates):
+            widget.update_port(port, n & 0xffff)
+            m.samples += 1
+        app.processEvents()
+    sys.stdout = sys.__stdout__
+    return m
+
+# Run all the benchmarks, return list of results
+def bench_all(latency=0.0, nvars=BENCH_VARS, secs=BENCH_SECS, wait_prob=0.0):
+    d = bench_open(latency, wait_prob)
+    meas = [bench_poll(d, 1, secs), bench_poll(d, nvars, secs),
+            bench_poll(d, nvars, secs, 1),
+            bench_poll_pipeline(d, nvars, secs), bench_poll_io_thread(d, nvars, secs),
+            bench_block_read(d), bench_block_write(d), bench_pc_sample(d, secs),
+            bench_gui(d),
+            bench_gui_ports(d)]
+    driver.close(d)
+    return [m.results() for m in meas if m is not None]
+
+# Display results
+def disp_results(results):
+    print("%-24s %12s %8s %8s %8s %10s" % ("Benchmark", "Samples/s",
+          "Bytes/tr", "Tr/samp", "Rd/samp", "CPU us"))
+    for r in results:
+        print("%-24s %12.0f %8.1f %8.2f %8.3f %10.1f" % (r["name"],
+              r["samples_per_sec"], r["bytes_per_trans"], r["trans_per_sample"],
+              r["reads_per_sample"], r["cpu_us_per_sample"]))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reporta benchmarks")
+    parser.add_argument("-l", "--latency", type=float, default=0.0,
+                        help="emulated USB latency (msec)")
+    parser.add_argument("-n", "--nvars", type=int, default=BENCH_VARS,
+                        help="number of poll variables")
+    parser.add_argument("-s", "--secs", type=float, default=BENCH_SECS,
+                        help="duration of timed benchmarks (sec)")
+    parser.add_argument("-w", "--wait", type=float, default=0.0,
+                        help="probability of emulated WAIT response")
+    parser.add_argument("-j", "--json", action="store_true",
+                        help="output results as JSON")
+    args = parser.parse_args()
+    results = bench_all(args.latency / 1000.0, args.nvars, args.secs, args.wait)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        disp_results(results)
+
+# EOF
@@ -0,0 +1,247 @@
+# Binary capture files for Iosoft Reporta project
+# Poll samples are stored as fixed-width records in delta-encoded,
+# compressed chunks, with a time index in the file footer
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import sys, os, time, struct, zlib, mmap
+import numpy as np
+
+CAPTURE_MAGIC   = b"RPCAPT02"   # File identifier
+INDEX_MAGIC     = b"RPINDX01"   # Footer identifier
+CAPTURE_CHUNK   = 4096          # Records per chunk
+CAPTURE_LEVEL   = 6             # zlib compression level
+
+# File layout: header, variable table, chunks, index, trailer
+# Times are stored as microseconds, values as uint32 with a valid flag
+HEADER_FMT      = "<8sI"        # Magic, number of variables
+VAR_FMT         = "<IH"         # Variable address, name length (then UTF-8 name)
+CHUNK_FMT       = "<IIqq"       # Records, data length, first & last time
+INDEX_FMT       = "<Qqq"        # Chunk offset, first & last time
+TRAILER_FMT     = "<QI8s"       # Index offset, number of chunks, magic
+
+# Delta-encode and compress a chunk of records, return bytes
+# Each column is stored separately, as this compresses better
+def chunk_encode(times, values, valid):
+    dt, dv = times.copy(), values.copy()
+    dt[1:] -= times[:-1]
+    dv[1:] -= values[:-1]
+    data = (dt.astype('<i8').tobytes() + dv.astype('<u4').T.tobytes() +
+            valid.astype('u1').T.tobytes())
+    return zlib.compress(data, CAPTURE_LEVEL)
+
+# Decompress and decode a chunk, return (times, values, valid) arrays
+def chunk_decode(data, nrecs, nvars):
+    raw = zlib.decompress(data)
+    times = np.frombuffer(raw, '<i8', nrecs, 0).cumsum()
+    n = nrecs * 8
+    dv = np.frombuffer(raw, '<u4', nrecs*nvars, n).reshape(nvars, nrecs).T
+    values = dv.cumsum(axis=0, dtype=np.uint32)
+    n += nrecs * nvars * 4
+    valid = np.frombuffer(raw, 'u1', nrecs*nvars, n).reshape(nvars, nrecs).T != 0
+    return times, values, valid
+
+# Class to write poll samples to a capture file, one record per poll cycle
+class CaptureWriter(object):
+    def __init__(self, fname, pvs, chunk=CAPTURE_CHUNK):
+        self.names = [pv.name for pv in pvs]
+        self.cols = dict([(name, n) for n, name in enumerate(self.names)])
+        self.chunk = chunk
+        self.times = np.zeros(chunk, np.int64)
+        self.values = np.zeros((chunk, len(pvs)), np.uint32)
+        self.valid = np.zeros((chunk, len(pvs)), np.bool_)
+        self.nrecs = 0
+        self.index = []
+        self.f = open(fname, "wb")
+        self.f.write(struct.pack(HEADER_FMT, CAPTURE_MAGIC, len(pvs)))
+        for pv in pvs:
+            name = pv.name.encode("utf-8")
+            self.f.write(struct.pack(VAR_FMT, pv.addr, len(name)) + name)
+
+    # Add a record from a decoded poll batch, ignoring unknown variables
+    def add_batch(self, batch):
+        i = self.nrecs
+        self.times[i] = int(batch.time * 1e6)
+        self.valid[i] = False
+        for pv, val in zip(batch.pvs, batch.values):
+            col = self.cols.get(pv.name)
+            if col is not None and val is not None:
+                self.values[i, col] = val
+                self.valid[i, col] = True
+        self.nrecs += 1
+        if self.nrecs >= self.chunk:
+            self.flush()
+
+    # Write the buffered records as a chunk
+    def flush(self):
+        n = self.nrecs
+        if n:
+            data = chunk_encode(self.times[:n], self.values[:n], self.valid[:n])
+            self.index.append((self.f.tell(), self.times[0], self.times[n-1]))
+            self.f.write(struct.pack(CHUNK_FMT, n, len(data),
+                                     self.times[0], self.times[n-1]))
+            self.f.write(data)
+            self.nrecs = 0
+
+    # Write the remaining records, the index and trailer, and close file
+    def close(self):
+        if self.f:
+            self.flush()
+            offset = self.f.tell()
+            for entry in self.index:
+                self.f.write(struct.pack(INDEX_FMT, *entry))
+            self.f.write(struct.pack(TRAILER_FMT, offset, len(self.index), INDEX_MAGIC))
+            self.f.close()
+            self.f = None
+
+# Class to read a capture file, which is memory-mapped, so that a time
+# range can be decoded without reading the rest of the file
+# If the file wasn't closed properly, the index is rebuilt from the chunks;
+# a file that is too short to have a header (e.g. left by a writer that was
+# interrupted) gives a ValueError
+class CaptureReader(object):
+    def __init__(self, fname):
+        self.f = open(fname, "rb")
+        if os.fstat(self.f.fileno()).st_size < struct.calcsize(HEADER_FMT):
+            self.f.close()
+            raise ValueError("Empty capture file: %s" % fname)
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, nvars = struct.unpack_from(HEADER_FMT, self.mm, 0)
+        if magic != CAPTURE_MAGIC:
+            raise ValueError("Not a capture file: %s" % fname)
+        n = struct.calcsize(HEADER_FMT)
+        self.names, self.addrs = [], []
+        for i in range(0, nvars):
+            addr, nlen = struct.unpack_from(VAR_FMT, self.mm, n)
+            n += struct.calcsize(VAR_FMT)
+            self.names.append(self.mm[n:n+nlen].decode("utf-8"))
+            self.addrs.append(addr)
+            n += nlen
+        index = self.read_index() or self.scan_chunks(n)
+        self.offsets = np.array([e[0] for e in index], np.int64)
+        self.firsts = np.array([e[1] for e in index], np.int64)
+        self.lasts = np.array([e[2] for e in index], np.int64)
+
+    # Read the index from the footer, return list of entries, None if absent
+    def read_index(self):
+        tlen = struct.calcsize(TRAILER_FMT)
+        if len(self.mm) < tlen:
+            return None
+        offset, nchunks, magic = struct.unpack_from(TRAILER_FMT, self.mm, len(self.mm)-tlen)
+        if magic != INDEX_MAGIC:
+            return None
+        ilen = struct.calcsize(INDEX_FMT)
+        return [struct.unpack_from(INDEX_FMT, self.mm, offset + i*ilen)
+                for i in range(0, nchunks)]
+
+    # Rebuild the index by scanning the chunk headers, starting at offset
+    def scan_chunks(self, offset):
+        index, clen = [], struct.calcsize(CHUNK_FMT)
+        while offset + clen <= len(self.mm):
+            nrecs, dlen, first, last = struct.unpack_from(CHUNK_FMT, self.mm, offset)
+            if offset + clen + dlen > len(self.mm):
+                break
+            index.append((offset, first, last))
+            offset += clen + dlen
+        return index
+
+    # Return number of chunks
+    def __len__(self):
+        return len(self.offsets)
+
+    # Return start and end times of the capture (sec)
+    def time_range(self):
+        return ((self.firsts[0] / 1e6, self.lasts[-1] / 1e6) if len(self) else
+                (None, None))
+
+    # Decode a chunk, return (times, values, valid) with times in seconds
+    def read_chunk(self, n):
+        offset = self.offsets[n]
+        nrecs, dlen, first, last = struct.unpack_from(CHUNK_FMT, self.mm, offset)
+        offset += struct.calcsize(CHUNK_FMT)
+        times, values, valid = chunk_decode(self.mm[offset:offset+dlen],
+                                            nrecs, len(self.names))
+        return times / 1e6, values, valid
+
+    # Generator to return (times, values, valid) for each chunk in a time
+    # range, with optional start time (inclusive) and end time (exclusive)
+    # Only the chunks that overlap the range are decoded
+    def chunks(self, start=None, end=None):
+        lo = 0 if start is None else np.searchsorted(self.lasts, int(start * 1e6), 'left')
+        hi = len(self) if end is None else np.searchsorted(self.firsts, int(end * 1e6), 'left')
+        for n in range(lo, hi):
+            times, values, valid = self.read_chunk(n)
+            mask = np.ones(len(times), np.bool_)
+            if start is not None:
+                mask &= times >= start
+            if end is not None:
+                mask &= times < end
+            yield times[mask], values[mask], valid[mask]
+
+    # Return (times, values, valid) arrays for a time range
+    def read(self, start=None, end=None):
+        parts = list(self.chunks(start, end))
+        if not parts:
+            return (np.zeros(0), np.zeros((0, len(self.names)), np.uint32),
+                    np.zeros((0, len(self.names)), np.bool_))
+        return tuple([np.concatenate(p) for p in zip(*parts)])
+
+    # Close the file
+    def close(self):
+        self.mm.close()
+        self.f.close()
+
+# Replay a time range from a capture file, calling emit with the name
+# and value of each variable that changes (None if the read failed), in
+# the same way as the poll task
+# Timing is scaled by the speed factor (0 for no delays); stop is an
+# optional function that returns True to end the replay
+def capture_replay(reader, emit, start=None, end=None, speed=1.0, stop=None):
+    nvars = len(reader.names)
+    last_v, last_ok = np.zeros(nvars, np.uint32), np.zeros(nvars, np.bool_)
+    t0 = wall0 = None
+    for times, values, valid in reader.chunks(start, end):
+        if not len(times):
+            continue
+        prev_v = np.vstack((last_v, values[:-1]))
+        prev_ok = np.vstack((last_ok, valid[:-1]))
+        changed = (valid != prev_ok) | (valid & (values != prev_v))
+        for i in np.nonzero(changed.any(axis=1))[0]:
+            if stop and stop():
+                return
+            if t0 is None:
+                t0, wall0 = times[i], time.time()
+            if speed > 0:
+                delay = wall0 + (times[i] - t0) / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            for col in np.nonzero(changed[i])[0]:
+                emit(reader.names[col], int(values[i, col]) if valid[i, col] else None)
+        last_v, last_ok = values[-1], valid[-1]
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: rp_capture.py FILE [START END]")
+    else:
+        reader = CaptureReader(sys.argv[1])
+        start, end = reader.time_range()
+        print("%u variables, %u chunks, %.3f sec" % (len(reader.names),
+              len(reader), (end - start) if len(reader) else 0))
+        if len(sys.argv) > 3:
+            start, end = start + float(sys.argv[2]), start + float(sys.argv[3])
+            capture_replay(reader, lambda name, val: print("%s=%s" % (name,
+                           ("%08X" % val) if val is not None else "?")), start, end, 0)
+        reader.close()
+
+# EOF
@@ -0,0 +1,177 @@
+# Headless command-line polling for Iosoft Reporta project
+# Streams poll samples as CSV or JSON lines, without importing PyQt
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import sys, time, json, argparse
+import rp_arm as arm, rp_ftd2xx as driver, rp_multi, rp_tune, rp_stats
+
+CLI_IDLE        = 0.1       # Max delay if nothing to poll (sec)
+CLI_BUFFER      = 65536     # Output file buffer size (bytes)
+CLI_FLUSH       = 0.5       # Max time between output flushes (sec)
+CLI_FORMATS     = ("csv", "json")
+PORT_ADDRS      = dict(PA=arm.GPIOA, PB=arm.GPIOB, PC=arm.GPIOC,
+                       PD=arm.GPIOD, PE=arm.GPIOE)
+
+# Parse a poll variable definition NAME=ADDR[@RATE], return (name, addr, rate)
+# A port name (PA to PE) can be given without an address, for its input
+# register; a word-aligned hex address can be given without a name, if it
+# starts with a digit. Any other name is an ELF file variable, with optional
+# selectors, and is returned with no address
+def parse_var(s, rate=arm.POLL_RATE):
+    s, _, r = s.partition("@")
+    name, _, addr = s.rpartition("=")
+    rate = float(r) if r else rate
+    if not name and addr.upper() not in PORT_ADDRS and not addr[:1].isdigit():
+        return addr, None, rate
+    if not name:
+        name = addr
+    if addr.upper() in PORT_ADDRS:
+        name, addr = addr.upper(), PORT_ADDRS[addr.upper()] + arm.GPIO_IDR
+    else:
+        addr = int(addr, 16)
+        if addr & 3:
+            raise ValueError("address %X isn't word-aligned" % addr)
+    return name, addr, rate
+
+# Class to format poll batches as lines of text, and write them to a file
+# with buffering; the file is flushed at intervals, so output is streamed
+class SampleWriter(object):
+    def __init__(self, f, names, fmt="csv"):
+        self.f, self.names, self.fmt = f, list(names), fmt
+        self.cols = dict([(name, n) for n, name in enumerate(self.names)])
+        self.flushed = time.time()
+        if fmt == "csv":
+            self.f.write("time,%s\n" % ",".join(self.names))
+
+    # Return a text line for a batch: CSV has a column for every variable,
+    # empty if not polled or failed; JSON has the polled variables, with
+    # null if failed
+    def format(self, batch):
+        if self.fmt == "json":
+            d = dict([("time", round(batch.time, 6))])
+            d.update([(pv.name, val) for pv, val in zip(batch.pvs, batch.values)])
+            return json.dumps(d) + "\n"
+        vals = [""] * len(self.names)
+        for pv, val in zip(batch.pvs, batch.values):
+            if val is not None:
+                vals[self.cols[pv.name]] = str(val)
+        return "%.6f,%s\n" % (batch.time, ",".join(vals))
+
+    # Write a list of batches, flushing the file if it is time to do so
+    def write(self, batches):
+        for batch in batches:
+            self.f.write(self.format(batch))
+        now = time.time()
+        if now - self.flushed >= CLI_FLUSH:
+            self.f.flush()
+            self.flushed = now
+
+# Poll the variables until the time (sec) or number of batches is reached,
+# or interrupted, writing the samples; return number of batches
+def cli_poll(h, writer, secs=None, count=None, depth=arm.POLL_DEPTH):
+    end = time.time() + secs if secs else None
+    total = 0
+    try:
+        while (end is None or time.time() < end) and (not count or total < count):
+            pvs = arm.poll_due_vars(h, time.time())
+            batches = arm.poll_pipeline(h, pvs, depth) if pvs else []
+            due = arm.poll_next_due(h)
+            delay = CLI_IDLE if due is None else due - time.time()
+            if delay > 0:
+                batches += arm.poll_drain(h)
+            writer.write(batches)
+            total += len(batches)
+            if delay > 0:
+                time.sleep(min(delay, CLI_IDLE))
+    except KeyboardInterrupt:
+        pass
+    batches = arm.poll_drain(h)
+    writer.write(batches)
+    return total + len(batches)
+
+# Run the command-line interface with a list of arguments, return exit code
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reporta headless poll")
+    parser.add_argument("vars", nargs="*", default=["PB"],
+                        help="poll variables NAME=ADDR[@RATE] with hex ADDR, "
+                             "or ELF VARIABLE[@RATE] (default PB)")
+    parser.add_argument("-x", "--elf", help="ELF file for variable names")
+    parser.add_argument("-f", "--format", choices=CLI_FORMATS, default="csv",
+                        help="output format")
+    parser.add_argument("-o", "--output", help="output file (default stdout)")
+    parser.add_argument("-r", "--rate", type=float, default=arm.POLL_RATE,
+                        help="default poll rate (samples/sec)")
+    parser.add_argument("-s", "--secs", type=float, help="polling time (sec)")
+    parser.add_argument("-n", "--count", type=int, help="number of poll cycles")
+    parser.add_argument("-d", "--depth", type=int, default=arm.POLL_DEPTH,
+                        help="pipeline depth")
+    parser.add_argument("-i", "--index", type=int, default=0,
+                        help="probe index")
+    parser.add_argument("-t", "--tune", action="store_true",
+                        help="use cached or auto-tuned link settings")
+    parser.add_argument("-S", "--stats", metavar="FILE",
+                        help="write JSON statistics on exit ('-' for stderr)")
+    parser.add_argument("-p", "--profile", action="store_true",
+                        help="enable sampling profiler (with --stats)")
+    parser.add_argument("-e", "--emulate", action="store_true",
+                        help="use emulated probe")
+    args = parser.parse_args(argv)
+    index = None
+    try:
+        pvars = [parse_var(s, args.rate) for s in args.vars]
+        if args.elf:
+            import rp_elf
+            index = rp_elf.ElfIndex(args.elf)
+        for name, addr, rate in pvars:
+            if addr is None and index is None:
+                raise ValueError("'%s' needs an ELF file" % name)
+            elif addr is None:
+                index.resolve(name)
+    except (ValueError, IOError) as e:
+        parser.error("invalid variable: %s" % e)
+    driver.EMULATE = driver.EMULATE or args.emulate
+    if args.stats:
+        rp_stats.dump_on_exit(args.stats)
+        if args.profile:
+            rp_stats.profile_start()
+    h = rp_multi.probe_start(args.index)
+    if not h:
+        print("Can't start SWD interface", file=sys.stderr)
+        return 1
+    if args.tune:
+        print("Link: %s" % rp_tune.profile_str(rp_tune.link_setup(h)), file=sys.stderr)
+    for name, addr, rate in pvars:
+        if addr is None:
+            arm.poll_add_symbol(h, index, name, rate)
+        else:
+            arm.poll_add_var(h, name, addr, rate)
+    f = open(args.output, "w", CLI_BUFFER) if args.output else sys.stdout
+    writer = SampleWriter(f, [pv.name for pv in h.poll_vars], args.format)
+    try:
+        n = cli_poll(h, writer, args.secs, args.count, args.depth)
+        f.flush()
+        print("%u poll cycles" % n, file=sys.stderr)
+    except IOError:
+        pass
+    finally:
+        driver.close(h)
+        if args.output:
+            f.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+# EOF
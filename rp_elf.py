@@ -0,0 +1,364 @@
+# ELF file symbol table for Iosoft Reporta project
+# Reads the function & variable symbols from a 32-bit little-endian ELF
+# file, as produced by an ARM compiler, and resolves addresses to symbols;
+# an index of the global variables, with their DWARF types, is cached on disk
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import os, re, sys, json, struct, hashlib
+import numpy as np
+try:
+    from elftools.elf.elffile import ELFFile
+except ImportError:
+    ELFFile = None
+
+ELF_MAGIC       = b"\x7fELF"
+ELF_HDR_FMT     = "<16sHHIIIIIHHHHHH"   # ELF32 file header
+ELF_SHDR_FMT    = "<IIIIIIIIII"         # ELF32 section header
+ELF_SYM_FMT     = "<IIIBBH"             # ELF32 symbol table entry
+SHT_SYMTAB      = 2                     # Section type: symbol table
+STT_OBJECT      = 1                     # Symbol types: variable
+STT_FUNC        = 2                     #               function
+STT_FILE        = 4                     #               source file name
+ELF_CACHE_DIR   = os.path.join(os.path.expanduser("~"), ".reporta_elf")
+ELF_CACHE_VERSION = 1                   # Version of index cache format
+ELF_MAX_ITEMS   = 1024                  # Max items when expanding a variable
+ELF_PATH_RE     = r"[A-Za-z_]\w*(\.[A-Za-z_]\w*|\[\s*\d+\s*\])*$" # Variable, members & indexes
+DW_OP_ADDR      = 0x03                  # DWARF location: static address
+DW_OP_PLUS_UCONST = 0x23                # DWARF location: add constant
+DW_TYPE_TAGS    = ("DW_TAG_typedef", "DW_TAG_volatile_type",
+                   "DW_TAG_const_type", "DW_TAG_restrict_type") # Type qualifiers
+
+# Class for a symbol: name, address, size, type, and source file name
+class ElfSymbol(object):
+    __slots__ = ("name", "addr", "size", "typ", "fname")
+
+    def __init__(self, name, addr, size, typ, fname=""):
+        self.name, self.addr, self.size, self.typ = name, addr, size, typ
+        self.fname = fname
+
+    def __repr__(self):
+        return "%s %08X %u" % (self.name, self.addr, self.size)
+
+# Read the function & variable symbols from an ELF file, return a list
+# The Thumb bit is removed from function addresses; local symbols get the
+# file name from the preceding file symbol
+def elf_symbols(fname):
+    with open(fname, "rb") as f:
+        data = f.read()
+    hdr = struct.unpack_from(ELF_HDR_FMT, data, 0)
+    ident, shoff, shentsize, shnum = hdr[0], hdr[6], hdr[11], hdr[12]
+    if ident[:4] != ELF_MAGIC or ident[4] not in (1, b"\x01") or ident[5] not in (1, b"\x01"):
+        raise ValueError("Not a 32-bit little-endian ELF file: %s" % fname)
+    shdrs = [struct.unpack_from(ELF_SHDR_FMT, data, shoff + n*shentsize)
+             for n in range(0, shnum)]
+    syms = []
+    for sh in shdrs:
+        if sh[1] != SHT_SYMTAB:
+            continue
+        stroff = shdrs[sh[6]][4]
+        srcfile = ""
+        for offset in range(sh[4], sh[4] + sh[5], sh[9]):
+            name, addr, size, info, other, shndx = struct.unpack_from(ELF_SYM_FMT, data, offset)
+            end = data.index(b"\0", stroff + name)
+            name = data[stroff + name:end].decode("utf-8", "replace")
+            typ = info & 0xf
+            if typ == STT_FILE:
+                srcfile = name
+            elif typ in (STT_FUNC, STT_OBJECT) and shndx:
+                if typ == STT_FUNC:
+                    addr &= ~1
+                syms.append(ElfSymbol(name, addr, size, typ,
+                                      srcfile if info >> 4 == 0 else ""))
+    return syms
+
+# Class for a table of symbols, sorted by address for lookup
+class SymbolTable(object):
+    def __init__(self, syms):
+        self.syms = sorted(syms, key=lambda s: (s.addr, -s.size))
+        self.addrs = np.array([s.addr for s in self.syms], np.uint32)
+        self.ends = np.array([s.addr + max(s.size, 1) for s in self.syms], np.uint64)
+        self.names = dict([(s.name, s) for s in self.syms])
+
+    # Return symbols of the given type (default functions)
+    def of_type(self, typ=STT_FUNC):
+        return SymbolTable([s for s in self.syms if s.typ == typ])
+
+    # Return the symbol with the given name, None if not found
+    def find(self, name):
+        return self.names.get(name)
+
+    # Return an array of symbol indexes for an array of addresses,
+    # -1 if an address isn't within a symbol
+    def lookup(self, addrs):
+        addrs = np.asarray(addrs, np.uint32)
+        idx = np.searchsorted(self.addrs, addrs, 'right') - 1
+        inside = (idx >= 0) & (addrs < self.ends[np.maximum(idx, 0)])
+        return np.where(inside, idx, -1)
+
+    # Return the symbol containing an address, None if not found
+    def symbol(self, addr):
+        n = int(self.lookup([addr])[0])
+        return self.syms[n] if n >= 0 else None
+
+# Return the hash of an ELF file's contents, as a hex string
+def elf_hash(fname):
+    with open(fname, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+# Return the value of an unsigned LEB128 number in a list of bytes
+def uleb128(data):
+    val = 0
+    for n, b in enumerate(data):
+        val |= (b & 0x7f) << (7 * n)
+        if not b & 0x80:
+            break
+    return val
+
+# Return the value of a DWARF attribute, or a default if not present
+def dwarf_attr(die, name, default=None):
+    attr = die.attributes.get(name)
+    return attr.value if attr is not None else default
+
+# Return the DIE for the type of a DWARF entry, None if void
+def dwarf_type(die):
+    return die.get_DIE_from_attribute("DW_AT_type") if "DW_AT_type" in die.attributes else None
+
+# Class to build a table of the data types of variables from DWARF entries
+# Each type is a list: base ["b", size, encoding], struct or union
+# ["s", size, [[member, offset, type_id], ...]], or array
+# ["a", size, element_type_id, count]; the type_id is the index in the table
+# Typedefs & qualifiers are skipped, and multi-dimensional arrays are
+# converted to arrays of arrays
+class DwarfTypes(object):
+    def __init__(self):
+        self.types, self.ids = [], {}
+
+    # Add a type to the table, return the ID
+    def add(self, typ):
+        self.types.append(typ)
+        return len(self.types) - 1
+
+    # Return the ID of the type of a DIE, adding it if necessary
+    def type_id(self, die):
+        while die is not None and die.tag in DW_TYPE_TAGS:
+            die = dwarf_type(die)
+        key = die.offset if die is not None else None
+        if key in self.ids:
+            return self.ids[key]
+        tid = self.ids[key] = self.add(None)
+        size = dwarf_attr(die, "DW_AT_byte_size", 0) if die is not None else 0
+        if die is None:
+            self.types[tid] = ["b", 0, 0]
+        elif die.tag in ("DW_TAG_structure_type", "DW_TAG_union_type", "DW_TAG_class_type"):
+            self.types[tid] = ["s", size, []]
+            for child in die.iter_children():
+                if child.tag == "DW_TAG_member":
+                    name = dwarf_attr(child, "DW_AT_name", b"").decode("utf-8", "replace")
+                    self.types[tid][2].append([name, self.member_offset(child),
+                                               self.type_id(dwarf_type(child))])
+        elif die.tag == "DW_TAG_array_type":
+            counts = [self.subrange_count(child) for child in die.iter_children()
+                      if child.tag == "DW_TAG_subrange_type"] or [0]
+            elem = self.type_id(dwarf_type(die))
+            for count in reversed(counts[1:]):
+                elem = self.add(["a", count * self.types[elem][1], elem, count])
+            self.types[tid] = ["a", counts[0] * self.types[elem][1], elem, counts[0]]
+        else:
+            self.types[tid] = ["b", size or (4 if die.tag == "DW_TAG_pointer_type" else 0),
+                               dwarf_attr(die, "DW_AT_encoding", 0)]
+        return tid
+
+    # Return the byte offset of a struct member
+    @staticmethod
+    def member_offset(die):
+        loc = dwarf_attr(die, "DW_AT_data_member_location")
+        if isinstance(loc, list):
+            return uleb128(loc[1:]) if loc and loc[0] == DW_OP_PLUS_UCONST else 0
+        return loc if loc is not None else dwarf_attr(die, "DW_AT_data_bit_offset", 0) // 8
+
+    # Return the number of elements in an array dimension, 0 if unknown
+    @staticmethod
+    def subrange_count(die):
+        count = dwarf_attr(die, "DW_AT_count")
+        upper = dwarf_attr(die, "DW_AT_upper_bound")
+        if isinstance(count, int):
+            return count
+        return upper + 1 if isinstance(upper, int) else 0
+
+# Return (types, vars) for the global & static variables in the DWARF
+# debug information, where vars is a dictionary {name: [addr, type_id]}
+# Only variables with a fixed address are included, and if a name is used
+# more than once, the first is kept
+def dwarf_vars(fname):
+    dtypes, dvars = DwarfTypes(), {}
+    with open(fname, "rb") as f:
+        elf = ELFFile(f)
+        if not elf.has_dwarf_info():
+            return None
+        for cu in elf.get_dwarf_info().iter_CUs():
+            for die in cu.get_top_DIE().iter_children():
+                if die.tag != "DW_TAG_variable":
+                    continue
+                loc = dwarf_attr(die, "DW_AT_location")
+                if not isinstance(loc, list) or len(loc) != 5 or loc[0] != DW_OP_ADDR:
+                    continue
+                if "DW_AT_specification" in die.attributes:
+                    die = die.get_DIE_from_attribute("DW_AT_specification")
+                name = dwarf_attr(die, "DW_AT_name", b"").decode("utf-8", "replace")
+                if name and name not in dvars:
+                    addr = sum([b << (8 * n) for n, b in enumerate(loc[1:])])
+                    dvars[name] = [addr, dtypes.type_id(dwarf_type(die))]
+    return dtypes.types, dvars
+
+# Return (types, vars) for the variables in the symbol table, if there is
+# no debug information; a variable of more than 4 bytes is treated as an
+# array of words, or bytes if the size isn't a multiple of 4
+def symbol_vars(syms):
+    types, ids, tvars = [], {}, {}
+    def type_id(size):
+        if size not in ids:
+            if size in (0, 1, 2, 4):
+                types.append(["b", size, 0])
+            else:
+                elem = type_id(4 if size % 4 == 0 else 1)
+                types.append(["a", size, elem, size // types[elem][1]])
+            ids[size] = len(types) - 1
+        return ids[size]
+    for s in syms:
+        if s.typ == STT_OBJECT and s.name not in tvars:
+            tvars[s.name] = [s.addr, type_id(s.size)]
+    return types, tvars
+
+# Class for an index of the symbols, and the addresses & types of the
+# variables in an ELF file; the variable types are from the DWARF debug
+# information if available (and pyelftools is installed), otherwise the
+# symbol sizes. The index is cached on disk, keyed by the hash of the file,
+# so it only has to be rebuilt when the file changes, or if pyelftools has
+# been installed or removed since it was built
+class ElfIndex(object):
+    def __init__(self, fname, cache_dir=ELF_CACHE_DIR):
+        self.fname = fname
+        self.hash = elf_hash(fname)
+        self.cache_fname = os.path.join(cache_dir, self.hash + ".json") if cache_dir else None
+        d = self.load()
+        if d is None:
+            d = self.build()
+            self.save(d)
+        self.sym_list, self.types, self.vars = d["syms"], d["types"], d["vars"]
+        self.dwarf = d["dwarf"]
+
+    # Load the index from the cache file, return None if not available,
+    # or it was built with a different availability of pyelftools
+    def load(self):
+        try:
+            with open(self.cache_fname) as f:
+                d = json.load(f)
+            return d if (d.get("version") == ELF_CACHE_VERSION and
+                         d.get("elftools") == (ELFFile is not None)) else None
+        except (IOError, OSError, TypeError, ValueError):
+            return None
+
+    # Build the index from the ELF file, return dictionary
+    def build(self):
+        syms = elf_symbols(self.fname)
+        tv = dwarf_vars(self.fname) if ELFFile else None
+        types, tvars = tv or symbol_vars(syms)
+        return {"version": ELF_CACHE_VERSION, "elftools": ELFFile is not None,
+                "dwarf": tv is not None,
+                "syms": [[s.name, s.addr, s.size, s.typ, s.fname] for s in syms],
+                "types": types, "vars": tvars}
+
+    # Save the index in the cache file
+    def save(self, d):
+        if self.cache_fname:
+            try:
+                if not os.path.isdir(os.path.dirname(self.cache_fname)):
+                    os.makedirs(os.path.dirname(self.cache_fname))
+                with open(self.cache_fname, "w") as f:
+                    json.dump(d, f, separators=(",", ":"))
+            except (IOError, OSError):
+                pass
+
+    # Return a table of the symbols of the given type (default functions)
+    def symbols(self, typ=STT_FUNC):
+        return SymbolTable([ElfSymbol(*s) for s in self.sym_list if s[3] == typ])
+
+    # Return (addr, type_id) for a variable name, with optional member and
+    # index selectors, e.g. 'state.pts[2].x'; raise ValueError if not found,
+    # or the path isn't a valid variable name with selectors
+    def resolve(self, path):
+        if not re.match(ELF_PATH_RE, path):
+            raise ValueError("invalid variable name '%s'" % path)
+        parts = re.findall(r"\.?([A-Za-z_]\w*)|\[\s*(\d+)\s*\]", path)
+        if parts[0][0] not in self.vars:
+            raise ValueError("unknown variable '%s'" % path)
+        addr, tid = self.vars[parts[0][0]]
+        for member, index in parts[1:]:
+            typ = self.types[tid]
+            if member and typ[0] == "s":
+                match = [m for m in typ[2] if m[0] == member]
+                if not match:
+                    raise ValueError("no member '%s' in '%s'" % (member, path))
+                addr, tid = addr + match[0][1], match[0][2]
+            elif index and typ[0] == "a" and int(index) < typ[3]:
+                addr, tid = addr + int(index) * self.types[typ[2]][1], typ[2]
+            else:
+                raise ValueError("invalid selector '%s' in '%s'" % (member or index, path))
+        return addr, tid
+
+    # Return list of (name, addr, size) for the base-type items in a
+    # variable, with structs & arrays expanded into their members & elements
+    # Raise ValueError if not found, or there are more than maxitems
+    def expand(self, path, maxitems=ELF_MAX_ITEMS):
+        addr, tid = self.resolve(path)
+        items = []
+        self.expand_type(path, addr, tid, items, maxitems)
+        return items
+
+    # Add the items in a variable of the given type to a list
+    def expand_type(self, path, addr, tid, items, maxitems):
+        typ = self.types[tid]
+        if typ[0] == "s":
+            for member, offset, mtid in typ[2]:
+                self.expand_type(path + "." + member if member else path,
+                                 addr + offset, mtid, items, maxitems)
+        elif typ[0] == "a":
+            esize = self.types[typ[2]][1]
+            for n in range(0, typ[3]):
+                self.expand_type("%s[%u]" % (path, n), addr + n * esize, typ[2], items, maxitems)
+        elif typ[1]:
+            if len(items) >= maxitems:
+                raise ValueError("more than %u items in '%s'" % (maxitems, path))
+            items.append((path, addr, typ[1]))
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: rp_elf.py FILE [ADDR|VARIABLE ...]")
+    elif len(sys.argv) > 2:
+        table, index = SymbolTable(elf_symbols(sys.argv[1])), None
+        for a in sys.argv[2:]:
+            if re.match("^(0x)?[0-9a-fA-F]+$", a) and not table.find(a):
+                print("%s: %s" % (a, table.symbol(int(a, 16))))
+            else:
+                index = index or ElfIndex(sys.argv[1])
+                for name, addr, size in index.expand(a):
+                    print("%08X %6u %s" % (addr, size, name))
+    else:
+        table = SymbolTable(elf_symbols(sys.argv[1]))
+        for s in table.syms:
+            print("%08X %6u %s %s" % (s.addr, s.size, "F" if s.typ == STT_FUNC
+                                      else "V", s.name))
+
+# EOF
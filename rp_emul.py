@@ -0,0 +1,520 @@
+# Emulated FTDI MPSSE device and SWD target for Iosoft Reporta project
+# Allows the SWD stack to be exercised and measured without hardware
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import time, random, struct
+from collections import deque
+
+timer = getattr(time, "perf_counter", time.time)
+
+EMU_TYPE        = 8             # Device type (index into driver device_types)
+EMU_DESC        = b"Reporta emulator"
+EMU_SERIAL      = b"EMU%05u"
+USB_FRAME       = 0.000125      # USB microframe time (sec)
+USB_PACKET      = 510           # Data bytes in a USB packet
+USB_RATE        = 20e6          # USB data rate (bytes/sec)
+EMU_LATENCY     = 0.0           # Default USB latency per transfer (sec)
+EMU_WAIT_PROB   = 0.0           # Default probability of AP WAIT response
+EMU_MAX_CLOCK   = 10e6          # Max SPI clock before read data is corrupted
+
+DP_IDCODE       = 0x1BA01477    # Cortex-M3 SW-DP ident
+AP_IDR          = 0x24770011    # AHB-AP ident
+AP_BASE         = 0xE00FF003    # Debug ROM table address
+
+# DP CTRL/STAT bits
+CTRL_ORUNDETECT = 1 << 0
+CTRL_STICKYORUN = 1 << 1
+CTRL_STICKYCMP  = 1 << 4
+CTRL_STICKYERR  = 1 << 5
+CTRL_READOK     = 1 << 6
+CTRL_WDATAERR   = 1 << 7
+CTRL_STICKY     = CTRL_STICKYORUN|CTRL_STICKYCMP|CTRL_STICKYERR|CTRL_WDATAERR
+CTRL_PWRUP_REQ  = 0x50000000
+CTRL_RW_MASK    = 0xFFFFFF0D
+
+ACK_OK, ACK_WAIT, ACK_FAULT = 1, 2, 4
+
+# SWD target line states
+ST_IDLE, ST_HDR, ST_TRN, ST_DRIVE, ST_WDATA = range(5)
+
+# Region of emulated memory, little-endian
+class EmuRegion(object):
+    def __init__(self, base, size, name=""):
+        self.base, self.size, self.name = base, size, name
+        self.data = bytearray(size)
+
+    # Read or write an aligned 32-bit word
+    def read32(self, addr):
+        return struct.unpack_from("<I", self.data, addr - self.base)[0]
+    def write32(self, addr, val):
+        struct.pack_into("<I", self.data, addr - self.base, val & 0xffffffff)
+
+# Emulated memory map, with optional handlers for live registers
+class EmuMemory(object):
+    def __init__(self):
+        self.regions = []
+        self.handlers = {}
+
+    # Add a region of RAM-like memory
+    def add_region(self, base, size, name=""):
+        r = EmuRegion(base, size, name)
+        self.regions.append(r)
+        return r
+
+    # Add a handler function for a single register; called with no args
+    # for a read, or the value for a write
+    def add_handler(self, addr, func):
+        self.handlers[addr & ~3] = func
+
+    # Find region containing address, None if unmapped
+    def region(self, addr):
+        for r in self.regions:
+            if r.base <= addr < r.base + r.size:
+                return r
+        return None
+
+    # Read 32-bit word, return None if unmapped
+    def read32(self, addr):
+        addr &= ~3
+        if addr in self.handlers:
+            return self.handlers[addr]() & 0xffffffff
+        r = self.region(addr)
+        return r.read32(addr) if r else None
+
+    # Write 32-bit word using byte-lane mask, return False if unmapped
+    def write32(self, addr, val, mask=0xffffffff):
+        addr &= ~3
+        if addr in self.handlers:
+            self.handlers[addr](val & mask)
+            return True
+        r = self.region(addr)
+        if not r:
+            return False
+        if mask != 0xffffffff:
+            val = (r.read32(addr) & ~mask) | (val & mask)
+        r.write32(addr, val)
+        return True
+
+# Memory map of an STM32F103 'blue pill', with some simulated activity:
+# a tick counter at the start of SRAM, a toggling port B, and DWT PC samples
+class EmuStm32(EmuMemory):
+    SRAM, SRAM_SIZE = 0x20000000, 20*1024
+    FLASH, FLASH_SIZE = 0x08000000, 64*1024
+    GPIO_BASE = 0x40010800
+    PCSR = 0xE000101C
+
+    def __init__(self, seed=1):
+        super(EmuStm32, self).__init__()
+        self.rand = random.Random(seed)
+        self.flash = self.add_region(self.FLASH, self.FLASH_SIZE, "flash")
+        self.sram = self.add_region(self.SRAM, self.SRAM_SIZE, "sram")
+        for n in range(0, 5):
+            self.add_region(self.GPIO_BASE + n*0x400, 0x400, "GPIO%c" % (65+n))
+        self.add_region(0xE000E000, 0x1000, "SCS")
+        self.add_region(0xE0001000, 0x1000, "DWT")
+        self.ticks = 0
+        self.add_handler(self.SRAM, self.tick_count)
+        self.add_handler(self.GPIO_BASE + 0x400 + 8, self.port_b)
+        self.add_handler(self.PCSR, self.pc_sample)
+        self.funcs = [(0x08000200, 0x40, 6), (0x08000400, 0x100, 3),
+                      (0x08000800, 0x20, 1)]
+
+    # Simulated free-running counter
+    def tick_count(self, val=None):
+        if val is not None:
+            self.ticks = val
+        return self.ticks
+
+    # Simulated port B input: slow counter on the upper bits
+    def port_b(self, val=None):
+        return (self.ticks >> 4) << 8 & 0xff00
+
+    # Simulated PC sample, weighted towards a few 'functions'
+    def pc_sample(self, val=None):
+        total = sum(f[2] for f in self.funcs)
+        n = self.rand.randrange(total)
+        for base, size, weight in self.funcs:
+            if n < weight:
+                return base + 2*self.rand.randrange(size // 2)
+            n -= weight
+        return 0
+
+    # Advance simulated time by one AHB access
+    def step(self):
+        self.ticks += 1
+        if self.ticks & 0x3f == 0:
+            n = self.rand.randrange(64)
+            self.sram.write32(self.SRAM + 0x100 + n*4, self.ticks)
+            self.sram.write32(self.SRAM + self.SRAM_SIZE - 4 - n*4, self.ticks)
+
+# Emulated SWD target: SW-DP and AHB-AP
+class SwdTarget(object):
+    def __init__(self, mem=None, wait_prob=0.0, seed=1):
+        self.mem = mem if mem is not None else EmuStm32(seed)
+        self.wait_prob = wait_prob
+        self.rand = random.Random(seed)
+        self.transactions = 0
+        self.line_reset()
+
+    # Reset SWD line state and DP registers
+    def line_reset(self):
+        self.state, self.ones = ST_IDLE, 0
+        self.steps = []
+        self.ctrl = self.select = self.rdbuff = 0
+        self.csw, self.tar = 0x03000040, 0
+        self.hdr = self.nbits = 0
+
+    # Clock a number of bits (l.s.bit first), return the line state
+    def clock(self, tdi, nbits):
+        tdo = 0
+        for n in range(0, nbits):
+            tdo |= self.clock_bit((tdi >> n) & 1) << n
+        return tdo
+
+    # Clock single bit, return line state
+    def clock_bit(self, b):
+        if b:
+            self.ones += 1
+            if self.ones >= 50:
+                self.line_reset()
+                self.ones = 50
+                return b
+        else:
+            self.ones = 0
+        st = self.state
+        if st == ST_IDLE:
+            if b:
+                self.state, self.hdr, self.nbits = ST_HDR, 1, 1
+            return b
+        if st == ST_HDR:
+            self.hdr |= b << self.nbits
+            self.nbits += 1
+            if self.nbits == 8:
+                self.request(self.hdr)
+                self.next_step()
+            return b
+        self.nbits += 1
+        if st == ST_DRIVE:
+            b = (self.drive >> (self.nbits-1)) & 1
+        elif st == ST_WDATA:
+            self.wdata |= b << (self.nbits-1)
+        if self.nbits >= self.steplen:
+            if st == ST_WDATA:
+                self.write_data(self.wdata)
+            self.next_step()
+        return b
+
+    # Move to next step of the transaction
+    def next_step(self):
+        self.nbits = 0
+        if self.steps:
+            self.state, self.steplen, self.drive = self.steps.pop(0)
+            self.wdata = 0
+        else:
+            self.state = ST_IDLE
+
+    # Decode request header, and set up the following steps
+    def request(self, hdr):
+        ap, rd, a = (hdr>>1)&1, (hdr>>2)&1, (hdr>>3)&3
+        par = (hdr>>5) & 1
+        if par != ap^rd^(a&1)^(a>>1) or hdr&0x40 or not hdr&0x80:
+            self.steps = []
+            return
+        self.transactions += 1
+        self.req = ap, rd, a << 2
+        ack = self.get_ack(ap, rd, a << 2)
+        orun = self.ctrl & CTRL_ORUNDETECT
+        steps = [(ST_TRN, 1, 0)]
+        if rd:
+            if ack == ACK_OK:
+                val = self.read_reg(ap, a << 2)
+                drive = ack | (val << 3) | (parity32(val) << 35)
+                steps.append((ST_DRIVE, 36, drive))
+            else:
+                steps.append((ST_DRIVE, 36 if orun else 3, ack))
+            steps.append((ST_TRN, 1, 0))
+        else:
+            steps += [(ST_DRIVE, 3, ack), (ST_TRN, 1, 0)]
+            if ack == ACK_OK or orun:
+                steps.append((ST_WDATA, 33, 0))
+            self.wr_ok = ack == ACK_OK
+        self.steps = steps
+
+    # Determine acknowledgement for a request
+    def get_ack(self, ap, rd, addr):
+        sticky = self.ctrl & CTRL_STICKY
+        if not ap:
+            if sticky and not (rd and addr in (0, 4)) and not (not rd and addr == 0):
+                return ACK_FAULT
+            return ACK_OK
+        if sticky:
+            return ACK_FAULT
+        if self.wait_prob and self.rand.random() < self.wait_prob:
+            if self.ctrl & CTRL_ORUNDETECT:
+                self.ctrl |= CTRL_STICKYORUN
+            return ACK_WAIT
+        return ACK_OK
+
+    # Read DP or AP register
+    def read_reg(self, ap, addr):
+        if not ap:
+            return (DP_IDCODE if addr == 0 else self.ctrl if addr == 4 else
+                    self.rdbuff)
+        val, self.rdbuff = self.rdbuff, self.ap_read(addr | (self.select & 0xf0))
+        return val
+
+    # Handle data phase of write request
+    def write_data(self, wdata):
+        if not self.wr_ok:
+            return
+        val = wdata & 0xffffffff
+        if (wdata >> 32) & 1 != parity32(val):
+            self.ctrl |= CTRL_WDATAERR
+            return
+        ap, rd, addr = self.req
+        if ap:
+            self.ap_write(addr | (self.select & 0xf0), val)
+        elif addr == 0:
+            clr = ((CTRL_STICKYCMP if val & 2 else 0) |
+                   (CTRL_STICKYERR if val & 4 else 0) |
+                   (CTRL_WDATAERR if val & 8 else 0) |
+                   (CTRL_STICKYORUN if val & 16 else 0))
+            self.ctrl &= ~clr
+        elif addr == 4:
+            self.ctrl = (self.ctrl & ~CTRL_RW_MASK) | (val & CTRL_RW_MASK)
+            self.ctrl = (self.ctrl & ~0xA0000000) | ((val & CTRL_PWRUP_REQ) << 1)
+        elif addr == 8:
+            self.select = val
+
+    # Size of AP memory access in bytes
+    def access_size(self):
+        return 1 << min(self.csw & 7, 2)
+
+    # Advance TAR after DRW access; auto-increment wraps at 1K boundary
+    def tar_inc(self):
+        if (self.csw >> 4) & 3 == 1:
+            n = self.access_size()
+            self.tar = (self.tar & ~0x3ff) | ((self.tar + n) & 0x3ff)
+
+    # Read AP register
+    def ap_read(self, reg):
+        self.mem.step()
+        if reg == 0x00:
+            return self.csw
+        if reg == 0x04:
+            return self.tar
+        if reg == 0x0c or 0x10 <= reg <= 0x1c:
+            addr = self.tar if reg == 0x0c else (self.tar & ~0xf) | (reg & 0xc)
+            val = self.mem.read32(addr)
+            if val is None:
+                self.ctrl |= CTRL_STICKYERR
+                val = 0
+            if reg == 0x0c:
+                self.tar_inc()
+            return val
+        return AP_BASE if reg == 0xf8 else AP_IDR if reg == 0xfc else 0
+
+    # Write AP register
+    def ap_write(self, reg, val):
+        self.mem.step()
+        if reg == 0x00:
+            self.csw = (self.csw & 0x40) | (val & ~0x40)
+        elif reg == 0x04:
+            self.tar = val
+        elif reg == 0x0c or 0x10 <= reg <= 0x1c:
+            addr = self.tar if reg == 0x0c else (self.tar & ~0xf) | (reg & 0xc)
+            n = self.access_size()
+            mask = ((1 << (n*8)) - 1) << ((addr & 3) * 8)
+            if not self.mem.write32(addr, val, mask):
+                self.ctrl |= CTRL_STICKYERR
+            if reg == 0x0c:
+                self.tar_inc()
+
+# Emulated FTDI device in MPSSE mode, with an ftd2xx-compatible interface
+# If latency is non-zero, response data only reaches the host after that
+# delay, plus the latency timer if the response is short and there is no
+# 'send immediate'; a read blocks until the data it needs has arrived
+class EmuDevice(object):
+    def __init__(self, idx=0, target=None, latency=0.0):
+        self.idx = idx
+        self.target = target if target is not None else SwdTarget()
+        self.latency = latency
+        self.latency_timer = 16
+        self.mode = 0
+        self.pending = bytearray()
+        self.rxbuff = bytearray()
+        self.rxstart = 0
+        self.ready = deque()
+        self.immediate = False
+        self.port = [0, 0]
+        self.base_clock, self.clock_hz = 12e6, 6e6
+        self.emu_time = 0.0
+        self.usb_time = 0.0
+        self.nwrites = self.nreads = 0
+        self.txbytes = self.rxbytes = 0
+
+    # ftd2xx device methods, mostly with no effect on the emulation
+    def resetDevice(self):
+        self.pending = bytearray()
+        self.purge()
+    def purge(self, mask=0):
+        self.rxbuff, self.rxstart = bytearray(), 0
+        self.ready.clear()
+    def close(self):
+        pass
+    def getDeviceInfo(self):
+        return {'type': EMU_TYPE, 'id': 0x04036014,
+                'description': EMU_DESC, 'serial': EMU_SERIAL % self.idx}
+    def setUSBParameters(self, insize, outsize=0):
+        pass
+    def setChars(self, evch, even, erch, eren):
+        pass
+    def setTimeouts(self, rd, wr):
+        pass
+    def setLatencyTimer(self, ms):
+        self.latency_timer = ms
+    def getLatencyTimer(self):
+        return self.latency_timer
+    def setBitMode(self, mask, mode):
+        self.mode = mode
+    def getQueueStatus(self):
+        return len(self.rxbuff)
+
+    # Accept USB data, and decode MPSSE commands
+    # Any response is tagged with the time it would reach the host
+    def write(self, data):
+        t = timer()
+        rxlen = len(self.rxbuff)
+        self.pending += bytearray(data)
+        self.txbytes += len(data)
+        if self.mode == 2:
+            self.decode()
+        self.nwrites += 1
+        self.emu_time += timer() - t
+        self.usb_delay(len(data) / USB_RATE)
+        n = len(self.rxbuff) - rxlen
+        if n and self.latency:
+            wait = (0 if self.immediate or n >= USB_PACKET else
+                    self.latency_timer / 1000.0)
+            end = self.rxstart + len(self.rxbuff)
+            self.ready.append((end - n, end,
+                timer() + self.latency + USB_FRAME + wait + n / USB_RATE))
+        self.immediate = False
+        return len(data)
+
+    # Return USB data, waiting until it would have arrived
+    def read(self, nbytes, raw=True):
+        n = min(nbytes, len(self.rxbuff))
+        end = self.rxstart + n
+        while self.ready and self.ready[0][0] < end:
+            start, chunk_end, ready = self.ready[0]
+            self.usb_delay(ready - timer())
+            if chunk_end > end:
+                break
+            self.ready.popleft()
+        self.nreads += 1
+        data = bytes(self.rxbuff[:n])
+        del self.rxbuff[:n]
+        self.rxstart += n
+        self.rxbytes += n
+        return data
+
+    # Simulate USB transfer time, if latency modelling is enabled
+    def usb_delay(self, secs):
+        if self.latency and secs > 0:
+            self.usb_time += secs
+            time.sleep(secs)
+
+    # Decode MPSSE commands in the pending buffer
+    def decode(self):
+        buff, i = self.pending, 0
+        while i < len(buff):
+            cmd = buff[i]
+            n = self.command(cmd, buff, i)
+            if n is None:
+                break
+            i += n
+        del buff[:i]
+
+    # Execute a single MPSSE command, return its length, None if incomplete
+    def command(self, cmd, buff, i):
+        avail = len(buff) - i
+        if not cmd & 0x80:
+            return self.data_command(cmd, buff, i)
+        nargs = {0x80:2, 0x82:2, 0x86:2, 0x8e:1, 0x8f:2}.get(cmd, 0)
+        if avail < nargs + 1:
+            return None
+        if cmd in (0x80, 0x82):
+            self.port[cmd == 0x82] = buff[i+1]
+        elif cmd in (0x8a, 0x8b):
+            self.base_clock = 60e6 if cmd == 0x8a else 12e6
+        elif cmd == 0x86:
+            self.clock_hz = self.base_clock / (2 * (buff[i+1] + (buff[i+2] << 8) + 1))
+        elif cmd in (0x81, 0x83):
+            self.rxbuff.append(self.port[cmd == 0x83])
+        elif cmd == 0x87:
+            self.immediate = True
+        elif cmd not in (0x84, 0x85, 0x86, 0x8a, 0x8b, 0x8c, 0x8d,
+                         0x8e, 0x8f, 0x96, 0x97):
+            self.rxbuff += bytearray((0xFA, cmd))
+        return nargs + 1
+
+    # Execute a data shift command, return length or None if incomplete
+    # If the clock is too fast, a bit of each byte read is corrupted
+    def data_command(self, cmd, buff, i):
+        avail = len(buff) - i
+        noise = 1 if self.clock_hz > EMU_MAX_CLOCK else 0
+        wr, rd, lsb, bits = cmd & 0x10, cmd & 0x20, cmd & 0x08, cmd & 0x02
+        if cmd & 0x40:                      # TMS command: ignore
+            return 3 if avail >= 3 else None
+        if bits:
+            if avail < 2 + (1 if wr else 0):
+                return None
+            nbits = buff[i+1] + 1
+            out = buff[i+2] if wr else 0
+            if not lsb:
+                out = bitrev8(out)
+            tdo = self.target.clock(out, nbits) ^ noise
+            if rd:
+                val = (tdo << (8 - nbits)) & 0xff
+                self.rxbuff.append(val if lsb else bitrev8(tdo) & 0xff)
+            return 3 if wr else 2
+        if avail < 3:
+            return None
+        nbytes = buff[i+1] + (buff[i+2] << 8) + 1
+        if wr and avail < 3 + nbytes:
+            return None
+        clock = self.target.clock
+        for n in range(0, nbytes):
+            out = buff[i+3+n] if wr else 0
+            tdo = clock(out if lsb else bitrev8(out), 8) ^ noise
+            if rd:
+                self.rxbuff.append(tdo if lsb else bitrev8(tdo))
+        return 3 + (nbytes if wr else 0)
+
+# Reverse bits in a byte
+def bitrev8(b):
+    return int("{:08b}".format(b & 0xff)[::-1], 2)
+
+# Calculate parity of 32-bit integer
+def parity32(i):
+    return bin(i & 0xffffffff).count("1") & 1
+
+# Open an emulated device (same signature as ftd2xx.open)
+def open(idx=0):
+    return EmuDevice(idx, SwdTarget(wait_prob=EMU_WAIT_PROB, seed=idx+1),
+                     EMU_LATENCY)
+
+# EOF
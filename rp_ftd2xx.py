@@ -1,5 +1,6 @@
 # FTD2XX library interface for Iosoft Reporta project
 # Works with Python 2.7+ and 3; the latter also needs pypiwin32 installed
+# If EMULATE is set, an emulated device and target are used instead
 #
 # Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
 #
@@ -14,15 +15,34 @@
 # limitations under the License.
 
 from __future__ import print_function
-import sys, time, codecs, ftd2xx as ftd
+import sys, time, codecs, threading, rp_stats
+from ctypes import c_char
+from collections import deque
+try:
+    import Queue
+except:
+    import queue as Queue
+try:
+    import ftd2xx as ftd
+except ImportError:
+    ftd = None
 
 VERBOSE             = False # Flag to enable verbose display
+EMULATE             = False # Flag to use emulated device, not hardware
 BUFFERED            = True  # Flag to enable transmit buffering
 FTDI_BUFFLEN        = 1024  # Buffer size
 FTDI_TIMEOUT        = 1000  # Timeout for read/write operations (msec)
 FTDI_LATENCY        = 2     # Latency for transferring data
+IO_RING_SIZE        = 8     # Max received blocks awaiting decode
+
+timer = rp_stats.timer
+USB_WRITE           = rp_stats.stage("usb_write")   # Items are bytes
+USB_READ            = rp_stats.stage("usb_read")
 
 SPI_CLOCK_KHZ       = 1000  # Requested SPI clock frequency (kHz)
+FTDI_BASE_CLOCK     = 12000000 # MPSSE base clock, with divide-by-5
+FTDI_HS_CLOCK       = 60000000 # Base clock of H-series without divide-by-5
+FTDI_HS_TYPES       = ("FT2232H", "FT4232H", "FT232H")
 FTDI_SPI_OUT_BITS   = 0x03  # Bit mask for SPI outputs
 
 FTDI_MODE_BITBANG   = 1     # MPSSE modes
@@ -36,33 +56,53 @@ FTDI_SPI_WR_TDI     = 0x10
 FTDI_SPI_RD_TDO     = 0x20
 FTDI_SPI_WR_TMS     = 0x40
 
-txbuff = []                 # Transmit buffer
-
 # Device type strings
 device_types = ("FT232BM", "FT232AM", "FT100AX", "?", "FT2232C",
                 "FT232R", "FT2232H", "FT4232H", "FT232H")
 
-# Convert list of integers to a data string for USB transmission
-# If Python 3, strings are unicode, so convert to 8-bit ASCII
-def to_txdata(lst):
-    s = "".join([chr(a) for a in lst])
-    return s if sys.version_info<(3,) else codecs.latin_1_encode(s)[0]
+# Convert data to a ctypes array for USB transmission, without copying
+# Data can be a bytearray (with optional length) or a sequence of integers
+def to_txdata(data, n=None):
+    if not isinstance(data, bytearray):
+        data = bytearray(data)
+    return (c_char * (len(data) if n is None else n)).from_buffer(data)
 
-# Convert incoming USB data to a list of integers
-# Data could be a string or byte array
+# Convert incoming USB data to a byte array, which gives integer values
+# when indexed; Python 3 bytes are used as-is, Python 2 strings are copied
 def from_rxdata(data):
-    return [ord(b) for b in data] if type(data) is str else list(data)
+    return data if type(data) is bytes and sys.version_info>=(3,) else bytearray(data)
 
 # Convert incoming string to displayable format (unicode for Python 3)
 def from_rxstring(s):
     return codecs.latin_1_decode(s)[0]
 
-# Open an FTDI device
-def open(idx=0):
+# Class for an open device, with its own transmit buffer
+# Other attributes are those of the underlying device handle
+class Device(object):
+    def __init__(self, handle):
+        self.handle = handle
+        self.txbuff = bytearray(FTDI_BUFFLEN) # Transmit buffer, grows if necessary
+        self.txlen = 0                        # Number of bytes in transmit buffer
+        self.clock_hz = None                  # SPI clock frequency
+        self.latency = FTDI_LATENCY           # USB latency timer (msec)
+        self.bufflen = FTDI_BUFFLEN           # USB transfer size
+
+    def __getattr__(self, name):
+        return getattr(self.handle, name)
+
+# Open an FTDI device (or emulated device), return an instance of the
+# given Device class, or None if failed
+# The emulator is only imported if it is used
+def open(idx=0, cls=Device):
     try:
-        d = ftd.open(idx)
-        d.resetDevice()
-        d.purge()
+        if EMULATE:
+            import rp_emul
+            h = rp_emul.open(idx)
+        else:
+            h = ftd.open(idx)
+        h.resetDevice()
+        h.purge()
+        d = cls(h)
     except:
         d = None
     return(d)
@@ -77,23 +117,54 @@ def device_type_desc(d):
     typ = device_types[info['type']] if info['type']<len(device_types) else "?"
     return typ, from_rxstring(info['description'])
 
-# Initialise FTDI device in MPSSE SPI mode
-def spi_init(d, hz=1000000):
-    div = int((12000000 / (hz * 2)) - 1)
-    d.setUSBParameters(FTDI_BUFFLEN, FTDI_BUFFLEN)
+# Return device serial number string
+def device_serial(d):
+    return from_rxstring(d.getDeviceInfo()['serial'])
+
+# Return True if device is H-series, with a 60 MHz clock option
+def is_hispeed(d):
+    return device_type_desc(d)[0] in FTDI_HS_TYPES
+
+# Return the MPSSE base clock & divisor for the nearest SPI clock frequency
+# that isn't above the requested value, using the 60 MHz clock if possible
+def spi_clock_div(hz, hispeed=False):
+    base = FTDI_HS_CLOCK if hispeed else FTDI_BASE_CLOCK
+    div = min(max(-(-base // (2 * int(hz))) - 1, 0), 0xffff)
+    return base, div
+
+# Set the SPI clock frequency, return the actual value
+def spi_set_clock(d, hz):
+    hispeed = is_hispeed(d)
+    base, div = spi_clock_div(hz, hispeed)
+    if hispeed:
+        write_data(d, (0x8A if base == FTDI_HS_CLOCK else 0x8B,))
+    write_cmd_word(d, 0x86, div)
+    write_flush(d)
+    d.clock_hz = base // (2 * (div + 1))
+    return d.clock_hz
+
+# Set the USB latency timer (msec) and transfer size (bytes)
+def usb_set_params(d, latency, bufflen):
+    d.setUSBParameters(bufflen, bufflen)
+    d.setLatencyTimer(latency)
+    d.latency, d.bufflen = latency, bufflen
+
+# Initialise FTDI device in MPSSE SPI mode, with optional clock frequency,
+# USB latency timer and transfer size (default values if not given)
+def spi_init(d, hz=None, latency=None, bufflen=None):
+    usb_set_params(d, latency or FTDI_LATENCY, bufflen or FTDI_BUFFLEN)
     d.setChars(0, 0, 0, 0)
     d.setTimeouts(FTDI_TIMEOUT, FTDI_TIMEOUT)
-    d.setLatencyTimer(FTDI_LATENCY)
     d.setBitMode(0, 0)
     d.setBitMode(0, FTDI_MODE_MPSSE)
-    write_cmd_word(d, 0x86, div)
+    spi_set_clock(d, hz or SPI_CLOCK_KHZ * 1000)
     set_port(d, False, FTDI_SPI_OUT_BITS, 0x00)
     write_flush(d)
 
 # Write SPI command and data bytes to the device
 def spi_write_bytes(d, cmd, data):
     n = len(data) - 1
-    write_data(d, [cmd, n&0xff, n>>8] + list(data))
+    write_data(d, bytearray((cmd, n&0xff, n>>8)) + bytearray(data))
 
 # Read data bytes back from SPI
 def spi_read_bytes(d, nbytes):
@@ -114,7 +185,7 @@ def check_sync(d):
     write_data(d, (0xAA,))
     write_flush(d)
     data = read_data(d)
-    return data == [0xFA, 0xAA]
+    return list(data) == [0xFA, 0xAA]
 
 # Send command to return port status
 def get_port(d, hi):
@@ -135,29 +206,99 @@ def set_io_pins(d, hi, dirn, val):
 def write_cmd_word(d, cmd, w):
     write_data(d, (cmd, w&0xff, w>>8))
 
-# Write data (a list of integers) to device
+# Write data (bytes, bytearray or list of integers) to device
+# If buffering, copy into transmit buffer, extending it if necessary
 def write_data(d, data):
-    global txbuff
     if VERBOSE:
         print("Tx: %s" % data_str(data))
     if BUFFERED:
-        txbuff += data
+        n = d.txlen + len(data)
+        if n > len(d.txbuff):
+            d.txbuff.extend(bytearray(max(n, len(d.txbuff)*2) - len(d.txbuff)))
+        d.txbuff[d.txlen:n] = data
+        d.txlen = n
     else:
+        t = timer()
         d.write(to_txdata(data))
+        USB_WRITE.add(timer() - t, len(data))
 
 # Flush the transmit buffer, if buffering is enabled
 def write_flush(d):
-    global txbuff
-    d.write(to_txdata(txbuff))
-    txbuff = []
+    if d.txlen:
+        t = timer()
+        d.write(to_txdata(d.txbuff, d.txlen))
+        USB_WRITE.add(timer() - t, d.txlen)
+    d.txlen = 0
 
-# Read data from device, return list of integers
+# Return a copy of the transmit buffer contents, and empty the buffer
+def take_txdata(d):
+    data = d.txbuff[:d.txlen]
+    d.txlen = 0
+    return data
+
+# Read data from device, return bytes or bytearray
 def read_data(d, nbytes=FTDI_BUFFLEN):
+    t = timer()
     data = d.read(nbytes)
+    USB_READ.add(timer() - t, len(data))
     if VERBOSE:
         print("Rx: %s" % data_str(data))
     return from_rxdata(data)
 
+# Background USB I/O thread, which owns the device handle while running
+# Transmit blocks are taken from a queue and sent as soon as possible;
+# the responses are then read in order, and passed to the decoder through
+# a bounded queue, which holds back the reads if the decoder falls behind
+class IoWorker(threading.Thread):
+    def __init__(self, d, ringsize=IO_RING_SIZE):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.d = d
+        self.txq = Queue.Queue()
+        self.rxq = Queue.Queue(ringsize)
+
+    # Queue a block for transmission, with the number of bytes expected
+    # in response, and a tag to identify the response
+    def submit(self, data, rxlen, tag=None):
+        self.txq.put((data, rxlen, tag))
+
+    # Get the next response as (tag, data), waiting if necessary
+    # Raises Queue.Empty if a timeout is given and there is no response
+    def get(self, timeout=None):
+        return self.rxq.get(True, timeout)
+
+    # Thread to send all queued blocks, then read the oldest response
+    def run(self):
+        inflight = deque()
+        while True:
+            try:
+                item = self.txq.get(not inflight)
+            except Queue.Empty:
+                item = False
+            if item is None:
+                break
+            elif item:
+                data, rxlen, tag = item
+                if VERBOSE:
+                    print("Tx: %s" % data_str(data))
+                t = timer()
+                self.d.write(to_txdata(data))
+                USB_WRITE.add(timer() - t, len(data))
+                inflight.append((rxlen, tag))
+            else:
+                rxlen, tag = inflight.popleft()
+                self.rxq.put((tag, read_data(self.d, rxlen) if rxlen else b""))
+
+    # Stop the thread, discarding any unread responses
+    def stop(self):
+        self.txq.put(None)
+        while self.is_alive():
+            try:
+                self.rxq.get(True, 0.1)
+            except Queue.Empty:
+                pass
+        self.join()
+
 # Convert data to a displayable string of hex bytes
 # Data can be a string of bytes or array of ints
 def data_str(data):
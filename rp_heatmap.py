@@ -0,0 +1,229 @@
+# RAM activity heatmap for Iosoft Reporta project
+# Reads a CPU memory region in chunks at regular intervals, counts the
+# changes to each word, and displays the activity as an image
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import sys, time, threading, argparse
+import numpy as np
+import rp_arm as arm, rp_ftd2xx as driver, rp_pyqt as pyqt
+try:
+    from PyQt5.QtGui import QPainter, QImage, QColor, QPen
+    from PyQt5.QtCore import QRectF
+except:
+    from PyQt4.QtGui import QPainter, QImage, QColor, QPen
+    from PyQt4.QtCore import QRectF
+QtCore, QtWidgets, Qt = pyqt.QtCore, pyqt.QtWidgets, pyqt.Qt
+
+HEAT_ADDR       = 0x20000000    # Default region: STM32F1 SRAM
+HEAT_SIZE       = 20*1024       # Size of region (bytes)
+HEAT_WIDTH      = 64            # Words in each row of the image
+HEAT_RATE       = 5.0           # Region reads per second
+HEAT_CHUNK      = 2*arm.MEM_GROUP_WORDS # Words read in each chunk
+HEAT_DECAY      = 0.8           # Activity decay factor for each read
+HEAT_BACK       = 0xFF202020    # Colour of words that have never changed
+HEAT_LABEL_PEN  = QPen(QColor(200, 200, 200), 0)
+
+# Return a table of 256 RGB32 colours for activity levels: background
+# for level 0, then dark blue through red to yellow
+def heat_palette():
+    x = np.linspace(0, 1, 255)
+    r = np.clip(x * 2, 0, 1)
+    g = np.clip(x * 2 - 1, 0, 1)
+    b = np.clip(0.5 - np.abs(x - 0.25) * 2, 0, 1) + 0.25 * (x < 0.25)
+    rgb = [(c * 255).astype(np.uint32) for c in (r, g, b)]
+    colours = 0xFF000000 | (rgb[0] << 16) | (rgb[1] << 8) | rgb[2]
+    return np.concatenate(([HEAT_BACK], colours)).astype(np.uint32)
+
+# Class for the activity of a memory region: the number of changes to each
+# word, and a level of recent activity that decays after each read
+# The region is read a chunk at a time, so a read doesn't hold up polling
+# for long, and a failed chunk only loses the changes in that chunk
+# The image is an RGB32 buffer with one pixel per word, that is wrapped by
+# a QImage, so can be displayed without copying; the QImage doesn't keep
+# the buffer alive, so the array must stay referenced by this object
+class RamHeat(object):
+    def __init__(self, addr=HEAT_ADDR, size=HEAT_SIZE, width=HEAT_WIDTH,
+                 decay=HEAT_DECAY, chunk=HEAT_CHUNK):
+        self.addr, self.nwords, self.width = addr, size // 4, width
+        self.rows = (self.nwords + width - 1) // width
+        self.decay = decay
+        self.full = 1.0 / (1.0 - decay)     # Level if changing on every read
+        self.chunk, self.pos = min(chunk, self.nwords), 0
+        self.nchunks = (self.nwords + self.chunk - 1) // self.chunk
+        self.prev = np.zeros(self.nwords, np.uint32)
+        self.seen = np.zeros(self.nwords, bool)
+        self.counts = np.zeros(self.nwords, np.uint32)
+        self.heat = np.zeros(self.nwords, np.float32)
+        self.scaled = np.zeros(self.nwords, np.float32)
+        self.levels = np.zeros(self.rows * width, np.uint8)
+        self.pixels = np.zeros((self.rows, width), np.uint32)
+        self.palette = heat_palette()
+        self.image = QImage(self.pixels, width, self.rows, width * 4,
+                            QImage.Format_RGB32)
+        self.scans = self.reads = self.failed = 0
+        self.due = 0.0
+        self.lock = threading.Lock()
+
+    # Add the data from a read of part of the region, starting at the given
+    # word offset, return number of words changed. Words that haven't been
+    # read before are only stored
+    def update(self, data, start=0):
+        if data is None:
+            self.failed += 1
+            return 0
+        data = np.frombuffer(data, np.uint32) if not isinstance(data, np.ndarray) else data
+        end = start + len(data)
+        with self.lock:
+            self.reads += 1
+            changed = (data != self.prev[start:end]) & self.seen[start:end]
+            self.counts[start:end] += changed
+            self.heat[start:end] *= self.decay
+            self.heat[start:end] += changed
+            self.prev[start:end] = data
+            self.seen[start:end] = True
+        return int(changed.sum())
+
+    # Read the next chunk of the region, if it is due to be read, given the
+    # rate at which the whole region is read. Return True if it was read
+    def scan(self, h, rate=HEAT_RATE):
+        now = time.time()
+        if now < self.due:
+            return False
+        self.due = max(self.due + 1.0 / (rate * self.nchunks), now)
+        n = min(self.chunk, self.nwords - self.pos)
+        self.update(arm.cpu_mem_read_block(h, self.addr + self.pos*4, n), self.pos)
+        self.pos += n
+        if self.pos >= self.nwords:
+            self.pos = 0
+            self.scans += 1
+        return True
+
+    # Clear the change counts & activity
+    def reset(self):
+        with self.lock:
+            self.counts[:] = 0
+            self.heat[:] = 0
+
+    # Update the image pixels from the activity levels, return the image
+    # Words that have changed, but not recently, get the lowest level
+    def render(self):
+        levels = self.levels[:self.nwords]
+        with self.lock:
+            np.multiply(self.heat, 254.0 / self.full, out=self.scaled)
+            np.minimum(self.scaled, 254, out=levels, casting="unsafe")
+            levels += self.counts > 0
+        np.take(self.palette, self.levels, out=self.pixels.reshape(-1))
+        return self.image
+
+    # Return the address of the word at an image position, None if outside
+    def word_addr(self, col, row):
+        n = row * self.width + col
+        return self.addr + n*4 if 0 <= col < self.width and 0 <= n < self.nwords else None
+
+# Heatmap display widget, with the image scaled to fit, and the address
+# and change count of the word under the mouse pointer as a tooltip
+class HeatView(QtWidgets.QWidget):
+    def __init__(self, heat, parent=None, rate=pyqt.DISPLAY_RATE):
+        super(HeatView, self).__init__(parent)
+        self.heat = heat
+        self.reads = 0
+        self.setMinimumHeight(heat.rows)
+        self.setMouseTracking(True)
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(int(1000 / rate))
+
+    # Timer handler to redraw if part of the region has been read
+    def refresh(self):
+        if self.heat.reads != self.reads:
+            self.update()
+
+    # Draw the image, and a description of the region
+    def paintEvent(self, event):
+        self.reads = self.heat.reads
+        p = QPainter(self)
+        p.drawImage(QRectF(self.rect()), self.heat.render())
+        p.setPen(HEAT_LABEL_PEN)
+        p.drawText(QRectF(self.rect()).adjusted(2, 0, -2, 0), Qt.AlignTop | Qt.AlignRight,
+                   "%08X-%08X %u reads" % (self.heat.addr, self.heat.addr +
+                   self.heat.nwords*4 - 1, self.heat.scans))
+        p.end()
+
+    # Show the address & count for the word under the pointer
+    def mouseMoveEvent(self, event):
+        col = int(event.pos().x() * self.heat.width / max(self.width(), 1))
+        row = int(event.pos().y() * self.heat.rows / max(self.height(), 1))
+        addr = self.heat.word_addr(col, row)
+        if addr is not None:
+            n = (addr - self.heat.addr) // 4
+            self.setToolTip("%08X: %u changes" % (addr, self.heat.counts[n]))
+
+    # Clear the counts
+    def mouseDoubleClickEvent(self, event):
+        self.heat.reset()
+        self.update()
+
+# Thread to read the region at regular intervals, for standalone use
+class HeatTask(QtCore.QThread):
+    def __init__(self, h, heat, rate=HEAT_RATE, parent=None):
+        super(HeatTask, self).__init__(parent)
+        self.h, self.heat, self.rate = h, heat, rate
+        self.running = True
+
+    def run(self):
+        while self.running:
+            if not self.heat.scan(self.h, self.rate):
+                time.sleep(max(self.heat.due - time.time(), 0))
+
+    # Stop the running thread
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.wait()
+
+if __name__ == "__main__":
+    import rp_multi
+    parser = argparse.ArgumentParser(description="Reporta RAM activity heatmap")
+    parser.add_argument("-a", "--addr", type=lambda s: int(s, 16), default=HEAT_ADDR,
+                        help="start address (hex)")
+    parser.add_argument("-s", "--size", type=lambda s: int(s, 0), default=HEAT_SIZE,
+                        help="size (bytes)")
+    parser.add_argument("-w", "--width", type=int, default=HEAT_WIDTH,
+                        help="words per row")
+    parser.add_argument("-r", "--rate", type=float, default=HEAT_RATE,
+                        help="reads per second")
+    parser.add_argument("-i", "--index", type=int, default=0,
+                        help="probe index")
+    parser.add_argument("-e", "--emulate", action="store_true",
+                        help="use emulated probe")
+    args = parser.parse_args()
+    driver.EMULATE = driver.EMULATE or args.emulate
+    dev = rp_multi.probe_start(args.index)
+    if not dev:
+        print("Can't start SWD interface")
+    else:
+        app = QtWidgets.QApplication(sys.argv)
+        heat = RamHeat(args.addr, args.size, args.width)
+        view = HeatView(heat)
+        view.resize(args.width * 8, heat.rows * 8)
+        task = HeatTask(dev, heat, args.rate)
+        view.show()
+        task.start()
+        app.exec_()
+        task.stop()
+        driver.close(dev)
+        print("%u reads, %u chunks failed" % (heat.scans, heat.failed))
+
+# EOF
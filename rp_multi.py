@@ -0,0 +1,170 @@
+# Multi-probe polling for Iosoft Reporta project
+# Each probe is polled in its own process, and the samples are merged
+# into a single timestamped stream
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import time, heapq, argparse, multiprocessing
+import rp_arm as arm, rp_swd as swd, rp_ftd2xx as driver
+try:
+    import Queue
+except:
+    import queue as Queue
+
+MULTI_IDLE      = 0.1       # Max time between probe reports (sec)
+MULTI_CHUNK     = 256       # Max samples in one report from a probe
+
+# Open a probe and start up the SWD interface, return None if failed
+def probe_start(idx):
+    h = arm.open(idx)
+    if h:
+        driver.spi_init(h)
+        if not driver.check_sync(h):
+            driver.close(h)
+            return None
+        swd.swd_reset(h)
+        arm.cpu_swd_start(h)
+        arm.ap_config(h, 32)
+    return h
+
+# Process to poll one probe, given a list of (name, address, rate)
+# Reports (probe index, time mark, samples) are sent to the output queue,
+# where each sample is (time, probe index, name, value), and no later
+# sample will be earlier than the time mark. The final report has a
+# time mark of None
+def probe_proc(idx, pvars, outq, stop, emulate=False, depth=arm.POLL_DEPTH):
+    driver.EMULATE = emulate
+    h = probe_start(idx)
+    if h:
+        for name, addr, rate in pvars:
+            arm.poll_add_var(h, name, addr, rate)
+    samples = []
+    while h and not stop.is_set():
+        pvs = arm.poll_due_vars(h, time.time())
+        batches = arm.poll_pipeline(h, pvs, depth) if pvs else []
+        due = arm.poll_next_due(h)
+        delay = MULTI_IDLE if due is None else due - time.time()
+        if delay > 0:
+            batches += arm.poll_drain(h)
+        mark = h.poll_pending[0].time if h.poll_pending else time.time()
+        for batch in batches:
+            samples += [(batch.time, idx, pv.name, val)
+                        for pv, val in zip(batch.pvs, batch.values)]
+        if samples and (delay > 0 or len(samples) >= MULTI_CHUNK):
+            outq.put((idx, mark, samples))
+            samples = []
+        if delay > 0:
+            stop.wait(min(delay, MULTI_IDLE))
+    if h:
+        for batch in arm.poll_drain(h):
+            samples += [(batch.time, idx, pv.name, val)
+                        for pv, val in zip(batch.pvs, batch.values)]
+        driver.close(h)
+    outq.put((idx, None, samples))
+
+# Class to poll several probes in parallel, using a pool of processes,
+# one per probe. All the probes poll the same list of (name, address, rate)
+class MultiPoll(object):
+    def __init__(self, probes, pvars, emulate=None):
+        self.probes, self.pvars = list(probes), list(pvars)
+        self.emulate = driver.EMULATE if emulate is None else emulate
+        self.procs = []
+        self.marks = {}
+        self.heap, self.seq = [], 0
+
+    # Start the polling processes
+    def start(self):
+        self.outq = multiprocessing.Queue()
+        self.stopper = multiprocessing.Event()
+        for idx in self.probes:
+            p = multiprocessing.Process(target=probe_proc, args=(idx,
+                    self.pvars, self.outq, self.stopper, self.emulate))
+            p.daemon = True
+            p.start()
+            self.procs.append(p)
+            self.marks[idx] = 0.0
+
+    # Return True if any probes are still running
+    def running(self):
+        return len(self.marks) > 0
+
+    # Add a report from a probe to the merge heap
+    def add_report(self, idx, mark, samples):
+        for sample in samples:
+            heapq.heappush(self.heap, (sample[0], self.seq, sample))
+            self.seq += 1
+        if mark is None:
+            self.marks.pop(idx, None)
+        else:
+            self.marks[idx] = mark
+
+    # Get the samples from all probes that can be merged in time order,
+    # waiting up to the given timeout for a report; return list of samples
+    def get(self, timeout=None):
+        try:
+            report = self.outq.get(True, timeout)
+            while report:
+                self.add_report(*report)
+                report = self.outq.get_nowait()
+        except Queue.Empty:
+            pass
+        limit = min(self.marks.values()) if self.marks else None
+        samples = []
+        while self.heap and (limit is None or self.heap[0][0] <= limit):
+            samples.append(heapq.heappop(self.heap)[2])
+        return samples
+
+    # Stop polling, return the remaining samples
+    # If a process has died without a final report, its marks are dropped
+    def stop(self):
+        self.stopper.set()
+        samples = []
+        while self.running():
+            alive = any([p.is_alive() for p in self.procs])
+            samples += self.get(MULTI_IDLE)
+            if not alive:
+                self.marks.clear()
+        for p in self.procs:
+            p.join()
+        self.procs = []
+        return samples + self.get(0)
+
+# Poll several probes for the given time, returning a generator of samples
+def multi_poll(probes, pvars, secs, emulate=None):
+    mp = MultiPoll(probes, pvars, emulate)
+    mp.start()
+    end = time.time() + secs
+    while time.time() < end:
+        for sample in mp.get(MULTI_IDLE):
+            yield sample
+    for sample in mp.stop():
+        yield sample
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reporta multi-probe poll")
+    parser.add_argument("-n", "--nprobes", type=int, default=1,
+                        help="number of probes")
+    parser.add_argument("-s", "--secs", type=float, default=1.0,
+                        help="polling time (sec)")
+    parser.add_argument("-r", "--rate", type=float, default=arm.POLL_RATE,
+                        help="poll rate (samples/sec)")
+    parser.add_argument("-e", "--emulate", action="store_true",
+                        help="use emulated probes")
+    args = parser.parse_args()
+    pvars = [("PB", arm.GPIOB+arm.GPIO_IDR, args.rate)]
+    for t, idx, name, val in multi_poll(range(0, args.nprobes), pvars,
+                                        args.secs, args.emulate):
+        print("%.6f %u %s %s" % (t, idx, name, "?" if val is None else "%08X" % val))
+
+# EOF
@@ -0,0 +1,172 @@
+# Statistical PC-sampling profiler for Iosoft Reporta project
+# Reads the Cortex-M DWT PC Sample Register at high rate, histograms the
+# program counter values, and resolves them to functions from an ELF file
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import time, argparse
+import numpy as np
+import rp_arm as arm, rp_ftd2xx as driver, rp_multi
+
+DWT_PCSR        = 0xE000101C    # DWT PC Sample Register
+DEMCR           = 0xE000EDFC    # Debug Exception & Monitor Control Register
+DEMCR_TRCENA    = 1 << 24       # Trace enable, needed for DWT
+PCSR_INVALID    = 0xFFFFFFFF    # PCSR value if core halted or sampling disabled
+PCPROF_BATCH    = 1024          # PC samples in each batch
+PCPROF_BASE     = 0x08000000    # Default code address range (STM32 flash)
+PCPROF_SIZE     = 0x100000
+PCPROF_TOP      = 20            # Default number of functions in report
+PCPROF_BAR      = 40            # Width of bars in summary (characters)
+PCPROF_BLOCK    = 0x100         # Size of address blocks for PCs without symbols
+
+# Class for a histogram of PC values within a code address range, with a
+# count for each halfword (Thumb instructions are halfword-aligned)
+# PCs outside the range are only counted in total
+class PcHistogram(object):
+    def __init__(self, base=PCPROF_BASE, size=PCPROF_SIZE):
+        self.base, self.size = base, size
+        self.counts = np.zeros(size // 2, np.uint32)
+        self.total = self.invalid = 0
+
+    # Add an array of PC samples
+    def add(self, pcs):
+        pcs = np.asarray(pcs, np.uint32)
+        ok = pcs != PCSR_INVALID
+        self.invalid += len(pcs) - int(ok.sum())
+        pcs = pcs[ok]
+        self.total += len(pcs)
+        offsets = (pcs - np.uint32(self.base)) >> 1
+        offsets = offsets[offsets < len(self.counts)]
+        self.counts += np.bincount(offsets, minlength=len(self.counts)).astype(np.uint32)
+
+    # Return (pcs, counts) arrays for the PCs that have been sampled
+    def items(self):
+        idx = np.flatnonzero(self.counts)
+        return (idx * 2 + self.base).astype(np.uint32), self.counts[idx]
+
+    # Return number of samples outside the code range
+    def outside(self):
+        return self.total - int(self.counts.sum())
+
+# Enable the DWT, so the PC sample register is active
+def pc_sample_enable(h):
+    val = arm.cpu_mem_read32(h, DEMCR)
+    if val is not None and not val & DEMCR_TRCENA:
+        arm.cpu_mem_write_block(h, DEMCR, [val | DEMCR_TRCENA])
+
+# Sample the PC for the given time, or until stop() returns True, adding
+# the values to a histogram; return number of samples per second
+# The samples use repeated reads of PCSR without a TAR write, in large
+# batches, which is the fastest transaction path
+def pc_profile(h, hist, secs, stop=None, batch=PCPROF_BATCH):
+    start = time.time()
+    nsamples = 0
+    while time.time() - start < secs and not (stop and stop()):
+        pcs = arm.cpu_mem_sample(h, DWT_PCSR, batch)
+        hist.add(np.frombuffer(pcs, np.uint32) if len(pcs) else [])
+        nsamples += len(pcs)
+    return nsamples / max(time.time() - start, 1e-6)
+
+# Return list of (symbol, count, {pc: count}) for each function with
+# samples, in descending order of count; PCs without a symbol are grouped
+# in address blocks, with a symbol of None
+def pc_functions(hist, table=None):
+    pcs, counts = hist.items()
+    idx = table.lookup(pcs) if table is not None else np.full(len(pcs), -1)
+    funcs = {}
+    for pc, count, n in zip(pcs.tolist(), counts.tolist(), idx.tolist()):
+        sym = table.syms[n] if n >= 0 else None
+        key = n if sym else -1 - (pc // PCPROF_BLOCK)
+        entry = funcs.setdefault(key, [sym, 0, {}])
+        entry[1] += count
+        entry[2][pc] = count
+    return sorted([tuple(e) for e in funcs.values()], key=lambda e: -e[1])
+
+# Return the name of a function entry, or the address block if unknown
+def func_name(sym, pcs):
+    return sym.name if sym else "?%08X" % (min(pcs) & ~(PCPROF_BLOCK-1))
+
+# Return lines of text for a report of the top functions, with the
+# percentage of samples in each, and the hottest PC in the function
+def pc_report(hist, table=None, top=PCPROF_TOP):
+    total = float(max(hist.total, 1))
+    lines = ["%7s %6s  %-8s  %s" % ("Samples", "%", "Hot PC", "Function")]
+    for sym, count, pcs in pc_functions(hist, table)[:top]:
+        hot = max(pcs, key=pcs.get)
+        lines.append("%7u %6.2f  %08X  %s" % (count, 100 * count / total, hot,
+                                               func_name(sym, pcs)))
+    lines.append("%7u total, %u outside code, %u invalid" % (hist.total,
+                 hist.outside(), hist.invalid))
+    return lines
+
+# Return lines in 'folded stack' format for flame graph tools, one per PC:
+# 'file;function;address count'
+def pc_folded(hist, table=None):
+    lines = []
+    for sym, count, pcs in pc_functions(hist, table):
+        prefix = "%s;%s" % ((sym.fname or "?") if sym else "?", func_name(sym, pcs))
+        lines += ["%s;%08X %u" % (prefix, pc, n) for pc, n in sorted(pcs.items())]
+    return lines
+
+# Return lines of text for a flame-style summary: source files, with the
+# functions in each, as bars proportional to their share of the samples
+def pc_summary(hist, table=None, top=PCPROF_TOP, width=PCPROF_BAR):
+    total = float(max(hist.total, 1))
+    files = {}
+    for sym, count, pcs in pc_functions(hist, table):
+        fname = (sym.fname or "?") if sym else "?"
+        files.setdefault(fname, []).append((func_name(sym, pcs), count))
+    bar = lambda n, indent: ("#" * max(int(width * n / total), 1)).ljust(width + 2 - indent)
+    lines = []
+    for fname, funcs in sorted(files.items(), key=lambda f: -sum([c for n, c in f[1]])):
+        count = sum([c for n, c in funcs])
+        lines.append("%s %5.1f%% %s" % (bar(count, 0), 100 * count / total, fname))
+        for name, count in funcs[:top]:
+            lines.append("  %s %5.1f%%   %s" % (bar(count, 2), 100 * count / total, name))
+    return lines
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reporta PC-sampling profiler")
+    parser.add_argument("elf", nargs="?", help="ELF file for symbols")
+    parser.add_argument("-s", "--secs", type=float, default=2.0,
+                        help="sampling time (sec)")
+    parser.add_argument("-n", "--top", type=int, default=PCPROF_TOP,
+                        help="number of functions in report")
+    parser.add_argument("-f", "--folded", help="write folded stacks to file")
+    parser.add_argument("-i", "--index", type=int, default=0,
+                        help="probe index")
+    parser.add_argument("-e", "--emulate", action="store_true",
+                        help="use emulated probe")
+    args = parser.parse_args()
+    table = None
+    if args.elf:
+        import rp_elf
+        table = rp_elf.ElfIndex(args.elf).symbols(rp_elf.STT_FUNC)
+    driver.EMULATE = driver.EMULATE or args.emulate
+    dev = rp_multi.probe_start(args.index)
+    if not dev:
+        print("Can't start SWD interface")
+    else:
+        hist = PcHistogram()
+        pc_sample_enable(dev)
+        rate = pc_profile(dev, hist, args.secs)
+        driver.close(dev)
+        print("%.0f samples/s\n" % rate)
+        print("\n".join(pc_report(hist, table, args.top)) + "\n")
+        print("\n".join(pc_summary(hist, table, args.top)))
+        if args.folded:
+            with open(args.folded, "w") as f:
+                f.write("\n".join(pc_folded(hist, table)) + "\n")
+
+# EOF
@@ -12,14 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import sys, time
+import sys, time, threading, logging, logging.handlers, rp_stats
 try:
     from PyQt5.QtGui import QBrush, QPen, QColor, QFont, QTextCursor, QFontMetrics, QPainter
-    from PyQt5.QtWidgets import QApplication, QGraphicsScene, QGraphicsView, QGraphicsSimpleTextItem
+    from PyQt5.QtWidgets import QGraphicsScene, QGraphicsView
     from PyQt5 import QtCore, QtWidgets
 except:
     from PyQt4.QtGui import QBrush, QPen, QColor, QFont, QTextCursor, QFontMetrics, QPainter
-    from PyQt4.QtGui import QApplication, QGraphicsScene, QGraphicsView, QGraphicsSimpleTextItem
+    from PyQt4.QtGui import QGraphicsScene, QGraphicsView
     from PyQt4 import QtCore, QtGui as QtWidgets
 Qt = QtCore.Qt
 try:
@@ -31,6 +31,15 @@ from collections import OrderedDict
 VERSION         = "Reporta"
 GRID_PITCH      = 4.0
 WINDOW_SIZE     = 800, 500
+DISPLAY_RATE    = 25            # Display refresh rate (updates/sec)
+LOG_MAX_BLOCKS  = 2000          # Max lines in log display
+LOG_FLUSH_MSEC  = 100           # Interval between log display updates
+LOG_FILE        = None          # Log file name, None to use log display
+LOG_FILE_SIZE   = 1000000       # Max size of log file before rotation
+LOG_FILE_COUNT  = 5             # Number of rotated log files kept
+STATS_MSEC      = 1000          # Interval between stats panel updates
+STATS_FONT      = QFont("Courier New", 8)
+GUI_STAGE       = rp_stats.stage("gui")     # Items are pins changed
 VIEW_SIZE       = 400, 320
 FRAME_SIZE      = 120, 51
 FRAME_COLOUR    = QColor(240, 240, 240)
@@ -74,6 +83,10 @@ SEG_BITNUM = OrderedDict((("g",11), ("f",10), ("x",-1), ("a",1),  ("b",0),
 # 7-seg I/O port identifier
 SEGPORT = "PB"
 
+# I/O port names, indexed by port ident number, and number of bits per port
+PORT_NAMES = ("PA", "PB", "PC", "PD", "PE")
+PORT_NBITS = 16
+
 # Signal idents for 7-segment display pins, starting top left
 # Non-animated pins have null ident strings
 SEG_IDENTS = ["%s%u" % (SEGPORT, bitnum) if bitnum>=0 else ""
@@ -100,6 +113,18 @@ BOARDPINS=("GND", "GND", "3V3", "NRST","PB11","PB10","PB1", "PB0", "PA7", "PA6",
            "PB12","PB13","PB14","PB15","PA8", "PA9", "PA10","PA11","PA12","PA15",
            "PB3", "PB4", "PB5", "PB6", "PB7", "PB8", "PB9", "5V",  "GND", "3V3")
 
+# Return port ident number for a port name, None if not a port
+def port_id(name):
+    return PORT_NAMES.index(name) if name in PORT_NAMES else None
+
+# Return (port ident, bit number) for a pin name such as 'PB12', None if
+# not a port pin
+def pin_port(name):
+    port, num = port_id(name[:2]), name[2:]
+    if port is None or not num.isdigit() or int(num) >= PORT_NBITS:
+        return None
+    return port, int(num)
+
 # Convert a digit to the O/P bits driving 7-seg display
 def num_segbits(num):
     segs = num_segs[num & 0xf]
@@ -128,18 +153,30 @@ class PollTask(QtCore.QThread):
                 val = num_segbits(self.value)
                 val |= 0x8000 if self.value&1 else 0x8
                 if self.parent:
-                    self.parent.graph_updater.emit("%s=%X" % ("PB", val))
+                    self.parent.port_updater.emit(port_id("PB"), val)
                 self.value = (self.value + 1) % 10
 
 # Central widget (whole display area)
 class MyWidget(QtWidgets.QWidget):
-    text_updater = QtCore.pyqtSignal(str)   # Signal to update text display
-
     # Initialise the GUI
     def __init__(self, parent=None):
         super(MyWidget, self).__init__(parent)
         self.parent = parent
-        self.text = QtWidgets.QTextEdit()
+        self.text = QtWidgets.QPlainTextEdit()
+        self.text.setReadOnly(True)
+        self.text.setMaximumBlockCount(LOG_MAX_BLOCKS)
+        self.log_lock = threading.Lock()
+        self.log_buff = []
+        self.log_file = None
+        if LOG_FILE:
+            self.log_file = logging.handlers.RotatingFileHandler(LOG_FILE,
+                                maxBytes=LOG_FILE_SIZE, backupCount=LOG_FILE_COUNT)
+            self.log_file.setFormatter(logging.Formatter("%(message)s"))
+            self.log_file.terminator = ""
+            self.text.setPlainText("Logging to %s" % LOG_FILE)
+        self.log_timer = QtCore.QTimer()
+        self.log_timer.timeout.connect(self.flush_text)
+        self.log_timer.start(LOG_FLUSH_MSEC)
         self.scene = QGraphicsScene()
         self.view = MyView(self.scene)
         self.view.setRenderHint(QPainter.Antialiasing)
@@ -153,11 +190,11 @@ class MyWidget(QtWidgets.QWidget):
         self.draw_part_pins(SEGDISP_GPOS, SEGDISP_GSIZE, SEG_IDENTS, SMALLPIN_SIZE, True)
         self.draw_part_segs(SEGDISP_GPOS)
         self.draw_button()
+        self.make_port_tables()
         layout = QtWidgets.QVBoxLayout()
         layout.addWidget(self.view, 30)
         layout.addWidget(self.text, 10)
         self.setLayout(layout)
-        self.text_updater.connect(self.update_text)
         sys.stdout = self
 
     # Convert x,y grid position to graphics position
@@ -256,17 +293,43 @@ class MyWidget(QtWidgets.QWidget):
         self.add_pin_signal(BUTTON_PIN, p)
         return p
 
+    # Make tables of the animated items for each bit of each port,
+    # and the current port values
+    def make_port_tables(self):
+        self.port_items = [[[] for n in range(0, PORT_NBITS)] for port in PORT_NAMES]
+        self.port_values = [0] * len(PORT_NAMES)
+        for name, pins in self.sigpins.items():
+            pp = pin_port(name)
+            if pp:
+                self.port_items[pp[0]][pp[1]] += pins
+
+    # Set port pins on/off states, given port ident number and value
+    # Only the pins that have changed since the last update are redrawn
+    def update_port(self, port, val):
+        t = rp_stats.timer()
+        diff = (val ^ self.port_values[port]) & ((1 << PORT_NBITS) - 1)
+        self.port_values[port] = val
+        items = self.port_items[port]
+        nbits = 0
+        while diff:
+            bit = diff & -diff
+            opacity = PIN_ON_OPACITY if val & bit else PIN_OFF_OPACITY
+            for p in items[bit.bit_length() - 1]:
+                p.setOpacity(opacity)
+            diff ^= bit
+            nbits += 1
+        GUI_STAGE.add(rp_stats.timer() - t, nbits)
+
     # Set port pins on/off states
     # Space-delimited 'name=value' with 16 bit hex value, e.g. 'PA=12C PB=D3E4'
     def set_ports(self, s):
         data = str(s).split(' ')
         for d in data:
             name,eq,num = d.partition('=')
-            if eq and num is not None:
+            port = port_id(name)
+            if eq and port is not None and num != "?":
                 val = int(num, 16)
-                print("Port %s = %X" % (name, val))
-                for i in range(0, 16):
-                    self.set_pin("%s%u=%X" % (name, i, (val>>i)&1))
+                self.update_port(port, val)
 
     # Set pin (or segment) on/off state
     # Format is 'name=value', e.g.  'PA10=1'
@@ -274,6 +337,10 @@ class MyWidget(QtWidgets.QWidget):
         name, eq, num = s.partition('=')
         if eq and name in self.sigpins:
             val = int(num, 16)
+            pp = pin_port(name)
+            if pp:
+                mask = 1 << pp[1]
+                self.port_values[pp[0]] = (self.port_values[pp[0]] & ~mask) | (mask if val else 0)
             for p in self.sigpins[name]:
                 if int(p.opacity()) != val:
                     p.setOpacity(PIN_ON_OPACITY if val else PIN_OFF_OPACITY)
@@ -282,24 +349,100 @@ class MyWidget(QtWidgets.QWidget):
     def update_graph(self, s):
         self.set_ports(s)
 
-    # Handler to update text display
+    # Handler to update text display, or write to log file
+    # The display holds a limited number of lines, older lines are discarded
     def update_text(self, text):
+        text = str(text).replace("\r", "")      # Eliminate CR
+        if self.log_file:
+            for line in text.splitlines(True):
+                self.log_file.handle(logging.makeLogRecord({"msg": line}))
+            return
+        lines = text.split("\n")
+        if len(lines) > LOG_MAX_BLOCKS:         # Skip lines that would be discarded
+            text = "\n".join(lines[-LOG_MAX_BLOCKS:])
         disp = self.text.textCursor()           # Move cursor to end
         disp.movePosition(QTextCursor.End)
-        text = str(text).replace("\r", "")      # Eliminate CR
-        while text:
-            head,sep,text = text.partition("\n")# New line on LF
-            disp.insertText(head)
-            if sep:
-                disp.insertBlock()
-        self.text.ensureCursorVisible()    # Scroll if necessary
-
-    # Handle sys.stdout.write: update text display
+        disp.insertText(text)                   # New line on LF
+        self.text.ensureCursorVisible()         # Scroll if necessary
+
+    # Timer handler to flush buffered text to the display
+    def flush_text(self):
+        with self.log_lock:
+            text = "".join(self.log_buff)
+            self.log_buff = []
+        if text:
+            self.update_text(text)
+
+    # Handle sys.stdout.write: buffer text for display; can be called
+    # from any thread
     def write(self, text):
-        self.text_updater.emit(str(text))
+        with self.log_lock:
+            self.log_buff.append(str(text))
     def flush(self):
         pass
 
+    # Stop the log timer, display or write any buffered text, and close
+    # the log file
+    def close_log(self):
+        self.log_timer.stop()
+        self.flush_text()
+        if self.log_file:
+            self.log_file.close()
+            self.log_file = None
+
+# Class to pass values from the poll thread to the display, which is
+# updated on a timer at the display refresh rate, so acquisition and
+# rendering are decoupled. The latest value of each variable wins, with
+# counts of the bit toggles in each interval, and glitches (bits that
+# changed, but are back at their displayed state), so fast edges aren't lost
+class Coalescer(object):
+    def __init__(self, widget, rate=DISPLAY_RATE):
+        self.widget = widget
+        self.lock = threading.Lock()
+        self.values = {}                # Latest value of each variable
+        self.changed = OrderedDict()    # Variables changed in this interval
+        self.toggles = {}               # (bit mask, count) of toggles
+        self.shown = {}                 # Values on display
+        self.stats = {}                 # Total (toggles, glitches) per variable
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.flush)
+        self.timer.start(int(1000 / rate))
+
+    # Update a variable value; can be called from any thread
+    def update(self, name, val):
+        with self.lock:
+            old = self.values.get(name)
+            if val != old or name not in self.values:
+                self.values[name] = val
+                self.changed[name] = val
+                if old is not None and val is not None:
+                    mask, count = self.toggles.get(name, (0, 0))
+                    diff = old ^ val
+                    self.toggles[name] = (mask | diff, count + bin(diff).count("1"))
+
+    # Timer handler to update the display with the changed values
+    def flush(self):
+        with self.lock:
+            changed, toggles = self.changed, self.toggles
+            self.changed, self.toggles = OrderedDict(), {}
+        for name, val in changed.items():
+            mask, count = toggles.get(name, (0, 0))
+            old = self.shown.get(name)
+            glitches = 0
+            if old is not None and val is not None:
+                glitches = bin(mask & ~(old ^ val)).count("1")
+            total = self.stats.get(name, (0, 0))
+            self.stats[name] = total[0] + count, total[1] + glitches
+            self.shown[name] = val
+            valstr = ("%08X" % val) if val is not None else "?"
+            if glitches:
+                print("%8s = %s (%u toggles, %u glitches)" % (name, valstr, count, glitches))
+            port = port_id(name)
+            if port is not None and val is not None:
+                self.widget.update_port(port, val & ((1 << PORT_NBITS) - 1))
+            else:
+                self.widget.update_graph("%s=%s" % (name, valstr))
+
 # Subclass of graphics view to handle resizing
 class MyView(QGraphicsView):
     def resizeEvent(self, event):
@@ -307,9 +450,25 @@ class MyView(QGraphicsView):
         bounds = self.scene().itemsBoundingRect()
         self.fitInView(bounds, Qt.KeepAspectRatio)
 
+# Panel to display performance statistics, updated periodically
+class StatsPanel(QtWidgets.QPlainTextEdit):
+    def __init__(self, parent=None, msec=STATS_MSEC):
+        super(StatsPanel, self).__init__(parent)
+        self.setReadOnly(True)
+        self.setFont(STATS_FONT)
+        self.setLineWrapMode(QtWidgets.QPlainTextEdit.NoWrap)
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(msec)
+
+    # Display the latest statistics
+    def refresh(self):
+        self.setPlainText(rp_stats.stats_text())
+
 # Window to display widget
 class MyWindow(QtWidgets.QMainWindow, MyWidget):
     graph_updater = QtCore.pyqtSignal(str)
+    port_updater = QtCore.pyqtSignal(int, int)  # Port ident, value
 
     def __init__(self, parent=None):
         QtWidgets.QMainWindow.__init__(self, parent)
@@ -318,11 +477,14 @@ class MyWindow(QtWidgets.QMainWindow, MyWidget):
         self.setWindowTitle(VERSION)
         self.resize(*WINDOW_SIZE)
         self.graph_updater.connect(self.widget.update_graph)
+        self.port_updater.connect(self.widget.update_port)
+        self.coalescer = Coalescer(self.widget)
         self.close_handler = None
 
     def closeEvent(self, event):
         if self.close_handler:
             self.close_handler()
+        self.widget.close_log()
 
 if __name__ == '__main__':
     app = QtWidgets.QApplication(sys.argv)
@@ -0,0 +1,217 @@
+# Ring buffer of timestamped poll samples for Iosoft Reporta project
+# Fixed-capacity NumPy arrays, so memory use is constant
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import threading
+import numpy as np
+
+RING_CAPACITY   = 100000    # Default number of rows in ring buffer
+RING_LEVELS     = (16, 256, 4096) # Block sizes for min/max summaries
+ALL_ONES        = np.uint32(0xffffffff)
+RING_COL_CACHE  = 64        # Max number of cached variable column lists
+
+# Return an array of slot numbers in time order for a circular array of
+# times, given the first slot and number of entries, with optional start
+# time (inclusive) and end time (exclusive)
+# The entries are in two sorted segments, which are searched separately
+def ring_slots(times, first, n, start=None, end=None):
+    size = len(times)
+    segs = [(first, min(first + n, size)), (0, max(first + n - size, 0))]
+    idx = []
+    for a, b in segs:
+        if b > a:
+            t = times[a:b]
+            lo = a + (0 if start is None else np.searchsorted(t, start, 'left'))
+            hi = a + (b-a if end is None else np.searchsorted(t, end, 'left'))
+            idx.append(np.arange(lo, hi))
+    return np.concatenate(idx) if idx else np.zeros(0, np.intp)
+
+# Class for summaries of fixed-size blocks of rows in a ring buffer, with
+# the time of the first row, and the min, max, bitwise AND & OR, and last
+# value of each variable, ignoring invalid values
+class RingSummary(object):
+    def __init__(self, ring, block):
+        nblocks, nvars = ring.capacity // block, len(ring.names)
+        self.block = block
+        self.times = np.zeros(nblocks, np.float64)
+        self.mins, self.maxs, self.ands, self.ors, self.lasts = [
+            np.zeros((nblocks, nvars), np.uint32) for n in range(0, 5)]
+        self.valid = np.zeros((nblocks, nvars), np.bool_)
+        self.done = 0               # Number of rows summarised
+
+    # Return the first block number that hasn't been overwritten
+    def first_block(self, ring):
+        return max(-(-(ring.count - ring.capacity) // self.block), 0)
+
+    # Summarise any new complete blocks in the ring buffer
+    def update(self, ring):
+        blk, nblocks = self.block, len(self.times)
+        k, kend = max(self.done // blk, self.first_block(ring)), ring.count // blk
+        while k < kend:
+            s0 = k % nblocks
+            s1 = min(nblocks, s0 + kend - k)
+            rows = slice(s0 * blk, s1 * blk)
+            v = ring.values[rows].reshape(s1 - s0, blk, -1)
+            ok = ring.valid[rows].reshape(s1 - s0, blk, -1)
+            self.times[s0:s1] = ring.times[rows][::blk]
+            hi, lo = np.where(ok, v, ALL_ONES), np.where(ok, v, 0)
+            self.mins[s0:s1] = hi.min(axis=1)
+            self.maxs[s0:s1] = lo.max(axis=1)
+            self.ands[s0:s1] = np.bitwise_and.reduce(hi, axis=1)
+            self.ors[s0:s1] = np.bitwise_or.reduce(lo, axis=1)
+            last = blk - 1 - np.argmax(ok[:, ::-1, :], axis=1)
+            self.lasts[s0:s1] = np.take_along_axis(v, last[:, None, :], axis=1)[:, 0, :]
+            self.valid[s0:s1] = ok.any(axis=1)
+            k += s1 - s0
+        self.done = kend * blk
+
+    # Return an array of block numbers in time order, for blocks starting
+    # in the given time range
+    def slots(self, ring, start=None, end=None):
+        first = self.first_block(ring)
+        return ring_slots(self.times, first % len(self.times),
+                          self.done // self.block - first, start, end)
+
+# Class for a ring buffer of poll samples, with a row for each poll cycle
+# There is a timestamp column, and a uint32 value column for each variable;
+# a value is only valid if the variable was read successfully in that cycle
+# The capacity is rounded up to a whole number of the largest summary blocks
+# Rows are added under the lock, which a reader in another thread must
+# hold while it gets data from the ring
+class SampleRing(object):
+    def __init__(self, names, capacity=RING_CAPACITY, levels=RING_LEVELS):
+        self.names = list(names)
+        self.cols = dict([(name, n) for n, name in enumerate(self.names)])
+        blk = max(levels) if levels else 1
+        self.capacity = -(-capacity // blk) * blk
+        capacity = self.capacity
+        self.times = np.zeros(capacity, np.float64)
+        self.values = np.zeros((capacity, len(self.names)), np.uint32)
+        self.valid = np.zeros((capacity, len(self.names)), np.bool_)
+        self.count = 0              # Total number of rows added
+        self.col_cache = {}         # Batch indexes & columns for variable lists
+        self.lock = threading.Lock()
+        self.summaries = [RingSummary(self, blk) for blk in sorted(levels)]
+
+    # Return number of rows currently held
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    # Add a row of values, given the timestamp, column numbers, and values
+    # (None if a read failed). Columns that aren't given are marked invalid
+    def add(self, t, cols, values):
+        with self.lock:
+            i = self.count % self.capacity
+            self.times[i] = t
+            self.valid[i] = False
+            self.values[i, cols] = [0 if val is None else val for val in values]
+            self.valid[i, cols] = [val is not None for val in values]
+            self.count += 1
+
+    # Return arrays of the positions & columns of the known variables in a
+    # list of poll variables; cached, as the same lists are polled repeatedly
+    def batch_cols(self, pvs):
+        key = tuple(pvs)
+        idx = self.col_cache.get(key)
+        if idx is None:
+            if len(self.col_cache) >= RING_COL_CACHE:
+                self.col_cache.clear()
+            known = [(n, self.cols[pv.name]) for n, pv in enumerate(pvs)
+                     if pv.name in self.cols]
+            idx = self.col_cache[key] = (np.array([k[0] for k in known], np.intp),
+                                         np.array([k[1] for k in known], np.intp))
+        return idx
+
+    # Add the values from a decoded poll batch, ignoring unknown variables
+    # The values are converted to floating-point, so failed reads are NaN,
+    # and the row is stored with a single assignment for each array
+    def add_batch(self, batch):
+        idx, cols = self.batch_cols(batch.pvs)
+        vals = np.array(batch.values, np.float64)[idx]
+        ok = ~np.isnan(vals)
+        with self.lock:
+            i = self.count % self.capacity
+            self.times[i] = batch.time
+            self.valid[i] = False
+            self.values[i, cols] = np.where(ok, vals, 0)
+            self.valid[i, cols] = ok
+            self.count += 1
+
+    # Return an array of row numbers in time order, with optional start
+    # time (inclusive) and end time (exclusive)
+    def rows(self, start=None, end=None):
+        first = self.count % self.capacity if self.count > self.capacity else 0
+        return ring_slots(self.times, first, len(self), start, end)
+
+    # Return (times, values, valid) arrays for a time window
+    # If a variable name is given, the values are for that variable only,
+    # otherwise there is a column for each variable
+    def window(self, start=None, end=None, name=None):
+        idx = self.rows(start, end)
+        if name is None:
+            return self.times[idx], self.values[idx], self.valid[idx]
+        col = self.cols[name]
+        return self.times[idx], self.values[idx, col], self.valid[idx, col]
+
+    # Return (times, values) of the valid samples of a variable
+    def samples(self, name, start=None, end=None):
+        t, v, ok = self.window(start, end, name)
+        return t[ok], v[ok]
+
+    # Return (times, values) where a variable has changed, including the
+    # first valid sample in the window
+    def changes(self, name, start=None, end=None):
+        t, v = self.samples(name, start, end)
+        mask = np.ones(len(v), np.bool_)
+        mask[1:] = v[1:] != v[:-1]
+        return t[mask], v[mask]
+
+    # Return (times, mins, maxs, ands, ors, lasts) for a variable in a time
+    # range, with at least npoints entries if possible. The coarsest block
+    # summaries are used that meet this, with the individual samples after
+    # the last complete block; if none do, all entries are samples
+    def minmax(self, name, start=None, end=None, npoints=0):
+        col = self.cols[name]
+        for summ in self.summaries:
+            summ.update(self)
+        for summ in reversed(self.summaries):
+            idx = summ.slots(self, start, end)
+            if len(idx) >= max(npoints, 1):
+                idx = idx[summ.valid[idx, col]]
+                rows = np.arange(summ.done, self.count) % self.capacity
+                t, v, ok = self.times[rows], self.values[rows, col], self.valid[rows, col]
+                ok &= (t >= start) if start is not None else ok
+                ok &= (t < end) if end is not None else ok
+                t, v = np.concatenate((summ.times[idx], t[ok])), v[ok]
+                return (t,) + tuple([np.concatenate((a[idx, col], v)) for a in
+                        (summ.mins, summ.maxs, summ.ands, summ.ors, summ.lasts)])
+        t, v = self.samples(name, start, end)
+        return t, v, v, v, v, v
+
+    # Return (times, values) of every nth valid sample of a variable
+    def decimate(self, name, factor, start=None, end=None):
+        t, v = self.samples(name, start, end)
+        return t[::factor], v[::factor]
+
+if __name__ == "__main__":
+    ring = SampleRing(("A", "B"), 8, ())
+    for n in range(0, 12):
+        ring.add(float(n), [0, 1], [n//3, None if n%4==0 else n])
+    t, v = ring.changes("A")
+    print("A changes: %s" % " ".join(["%g:%u" % tv for tv in zip(t, v)]))
+    t, v = ring.samples("B", 5, 10)
+    print("B samples: %s" % " ".join(["%g:%u" % tv for tv in zip(t, v)]))
+
+# EOF
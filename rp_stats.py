@@ -0,0 +1,205 @@
+# Performance statistics for Iosoft Reporta project
+# Low-overhead counters and latency histograms for each processing stage,
+# and an optional sampling profiler; results as text or JSON
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import os, sys, time, json, atexit, threading
+from collections import OrderedDict
+
+timer = getattr(time, "perf_counter", time.time)
+
+STATS_HIST_BINS = 24        # Latency histogram bins (powers of 2 microseconds)
+PROFILE_INTERVAL= 0.005     # Sampling profiler interval (sec)
+PROFILE_TOP     = 20        # Number of entries in profiler report
+
+# Class for the statistics of a processing stage: number of calls, items
+# (bytes or transactions), total & max time, and a histogram of latencies,
+# where bin n counts times below 2**n microseconds
+# Updates from different threads aren't locked, so counts may be slightly low
+class Stage(object):
+    __slots__ = ("name", "calls", "items", "total", "max", "hist")
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    # Clear the statistics
+    def reset(self):
+        self.calls = self.items = 0
+        self.total = self.max = 0.0
+        self.hist = [0] * STATS_HIST_BINS
+
+    # Add a call, given the time taken (sec) and number of items
+    def add(self, secs, items=0):
+        self.calls += 1
+        self.items += items
+        self.total += secs
+        if secs > self.max:
+            self.max = secs
+        self.hist[min(int(secs * 1e6).bit_length(), STATS_HIST_BINS - 1)] += 1
+
+    # Return dictionary of statistics, with times in microseconds
+    # The histogram is keyed by the upper limit of each non-empty bin
+    def results(self):
+        return OrderedDict((("calls", self.calls), ("items", self.items),
+            ("total_ms", round(self.total * 1e3, 3)),
+            ("mean_us", round(self.total * 1e6 / self.calls, 2) if self.calls else 0),
+            ("max_us", round(self.max * 1e6, 1)),
+            ("hist_us", OrderedDict([("<%u" % (1 << n), c)
+                                     for n, c in enumerate(self.hist) if c]))))
+
+# Class for an event counter
+class Counter(object):
+    __slots__ = ("name", "n")
+
+    def __init__(self, name):
+        self.name, self.n = name, 0
+
+    def reset(self):
+        self.n = 0
+
+stages = OrderedDict()
+counters = OrderedDict()
+profiler = None
+
+# Return the stage with the given name, creating it if necessary
+def stage(name):
+    return stages.setdefault(name, Stage(name))
+
+# Return the counter with the given name, creating it if necessary
+def counter(name):
+    return counters.setdefault(name, Counter(name))
+
+# Clear all statistics
+def reset():
+    for s in list(stages.values()) + list(counters.values()):
+        s.reset()
+
+# Sampling profiler thread: periodically records the function being
+# executed by each of the other threads, and the functions that called it
+class Profiler(threading.Thread):
+    def __init__(self, interval=PROFILE_INTERVAL):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.samples = 0
+        self.leaf, self.inclusive = {}, {}
+        self.running = threading.Event()
+
+    # Return a description of a code location
+    @staticmethod
+    def location(frame):
+        code = frame.f_code
+        return "%s (%s:%u)" % (code.co_name, os.path.basename(code.co_filename),
+                               code.co_firstlineno)
+
+    # Record the current stack of each thread
+    def sample(self):
+        me = threading.current_thread().ident
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            self.samples += 1
+            loc = self.location(frame)
+            self.leaf[loc] = self.leaf.get(loc, 0) + 1
+            seen = set()
+            while frame is not None:
+                loc = self.location(frame)
+                if loc not in seen:
+                    seen.add(loc)
+                    self.inclusive[loc] = self.inclusive.get(loc, 0) + 1
+                frame = frame.f_back
+
+    # Thread to take samples until stopped
+    def run(self):
+        self.running.set()
+        while self.running.is_set():
+            self.sample()
+            time.sleep(self.interval)
+
+    # Stop sampling
+    def stop(self):
+        self.running.clear()
+        self.join()
+
+    # Return dictionary of the functions with the most samples, as
+    # percentages of the total: leaf (self) time and inclusive time
+    def results(self, top=PROFILE_TOP):
+        n = float(max(self.samples, 1))
+        def pcts(d):
+            items = sorted(d.items(), key=lambda i: -i[1])[:top]
+            return OrderedDict([(k, round(100 * v / n, 1)) for k, v in items])
+        return OrderedDict((("samples", self.samples), ("self_pct", pcts(self.leaf)),
+                            ("inclusive_pct", pcts(self.inclusive))))
+
+# Start the sampling profiler
+def profile_start(interval=PROFILE_INTERVAL):
+    global profiler
+    if profiler is None:
+        profiler = Profiler(interval)
+        profiler.start()
+    return profiler
+
+# Stop the sampling profiler
+def profile_stop():
+    if profiler is not None and profiler.is_alive():
+        profiler.stop()
+
+# Return dictionary of all statistics
+def results():
+    d = OrderedDict((("stages", OrderedDict([(s.name, s.results())
+                        for s in stages.values()])),
+                     ("counters", OrderedDict([(c.name, c.n)
+                        for c in counters.values()]))))
+    if profiler is not None:
+        d["profile"] = profiler.results()
+    return d
+
+# Return statistics as lines of text
+def stats_text():
+    lines = ["%-12s %9s %10s %9s %9s %9s" % ("Stage", "Calls", "Items",
+             "Total ms", "Mean us", "Max us")]
+    for s in stages.values():
+        r = s.results()
+        lines.append("%-12s %9u %10u %9.1f %9.1f %9.1f" % (s.name, r["calls"],
+                     r["items"], r["total_ms"], r["mean_us"], r["max_us"]))
+    lines.append("  ".join(["%s %u" % (c.name, c.n) for c in counters.values()]))
+    if profiler is not None:
+        for loc, pct in profiler.results(5)["self_pct"].items():
+            lines.append("%5.1f%% %s" % (pct, loc))
+    return "\n".join(lines)
+
+# Write the statistics as JSON to a file ('-' for stderr)
+def dump(fname):
+    profile_stop()
+    text = json.dumps(results(), indent=2)
+    if fname == "-":
+        print(text, file=sys.stderr)
+    else:
+        with open(fname, "w") as f:
+            f.write(text + "\n")
+
+# Write the statistics as JSON when the program exits
+def dump_on_exit(fname):
+    atexit.register(dump, fname)
+
+if __name__ == "__main__":
+    s = stage("test")
+    for n in range(0, 1000):
+        t = timer()
+        s.add(timer() - t, 1)
+    print(stats_text())
+
+# EOF
@@ -13,7 +13,7 @@
 # limitations under the License.
 
 from __future__ import print_function
-import time, rp_ftd2xx as driver
+import time, rp_ftd2xx as driver, rp_stats
 
 VERBOSE  = False    # Flag to display SWD read/write cycles
 ERRVAL = 0xEEEEEEEE # Dummy value returned if read cycle fails
@@ -25,6 +25,13 @@ SWD_ACK_OK      = 1     # SWD Ack values
 SWD_ACK_WAIT    = 2
 SWD_ACK_ERROR   = 4
 
+timer = rp_stats.timer
+ENCODE          = rp_stats.stage("encode")  # Items are transactions
+DECODE          = rp_stats.stage("decode")
+ACK_WAITS       = rp_stats.counter("ack_wait")
+ACK_FAILS       = rp_stats.counter("ack_fail")
+PARITY_ERRS     = rp_stats.counter("parity_err")
+
 # Commands to read, write, and read+write SPI data
 SPI_WR_BYTES        = (driver.FTDI_SPI_WR_CLK_NEG |
                        driver.FTDI_SPI_LSB_FIRST |
@@ -36,14 +43,6 @@ SPI_RD_BITS         = SPI_RD_BYTES | driver.FTDI_SPI_BIT_MODE
 SPI_WR_BITS         = SPI_WR_BYTES | driver.FTDI_SPI_BIT_MODE
 SPI_RD_WR_BITS      = SPI_RD_BITS | SPI_WR_BITS
 
-# Class for a multi-bit value
-class Bitval(object):
-    def __init__(self, value, nbits, name="", rd=False):
-        self.value = value
-        self.nbits = nbits
-        self.name = name
-        self.rd = rd
-
 # Send SWD reset; at least 50 high bits, around 0111 1001 1110 0111
 # (9E E7 lsb-first), then at least 2 null bits
 def swd_reset(d):
@@ -54,65 +53,100 @@ def swd_reset(d):
 
 # Send a number of idle (zero) bytes
 def swd_idle_bytes(d, n):
-    data = n * [0]
+    data = bytearray(n)
     driver.spi_write_bytes(d, SPI_WR_BYTES, data)
 
-# Create an SWD read request for a given AP or DP address
-class swd_rd_request(object):
-    def __init__(self, ap, addr):
-        addr >>= 2
-        hpar = ap ^ 1 ^ (addr & 1) ^ (addr>>1 & 1)
-        self.ack = Bitval(0, 3, "Ack", 1)
-        self.data = Bitval(0, 32, "Data", 1)
-        self.dparity = Bitval(0, 1, "DParity", 1)
-        self.bitvals = (
-            Bitval(1,    1, "Start"),  Bitval(ap,   1, "AP"),
-            Bitval(1, 1, "Read"),      Bitval(addr, 2, "Addr"),
-            Bitval(hpar, 1, "HParity"),Bitval(0, 1, "Stop"),
-            Bitval(1,    1, "Park"),   Bitval(0,    1, "Turn"),
-            self.ack,                  self.data,
-            self.dparity,              Bitval(0, 1, "Turn"))
-
-    # Allow the bitval list to be iterated
-    def __getitem__(self, idx):
-        bv = self.bitvals[idx]
-        return bv
-
-# Create an SWD write request for a given AP or DP address
-class swd_wr_request(object):
-    def __init__(self, ap, addr, value):
-        addr >>= 2
-        hpar = ap ^ (addr & 1) ^ (addr>>1 & 1)
-        self.ack = Bitval(0, 3, "Ack", 1)
-        self.data = Bitval(value, 32, "Data")
-        self.dparity = Bitval(parity32(value), 1, "DParity")
-        self.bitvals = (
-            Bitval(1,    1, "Start"),  Bitval(ap,   1, "AP"),
-            Bitval(0, 1, "Read"),      Bitval(addr, 2, "Addr"),
-            Bitval(hpar, 1, "HParity"),Bitval(0, 1, "Stop"),
-            Bitval(1,    1, "Park"),   Bitval(0,    1, "Turn"),
-            self.ack,                  Bitval(0,    1, "Turn"),
-            self.data,                 self.dparity)
-
-    # Allow the bitval list to be iterated
-    def __getitem__(self, idx):
-        bv = self.bitvals[idx]
-        return bv
+# Response lengths for read & write requests (bytes from FTDI device)
+SWD_RD_RESP_LEN = 6
+SWD_WR_RESP_LEN = 1
+
+# Create the 8-bit SWD request header: start, AP/DP, R/W, address (2 bits),
+# parity, stop and park, sent l.s.bit first
+def swd_header(ap, rd, addr):
+    a = (addr >> 2) & 3
+    par = ap ^ rd ^ (a & 1) ^ (a >> 1)
+    return 0x81 | (ap << 1) | (rd << 2) | (a << 3) | (par << 5)
+
+# Create MPSSE command bytes for the start of a request, up to the ack.
+# The header is 8 write-only bits; the turnaround bit and 3-bit ack are
+# read together, so the ack is in the top 3 bits of the response byte
+def swd_cmd_prefix(ap, rd, addr):
+    return bytearray((SPI_WR_BITS, 7, swd_header(ap, rd, addr),
+                      SPI_RD_WR_BITS, 3, 0))
+
+# Create MPSSE command bytes for a complete read request: prefix, then
+# 32 data bits as 4 bytes, then the parity & turnaround bits
+def swd_rd_cmd(ap, addr):
+    return swd_cmd_prefix(ap, 1, addr) + bytearray((SPI_RD_WR_BYTES, 3, 0,
+                                    0, 0, 0, 0, SPI_RD_WR_BITS, 1, 0))
+
+# Precomputed command bytes, indexed by AP/DP flag and address bits 2 & 3
+SWD_RD_CMDS = [[swd_rd_cmd(ap, a<<2) for a in range(0, 4)] for ap in (0, 1)]
+SWD_WR_PREFIXES = [[swd_cmd_prefix(ap, 0, a<<2) for a in range(0, 4)]
+                   for ap in (0, 1)]
+
+# Class for an SWD read or write request, and its response
+class SwdRequest(object):
+    __slots__ = ("ap", "addr", "rd", "data", "ack", "dparity")
+
+    def __init__(self, ap, addr, rd, data=0):
+        self.ap, self.addr, self.rd = ap, addr, rd
+        self.data = data
+        self.ack = 0
+        self.dparity = parity32(data) if not rd else 0
+
+    # Return MPSSE command bytes to send the request.
+    # For a write, the turnaround, 32 data bits and parity bit are
+    # sent as 4 bytes followed by 2 bits
+    def txdata(self):
+        if self.rd:
+            return SWD_RD_CMDS[self.ap][(self.addr>>2) & 3]
+        bits = (self.data << 1) | (self.dparity << 33)
+        cmd = SWD_WR_PREFIXES[self.ap][(self.addr>>2) & 3][:]
+        cmd += bytearray((SPI_WR_BYTES, 3, 0, bits & 0xff, (bits>>8) & 0xff,
+                          (bits>>16) & 0xff, (bits>>24) & 0xff,
+                          SPI_WR_BITS, 1, (bits>>32) & 3))
+        return cmd
+
+    # Return number of response bytes expected from the FTDI device
+    def rxlen(self):
+        return SWD_RD_RESP_LEN if self.rd else SWD_WR_RESP_LEN
+
+    # Decode the response bytes, starting at the given offset; for a read,
+    # the 4-byte data value is followed by the parity bit, left-justified
+    def decode(self, data, i=0):
+        if len(data) < i + self.rxlen():
+            self.ack, self.data = 0, ERRVAL if self.rd else self.data
+            return False
+        self.ack = (data[i] >> 5) & 7
+        if self.rd:
+            self.data = (data[i+1] | (data[i+2] << 8) | (data[i+3] << 16) |
+                         (data[i+4] << 24))
+            self.dparity = (data[i+5] >> 6) & 1
+        return True
+
+    # Check the data parity of a read response
+    def parity_ok(self):
+        return self.dparity == parity32(self.data)
+
+    # Check for a successful response: OK ack, and correct parity if a read
+    def ok(self):
+        return self.ack == SWD_ACK_OK and (not self.rd or self.parity_ok())
 
 # Send an SWD read request and/or get the response
 def swd_rd(d, ap, addr, tx=True, rx=True):
-    req = swd_rd_request(ap, addr)
+    req = SwdRequest(ap, addr, 1)
     ok = False
     if tx:
         spi_write_bitvals(d, req)
         ok = True
     if rx:
-        ok = spi_read_bitvals(d, req)
+        ok = spi_read_bitvals(d, (req,))
     if VERBOSE:
         if rx:
             print("Rd %X %-7s %08lX Ack %u" % (addr, 
                    apreg_str(addr) if ap else dpreg_str(addr, 1),
-                   req.data.value, req.ack.value))
+                   req.data, req.ack))
         else:
             print("Rd %X %-7s" % (addr,
                   apreg_str(addr) if ap else dpreg_str(addr, 1)))
@@ -120,82 +154,64 @@ def swd_rd(d, ap, addr, tx=True, rx=True):
 
 # Send an SWD write request and/or get the response
 def swd_wr(d, ap, addr, value, tx=True, rx=True):
-    req = swd_wr_request(ap, addr, value)
+    req = SwdRequest(ap, addr, 0, value)
     ok = False
     if tx:
         spi_write_bitvals(d, req)
         ok = True
     if rx:
-        ok = spi_read_bitvals(d, req)
+        ok = spi_read_bitvals(d, (req,))
     if VERBOSE:
         if rx:
             print("Wr %X %-7s %08lX Ack %u" % (addr, 
                   apreg_str(addr) if ap else dpreg_str(addr, 0),
-                  req.data.value, req.ack.value))
+                  req.data, req.ack))
         else:
             print("Wr %X %-7s %08lX" % (addr,
                   apreg_str(addr) if ap else dpreg_str(addr, 0),
-                  req.data.value))
+                  req.data))
     return req if ok else None
 
-# Write bitval requests
-def spi_write_bitvals(d, bitvals):
-    for bv in bitvals:
-        spi_write_bitval(d, bv)
+# Write request command bytes
+def spi_write_bitvals(d, req):
+    t = timer()
+    driver.write_data(d, req.txdata())
+    ENCODE.add(timer() - t, 1)
 
-# Read bitval responses
-def spi_read_bitvals(d, bitvals):
-    ok = True
+# Read the responses to a batch of requests. The total response length
+# is fetched in a single read, then decoded; return False if incomplete
+def spi_read_bitvals(d, reqs):
     driver.write_flush(d)
-    for bv in bitvals:
-        ok = spi_read_bitval(d, bv)
-        if not ok:
-            break
-    return ok
+    data = driver.spi_read_bytes(d, spi_resp_len(reqs))
+    return spi_decode_bitvals(reqs, data)
+
+# Return the total response length for a batch of requests
+def spi_resp_len(reqs):
+    return sum([req.rxlen() for req in reqs])
 
-# Write a bit value to SPI interface
-# If read-flag is set, use read+write, otherwise just write
-def spi_write_bitval(d, bv):
-    value, nbits = bv.value, bv.nbits
-    cmd = SPI_RD_WR_BITS if bv.rd else SPI_WR_BITS
-    while nbits > 0:
-        n = min(nbits, 8)
-        driver.spi_write_bits(d, cmd, value&0xff, n)
-        value >>= n
-        nbits -= n
-
-# Read a bit value (max 32 bits) from SPI if read-flag is set
-def spi_read_bitval(d, bv):
-    ok = True
-    if bv.rd:
-        bv.value = shift = 0
-        nbits = bv.nbits
-        while ok and nbits >= 8:    # Get whole bytes
-            data = driver.spi_read_bytes(d, 1)
-            if len(data) > 0:
-                byt = data[0] >> max(8-nbits, 0)
-                bv.value |= byt << shift
-                shift += 8
-                nbits -= 8
-            else:
-                bv.value = ERRVAL
-                ok = False
-        if ok and nbits>0:          # Get remaining bits
-            data = driver.spi_read_bits(d, nbits)
-            if len(data) > 0:
-                bv.value = data[0]
-            else:
-                bv.value = ERRVAL
-                ok = False
+# Decode the responses to a batch of requests, return False if incomplete
+# Failed acks and parity errors are counted
+def spi_decode_bitvals(reqs, data):
+    t = timer()
+    ok, i = True, 0
+    for req in reqs:
+        ok = req.decode(data, i) and ok
+        i += req.rxlen()
+        if req.ack != SWD_ACK_OK:
+            (ACK_WAITS if req.ack == SWD_ACK_WAIT else ACK_FAILS).n += 1
+        elif req.rd and not req.parity_ok():
+            PARITY_ERRS.n += 1
+    DECODE.add(timer() - t, len(reqs))
     return ok
 
-# Display bitvar values
-def disp_bitvars(bvs):
-    if bvs is None:
+# Display request values
+def disp_request(req):
+    if req is None:
         print("No response")
     else:
-        for bv in bvs:
-            print("%-8s %8X" % (bv.name, bv.value))
+        print("%-8s %8X" % ("Ack", req.ack))
+        print("%-8s %8X" % ("Data", req.data))
+        print("%-8s %8X" % ("DParity", req.dparity))
 
 # Calculate parity of 32-bit integer
 def parity32(i):
@@ -0,0 +1,175 @@
+# SWD link auto-tuning for Iosoft Reporta project
+# Finds the fastest reliable SPI clock, and the USB latency timer and
+# transfer size that give the highest poll rate; the results are cached
+# for each device serial number
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import os, time, json, argparse
+import rp_arm as arm, rp_swd as swd, rp_ftd2xx as driver
+
+TUNE_CACHE      = os.path.join(os.path.expanduser("~"), ".reporta_tune.json")
+TUNE_CLOCKS     = (1e6, 2e6, 3e6, 5e6, 7.5e6, 10e6, 15e6, 30e6) # SPI clocks to try
+TUNE_MARGIN     = 1         # Number of clock steps below the fastest that works
+TUNE_CHECKS     = 32        # Number of IDCODE reads to check each clock
+TUNE_LATENCIES  = (1, 2, 4, 8, 16)      # USB latency timer values (msec)
+TUNE_BUFFLENS   = (512, 1024, 4096, 16384, 65536) # USB transfer sizes
+TUNE_SECS       = 0.2       # Duration of each poll rate measurement
+TUNE_VARS       = 8         # Number of variables polled for measurement
+TUNE_ADDR       = 0xE000ED00 # Base address polled for measurement (SCB)
+TUNE_STEP       = 8         # Address step, so each variable is a separate read
+
+# Start up the SWD interface at the given clock, and check that the IDCODE
+# is read correctly several times; return True if OK
+# Each read is checked for ACK and data parity, and must match the first;
+# at too high a clock rate, the response may be incomplete
+def link_check(d, hz, nchecks=TUNE_CHECKS):
+    driver.spi_set_clock(d, hz)
+    swd.swd_reset(d)
+    ident = arm.cpu_swd_start(d)
+    if len(ident) != 8:
+        return False
+    for n in range(0, nchecks):
+        r = swd.swd_rd(d, swd.SWD_DP, arm.DPORT_IDCODE)
+        if r is None or not r.ok() or "%08X" % r.data != ident:
+            return False
+    return True
+
+# Step the clock up until the link fails, return the chosen clock frequency
+# (TUNE_MARGIN steps below the fastest that works), None if none work
+# Clocks above the maximum for the device are skipped, as they would be
+# clamped to the maximum, giving several steps at the same clock
+def tune_clock(d, clocks=TUNE_CLOCKS, margin=TUNE_MARGIN):
+    base = driver.FTDI_HS_CLOCK if driver.is_hispeed(d) else driver.FTDI_BASE_CLOCK
+    good = []
+    for hz in sorted([hz for hz in clocks if hz <= base // 2]):
+        if not link_check(d, hz):
+            break
+        good.append(hz)
+    return good[max(len(good) - 1 - margin, 0)] if good else None
+
+# Measure the poll rate (polls/sec) with the current link settings
+# The variables are at different addresses, that aren't merged into a
+# single read by the poll planner
+def poll_rate(d, secs=TUNE_SECS, nvars=TUNE_VARS):
+    saved = d.poll_vars
+    d.poll_vars = []
+    for n in range(0, nvars):
+        arm.poll_add_var(d, "T%u" % n, TUNE_ADDR + n*TUNE_STEP)
+    count, start = 0, time.time()
+    while time.time() - start < secs:
+        for batch in arm.poll_pipeline(d):
+            count += sum([val is not None for val in batch.values])
+    for batch in arm.poll_drain(d):
+        count += sum([val is not None for val in batch.values])
+    d.poll_vars = saved
+    return count / (time.time() - start)
+
+# Find the USB latency timer & transfer size with the highest poll rate,
+# return (latency, bufflen, polls/sec)
+def tune_usb(d, latencies=TUNE_LATENCIES, bufflens=TUNE_BUFFLENS):
+    best = None
+    for latency in latencies:
+        for bufflen in bufflens:
+            driver.usb_set_params(d, latency, bufflen)
+            rate = poll_rate(d)
+            if best is None or rate > best[2]:
+                best = latency, bufflen, rate
+    return best
+
+# Return a profile dictionary with the best link settings, None if failed
+def link_tune(d):
+    hz = tune_clock(d)
+    if hz is None:
+        return None
+    link_check(d, hz)
+    arm.ap_config(d, 32)
+    latency, bufflen, rate = tune_usb(d)
+    typ, desc = driver.device_type_desc(d)
+    return {"type": typ, "clock_hz": driver.spi_set_clock(d, hz),
+            "latency": latency, "bufflen": bufflen, "polls_per_sec": round(rate)}
+
+# Apply a profile to a device, and restart the SWD interface
+# Return True if the link works with the new settings
+def link_apply(d, profile):
+    driver.usb_set_params(d, profile["latency"], profile["bufflen"])
+    if not link_check(d, profile["clock_hz"]):
+        return False
+    arm.ap_config(d, 32)
+    return True
+
+# Load the cached profiles, return dictionary keyed by serial number
+def load_profiles(fname=TUNE_CACHE):
+    try:
+        with open(fname) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+# Save a profile in the cache
+def save_profile(serial, profile, fname=TUNE_CACHE):
+    profiles = load_profiles(fname)
+    profiles[serial] = profile
+    try:
+        with open(fname, "w") as f:
+            json.dump(profiles, f, indent=2, sort_keys=True)
+    except IOError:
+        pass
+
+# Set up the link using the cached profile for the device, or tune it if
+# there is none, or the cached profile doesn't work; return the profile,
+# or None if tuning failed (leaving the link at the default settings)
+def link_setup(d, retune=False, fname=TUNE_CACHE):
+    serial = driver.device_serial(d)
+    profile = None if retune else load_profiles(fname).get(serial)
+    if profile and link_apply(d, profile):
+        return profile
+    profile = link_tune(d)
+    if profile and link_apply(d, profile):
+        save_profile(serial, profile, fname)
+        return profile
+    driver.usb_set_params(d, driver.FTDI_LATENCY, driver.FTDI_BUFFLEN)
+    link_check(d, driver.SPI_CLOCK_KHZ * 1000)
+    arm.ap_config(d, 32)
+    return None
+
+# Return a description of a profile
+def profile_str(profile):
+    return ("%s clock %.3g MHz, latency %u ms, transfer %u bytes, %u polls/s" %
+            (profile["type"], profile["clock_hz"] / 1e6, profile["latency"],
+             profile["bufflen"], profile["polls_per_sec"])) if profile else "not tuned"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reporta link auto-tune")
+    parser.add_argument("-i", "--index", type=int, default=0,
+                        help="probe index")
+    parser.add_argument("-r", "--retune", action="store_true",
+                        help="ignore cached profile")
+    parser.add_argument("-e", "--emulate", action="store_true",
+                        help="use emulated probe")
+    args = parser.parse_args()
+    driver.EMULATE = driver.EMULATE or args.emulate
+    dev = arm.open(args.index)
+    if not dev:
+        print("Can't open FTDI device")
+    else:
+        driver.spi_init(dev)
+        if not driver.check_sync(dev):
+            print("Sync failed: check device supports MPSSE")
+        else:
+            print("%s: %s" % (driver.device_serial(dev),
+                              profile_str(link_setup(dev, args.retune))))
+        driver.close(dev)
+
+# EOF
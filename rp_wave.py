@@ -0,0 +1,215 @@
+# Logic-analyser waveform display for Iosoft Reporta project
+# Plots the history of pins and poll variables from a sample ring buffer,
+# using min/max decimation so each trace has at most one step per pixel
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import sys, time
+import numpy as np
+import rp_pyqt as pyqt
+try:
+    from PyQt5.QtGui import QPainter, QPainterPath, QPen, QColor
+    from PyQt5.QtCore import QRectF
+except:
+    from PyQt4.QtGui import QPainter, QPainterPath, QPen, QColor
+    from PyQt4.QtCore import QRectF
+QtCore, QtWidgets, Qt = pyqt.QtCore, pyqt.QtWidgets, pyqt.Qt
+
+timer = getattr(time, "perf_counter", time.time)
+
+WAVE_SPAN       = 2.0           # Default time span of display (sec)
+WAVE_MIN_SPAN   = 1e-4          # Minimum time span when zooming in (sec)
+WAVE_ZOOM       = 1.25          # Zoom factor for each mouse wheel step
+WAVE_LABEL_WD   = 50            # Width of trace labels (pixels)
+WAVE_MARGIN     = 3             # Vertical margin for each trace (pixels)
+WAVE_BACK       = QColor(16, 16, 16)
+WAVE_PEN        = QPen(QColor(0, 220, 0), 0)
+WAVE_LABEL_PEN  = QPen(QColor(200, 200, 200), 0)
+WAVE_GRID_PEN   = QPen(QColor(60, 60, 60), 0)
+
+# Return a trace definition (label, variable name, bit number) for a
+# pin name such as 'PB12', or for a poll variable (bit number None)
+def wave_trace(name):
+    pp = pyqt.pin_port(name)
+    return (name, pyqt.PORT_NAMES[pp[0]], pp[1]) if pp else (name, name, None)
+
+# Decimate values into pixel columns, given times, minimum, maximum & last
+# values, the start time and time per pixel. Values before the start are
+# put in column -1. Returns arrays of column number, and min, max & last
+def minmax_columns(t, vmin, vmax, vlast, start, tpp):
+    x = np.maximum(((t - start) / tpp).astype(np.int64), -1)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(x)) + 1))
+    ends = np.concatenate((starts[1:], [len(x)])) - 1
+    return (x[starts], np.minimum.reduceat(vmin, starts),
+            np.maximum.reduceat(vmax, starts), vlast[ends])
+
+# Waveform display widget, with a trace for each pin or variable
+# Follows the latest samples, until panned (mouse drag) or zoomed (wheel);
+# double-click to resume following
+# Traces for variables that aren't in the ring buffer are dropped
+class WaveView(QtWidgets.QWidget):
+    def __init__(self, ring, traces=(), parent=None, rate=pyqt.DISPLAY_RATE):
+        super(WaveView, self).__init__(parent)
+        self.ring = ring
+        self.traces = []
+        for trace in [wave_trace(t) if isinstance(t, str) else t for t in traces]:
+            if trace[1] in ring.cols:
+                self.traces.append(trace)
+            else:
+                print("Warning: no variable %s for trace %s" % (trace[1], trace[0]))
+        self.span, self.end, self.follow = WAVE_SPAN, 0.0, True
+        self.drag_x = None
+        self.count = 0
+        self.render_time = 0.0
+        self.setMinimumHeight(20 * len(self.traces))
+        self.timer = QtCore.QTimer()
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(int(1000 / rate))
+
+    # Timer handler to redraw if following, and there are new samples
+    def refresh(self):
+        if self.follow and self.ring.count != self.count:
+            self.update()
+
+    # Return time of latest sample
+    def latest(self):
+        with self.ring.lock:
+            n = self.ring.count
+            return self.ring.times[(n - 1) % self.ring.capacity] if n else 0.0
+
+    # Return the start & end times of the display, and time per pixel
+    def time_range(self):
+        end = self.latest() if self.follow else self.end
+        wd = max(self.width() - WAVE_LABEL_WD, 1)
+        return end - self.span, end, self.span / wd
+
+    # Return a path for a trace, given the time range, and trace position
+    # Samples from one screen width before the start are included, so the
+    # trace begins at the left edge. Long time ranges use the ring buffer
+    # block summaries, so the work is proportional to the display width
+    # The arrays are copied from the ring buffer while holding its lock
+    def trace_path(self, name, bit, start, end, tpp, top, ht):
+        npoints = int(2 * self.span / tpp)
+        with self.ring.lock:
+            t, mins, maxs, ands, ors, lasts = self.ring.minmax(name, start - self.span,
+                                                               end, npoints)
+        if not len(t):
+            return None
+        if bit is not None:
+            mins, maxs, lasts = (ands >> bit) & 1, (ors >> bit) & 1, (lasts >> bit) & 1
+            lo, hi = 0, 1
+        else:
+            mins, maxs, lasts = [a.astype(np.float64) for a in (mins, maxs, lasts)]
+            lo, hi = mins.min(), maxs.max()
+        scale = ht / float(max(hi - lo, 1))
+        cols, mins, maxs, lasts = minmax_columns(t, mins, maxs, lasts, start, tpp)
+        cols = (cols + WAVE_LABEL_WD).tolist()
+        ymins = (top + ht - (mins - lo) * scale).tolist()
+        ymaxs = (top + ht - (maxs - lo) * scale).tolist()
+        ylasts = (top + ht - (lasts - lo) * scale).tolist()
+        path = QPainterPath()
+        path.moveTo(cols[0], ylasts[0])
+        prev = ylasts[0]
+        for x, ymin, ymax, ylast in zip(cols, ymins, ymaxs, ylasts):
+            path.lineTo(x, prev)
+            path.lineTo(x, ymin)
+            path.lineTo(x, ymax)
+            path.lineTo(x, ylast)
+            prev = ylast
+        return path
+
+    # Draw the traces
+    def paintEvent(self, event):
+        t0 = timer()
+        self.count = self.ring.count
+        p = QPainter(self)
+        p.fillRect(self.rect(), WAVE_BACK)
+        if self.traces:
+            start, end, tpp = self.time_range()
+            ht = self.height() / float(len(self.traces))
+            wd = self.width() - WAVE_LABEL_WD
+            for n, (label, name, bit) in enumerate(self.traces):
+                top = n * ht
+                p.setPen(WAVE_GRID_PEN)
+                p.drawLine(0, int(top + ht), self.width(), int(top + ht))
+                p.setPen(WAVE_LABEL_PEN)
+                p.drawText(QRectF(2, top, WAVE_LABEL_WD - 2, ht),
+                           Qt.AlignVCenter | Qt.AlignLeft, label)
+                path = self.trace_path(name, bit, start, end, tpp,
+                                       top + WAVE_MARGIN, ht - 2*WAVE_MARGIN)
+                if path is not None:
+                    p.save()
+                    p.setClipRect(QRectF(WAVE_LABEL_WD, top, wd, ht))
+                    p.setPen(WAVE_PEN)
+                    p.drawPath(path)
+                    p.restore()
+            p.setPen(WAVE_LABEL_PEN)
+            p.drawText(QRectF(WAVE_LABEL_WD, 0, wd - 2, ht), Qt.AlignTop | Qt.AlignRight,
+                       "%.4g s" % self.span)
+        p.end()
+        self.render_time = timer() - t0
+
+    # Zoom in or out around the mouse position
+    def wheelEvent(self, event):
+        delta = event.angleDelta().y() if hasattr(event, "angleDelta") else event.delta()
+        start, end, tpp = self.time_range()
+        tc = start + max(event.pos().x() - WAVE_LABEL_WD, 0) * tpp
+        factor = WAVE_ZOOM ** (-delta / 120.0)
+        span = max(self.span * factor, WAVE_MIN_SPAN)
+        self.end = tc + (end - tc) * span / self.span
+        self.span, self.follow = span, False
+        self.update()
+
+    # Start dragging to pan the display
+    def mousePressEvent(self, event):
+        self.drag_x = event.pos().x()
+        self.end = self.time_range()[1]
+        self.follow = False
+
+    # Pan the display while dragging
+    def mouseMoveEvent(self, event):
+        if self.drag_x is not None:
+            x = event.pos().x()
+            self.end -= (x - self.drag_x) * self.time_range()[2]
+            self.drag_x = x
+            self.update()
+
+    # End dragging
+    def mouseReleaseEvent(self, event):
+        self.drag_x = None
+
+    # Resume following the latest samples
+    def mouseDoubleClickEvent(self, event):
+        self.span, self.follow = WAVE_SPAN, True
+        self.update()
+
+if __name__ == "__main__":
+    import rp_ring
+    nsamp = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    ring = rp_ring.SampleRing(["PB", "T"], nsamp)
+    t = np.arange(0, nsamp) * 1e-5
+    vals = np.zeros((nsamp, 2), np.uint32)
+    vals[:, 0] = np.arange(0, nsamp) >> 3
+    vals[:, 1] = (np.sin(t * 20) * 1000 + 1000).astype(np.uint32)
+    ring.times[:], ring.values[:], ring.valid[:] = t, vals, True
+    ring.count = nsamp
+    app = QtWidgets.QApplication(sys.argv)
+    view = WaveView(ring, ["PB0", "PB1", "PB8", "T"])
+    view.span = t[-1]
+    view.resize(800, 300)
+    view.show()
+    app.exec_()
+    print("Render time %.1f ms" % (view.render_time * 1000))
+
+# EOF
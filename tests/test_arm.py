@@ -0,0 +1,404 @@
+# Unit tests of CPU memory access & polling for Iosoft Reporta project
+# Uses the emulated device & target, with WAIT responses at a given rate
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest, time
+import rp_arm as arm, rp_swd as swd, rp_ftd2xx as driver
+try:
+    import Queue
+except:
+    import queue as Queue
+
+TEST_ADDR   = 0x20001000        # Emulated SRAM without simulated activity
+WAIT_PROB   = 0.05              # Probability of a WAIT for each AP access
+
+# Open an emulated probe, and start up the SWD interface
+def emu_probe(wait_prob=0.0, config=True):
+    driver.EMULATE = True
+    d = arm.open()
+    driver.spi_init(d)
+    swd.swd_reset(d)
+    arm.cpu_swd_start(d)
+    if config:
+        arm.ap_config(d, 32)
+    d.target.wait_prob = wait_prob
+    return d
+
+# Return a list of words from the emulated target memory
+def target_words(d, addr, nwords):
+    return [d.target.mem.read32(addr + n*4) for n in range(0, nwords)]
+
+class MemBlockTest(unittest.TestCase):
+    def setUp(self):
+        self.d = emu_probe(WAIT_PROB)
+
+    def tearDown(self):
+        driver.close(self.d)
+
+    # Block write & read, across 1K boundaries, with WAIT responses replayed
+    # and the group size reduced to suit the WAIT rate
+    def test_write_read(self):
+        vals = [(n * 0x01010101 + 7) & 0xffffffff for n in range(0, 1500)]
+        self.assertEqual(arm.cpu_mem_write_block(self.d, TEST_ADDR + 0x40, vals), [])
+        self.assertEqual(target_words(self.d, TEST_ADDR + 0x40, len(vals)), vals)
+        data = arm.cpu_mem_read_block(self.d, TEST_ADDR + 0x40, len(vals))
+        self.assertIsNotNone(data)
+        self.assertEqual(list(data), vals)
+        self.assertLess(self.d.mem_group, arm.MEM_GROUP_WORDS)
+
+    # A large block read completes, rather than replaying the whole batch
+    def test_large_read(self):
+        vals = list(range(0, 3000))
+        for n, val in enumerate(vals):
+            self.d.target.mem.write32(TEST_ADDR + n*4, val)
+        data = arm.cpu_mem_read_block(self.d, TEST_ADDR, len(vals))
+        self.assertIsNotNone(data)
+        self.assertEqual(list(data), vals)
+
+    # Sampling reads the same address repeatedly, with WAIT responses
+    # replayed at that address, and CSW restored afterwards
+    def test_sample(self):
+        csw = self.d.csw.value
+        self.d.target.mem.write32(TEST_ADDR, 0x12345678)
+        data = arm.cpu_mem_sample(self.d, TEST_ADDR, 300)
+        self.assertGreater(len(data), 0)
+        self.assertEqual(set(data), set([0x12345678]))
+        self.assertEqual(self.d.csw.value, csw)
+
+    # The CSW value set by ap_config is restored after a block transfer
+    def test_csw_restored(self):
+        csw = self.d.csw.value
+        arm.cpu_mem_read_block(self.d, TEST_ADDR, 10)
+        self.assertEqual(self.d.csw.value, csw)
+        self.assertEqual(self.d.target.csw & 0x37, csw & 0x37)
+
+    # If CSW was never configured, it isn't set to byte accesses afterwards
+    def test_csw_unconfigured(self):
+        driver.close(self.d)
+        self.d = emu_probe(0.0, False)
+        arm.cpu_mem_write_block(self.d, TEST_ADDR, [1, 2, 3])
+        self.assertEqual(self.d.target.csw & 7, 2)
+        self.assertEqual(arm.cpu_mem_read32(self.d, TEST_ADDR + 4), 2)
+
+class NoOverrunTest(unittest.TestCase):
+    def setUp(self):
+        self.orun = arm.ORUN_DETECT
+        arm.ORUN_DETECT = False
+        self.d = emu_probe()
+
+    def tearDown(self):
+        driver.close(self.d)
+        arm.ORUN_DETECT = self.orun
+
+    # Without overrun detection, reads after a WAIT aren't trusted, so a
+    # block read with WAITs returns the correct values
+    def test_read(self):
+        vals = list(range(1000, 1600))
+        arm.cpu_mem_write_block(self.d, TEST_ADDR, vals)
+        self.d.target.wait_prob = WAIT_PROB
+        for n in range(0, 5):
+            data = arm.cpu_mem_read_block(self.d, TEST_ADDR, len(vals))
+            self.assertIsNotNone(data)
+            self.assertEqual(list(data), vals)
+
+class ShadowTest(unittest.TestCase):
+    def setUp(self):
+        self.d = emu_probe()
+
+    def tearDown(self):
+        driver.close(self.d)
+
+    # Return the number of SWD transactions done by a function
+    def transactions(self, func, *args):
+        n = self.d.target.transactions
+        func(*args)
+        return self.d.target.transactions - n
+
+    # Writes that don't change a register are skipped
+    def test_skip(self):
+        self.assertEqual(self.transactions(arm.ap_config, self.d, 32), 0)
+        self.assertEqual(self.transactions(arm.ap_bank_select, self.d, 0), 0)
+        self.assertEqual(self.transactions(arm.ap_addr, self.d, TEST_ADDR), 1)
+        self.assertEqual(self.transactions(arm.ap_addr, self.d, TEST_ADDR), 0)
+        self.assertEqual(self.transactions(arm.ap_config, self.d, 16), 1)
+
+    # TAR tracks auto-increment, wrapping within a 1K block
+    def test_drw_access(self):
+        sh = arm.ApShadow()
+        sh.csw, sh.tar = 0x12, TEST_ADDR + 0x3f8
+        sh.drw_access(3)
+        self.assertEqual(sh.tar, TEST_ADDR + 4)
+        sh.csw = 0x02
+        sh.drw_access(3)
+        self.assertEqual(sh.tar, TEST_ADDR + 4)
+        sh.csw = None
+        sh.drw_access(1)
+        self.assertIsNone(sh.tar)
+
+    # A fixed variable is polled with a DRW & RDBUFF read, without TAR
+    def test_poll(self):
+        arm.poll_add_var(self.d, "V", TEST_ADDR)
+        self.d.target.mem.write32(TEST_ADDR, 1234)
+        for n in range(0, 3):
+            arm.poll_send_requests(self.d)
+            self.assertEqual(arm.poll_get_responses(self.d).values, [1234])
+        self.assertEqual(self.transactions(arm.poll_send_requests, self.d), 0)
+        self.assertEqual(self.transactions(arm.poll_get_responses, self.d), 2)
+
+    # If there is no response, the register values are unknown
+    def test_no_response(self):
+        read_bytes = driver.spi_read_bytes
+        driver.spi_read_bytes = lambda d, nbytes: bytearray()
+        try:
+            arm.ap_bank_select(self.d, 1)
+            arm.ap_config(self.d, 16)
+            arm.ap_addr(self.d, TEST_ADDR)
+        finally:
+            driver.spi_read_bytes = read_bytes
+        self.assertEqual((self.d.shadow.select, self.d.shadow.csw, self.d.shadow.tar),
+                         (None, None, None))
+
+class PollScheduleTest(unittest.TestCase):
+    def setUp(self):
+        self.d = arm.Probe(None)
+
+    # Each variable is polled at its own rate, highest priority first
+    def test_rates(self):
+        arm.poll_add_var(self.d, "A", TEST_ADDR, rate=100)
+        arm.poll_add_var(self.d, "B", TEST_ADDR + 4, rate=10, priority=1)
+        self.assertEqual([pv.name for pv in arm.poll_due_vars(self.d, 0.0)], ["B", "A"])
+        counts = {"A": 1, "B": 1}
+        for n in range(1, 1000):
+            for pv in arm.poll_due_vars(self.d, n * 0.001 + 1e-6):
+                counts[pv.name] += 1
+        self.assertEqual(counts, {"A": 100, "B": 10})
+
+    # If too many variables are due, the lowest priority are left until
+    # the next cycle
+    def test_maxvars(self):
+        for n in range(0, 3):
+            arm.poll_add_var(self.d, "P%u" % n, TEST_ADDR + n*4, priority=n)
+        self.assertEqual([pv.name for pv in arm.poll_due_vars(self.d, 0.0, 2)], ["P2", "P1"])
+        self.assertEqual([pv.name for pv in arm.poll_due_vars(self.d, 0.0, 2)], ["P0"])
+
+    # Missed samples are skipped, rather than polled in a burst
+    def test_missed(self):
+        arm.poll_add_var(self.d, "A", TEST_ADDR, rate=100)
+        arm.poll_due_vars(self.d, 0.0)
+        self.assertEqual(len(arm.poll_due_vars(self.d, 1.0)), 1)
+        self.assertAlmostEqual(arm.poll_next_due(self.d), 1.01)
+        self.assertEqual(arm.poll_due_vars(self.d, 1.005), [])
+
+class EmuPollTest(unittest.TestCase):
+    def setUp(self):
+        self.d = emu_probe()
+        self.vals = [0x44332211, 0x88776655, 0xCCBBAA99]
+        for n, val in enumerate(self.vals):
+            self.d.target.mem.write32(TEST_ADDR + n*8, val)
+            arm.poll_add_var(self.d, "V%u" % n, TEST_ADDR + n*8)
+
+    def tearDown(self):
+        driver.close(self.d)
+
+    # A poll cycle returns the value of each variable
+    def test_sync(self):
+        arm.poll_send_requests(self.d)
+        batch = arm.poll_get_responses(self.d)
+        self.assertEqual(batch.values, self.vals)
+        self.assertEqual([pv.value for pv in self.d.poll_vars], self.vals)
+
+    # Pipelined cycles are completed in order, leaving depth-1 in flight
+    def test_pipeline(self):
+        batches = []
+        for n in range(0, 50):
+            batches += arm.poll_pipeline(self.d, None, 3)
+            self.assertEqual(len(self.d.poll_pending), min(n + 1, 2))
+        batches += arm.poll_drain(self.d)
+        self.assertEqual(len(batches), 50)
+        cycles = [b.cycle for b in batches]
+        self.assertEqual(cycles, list(range(cycles[0], cycles[0] + 50)))
+        for b in batches:
+            self.assertEqual(b.values, self.vals)
+
+    # With WAITs, the batches are replayed, so a value is either correct,
+    # or None if the read failed after retries
+    def test_wait(self):
+        self.d.target.wait_prob = WAIT_PROB
+        batches = []
+        for n in range(0, 50):
+            arm.poll_send_requests(self.d)
+            batches.append(arm.poll_get_responses(self.d))
+        for n in range(0, 50):
+            batches += arm.poll_pipeline(self.d, None, 3)
+        batches += arm.poll_drain(self.d)
+        nvalues = 0
+        for b in batches:
+            for val, exp in zip(b.values, self.vals):
+                self.assertIn(val, (exp, None))
+                nvalues += val is not None
+        self.assertGreater(nvalues, 250)
+
+class PollPlanTest(unittest.TestCase):
+    # Return a plan for variables given as (address, size)
+    def plan(self, *addrs):
+        return arm.PollPlan([arm.Pollvar("V%u" % n, a, size=s)
+                             for n, (a, s) in enumerate(addrs)])
+
+    # Variables in the same word share a single read
+    def test_same_word(self):
+        p = self.plan((TEST_ADDR, 1), (TEST_ADDR + 1, 1), (TEST_ADDR + 2, 2))
+        self.assertEqual(p.runs, [(TEST_ADDR, 1)])
+        self.assertEqual(sorted(p.slots.values()), [(0, 0)] * 3)
+        self.assertFalse(p.inc)
+
+    # Adjacent words, and words with a small gap in SRAM, are merged
+    def test_adjacent(self):
+        p = self.plan((TEST_ADDR + 8, 4), (TEST_ADDR, 4), (TEST_ADDR + 4, 4))
+        self.assertEqual(p.runs, [(TEST_ADDR, 3)])
+        p = self.plan((TEST_ADDR, 4), (TEST_ADDR + 4 + 4*arm.POLL_GAP_WORDS, 4))
+        self.assertEqual(p.runs, [(TEST_ADDR, 2 + arm.POLL_GAP_WORDS)])
+        self.assertTrue(p.inc)
+
+    # Gaps aren't read in peripheral space, or past the largest gap
+    def test_gaps(self):
+        p = self.plan((arm.GPIOB, 4), (arm.GPIOB + 8, 4))
+        self.assertEqual(p.runs, [(arm.GPIOB, 1), (arm.GPIOB + 8, 1)])
+        gap = 4 * (arm.POLL_GAP_WORDS + 2)
+        p = self.plan((TEST_ADDR, 4), (TEST_ADDR + gap, 4))
+        self.assertEqual(p.runs, [(TEST_ADDR, 1), (TEST_ADDR + gap, 1)])
+
+    # A run doesn't cross a 1K boundary, as the TAR increment wraps
+    def test_wrap(self):
+        p = self.plan((TEST_ADDR + 0x3fc, 4), (TEST_ADDR + 0x400, 4))
+        self.assertEqual(p.runs, [(TEST_ADDR + 0x3fc, 1), (TEST_ADDR + 0x400, 1)])
+
+    # Plans are cached for a set of variables
+    def test_cache(self):
+        d = emu_probe()
+        arm.poll_add_var(d, "A", TEST_ADDR)
+        arm.poll_add_var(d, "B", TEST_ADDR + 4)
+        p = arm.poll_plan(d, d.poll_vars)
+        self.assertIs(arm.poll_plan(d, list(reversed(d.poll_vars))), p)
+        driver.close(d)
+
+class EmuSubwordTest(unittest.TestCase):
+    def setUp(self):
+        self.d = emu_probe(WAIT_PROB)
+        self.d.target.mem.write32(TEST_ADDR, 0x44332211)
+        self.d.target.mem.write32(TEST_ADDR + 4, 0x88776655)
+        self.d.target.mem.write32(TEST_ADDR + 12, 0xCCBBAA99)
+        for name, addr, size in (("B1", TEST_ADDR + 1, 1), ("H2", TEST_ADDR + 2, 2),
+                                 ("W1", TEST_ADDR + 4, 4), ("BAD", 0x30000000, 4),
+                                 ("B12", TEST_ADDR + 12, 1)):
+            arm.poll_add_var(self.d, name, addr, size=size)
+        self.expect = [0x22, 0x4433, 0x88776655, None, 0x99]
+
+    def tearDown(self):
+        driver.close(self.d)
+
+    # Values are extracted from the merged reads; with WAITs, a value is
+    # either correct, or None if the read failed after retries
+    def check(self, batches):
+        nvalues = 0
+        for batch in batches:
+            for val, exp in zip(batch.values, self.expect):
+                self.assertIn(val, (exp, None))
+                nvalues += val is not None
+        return nvalues
+
+    # Sub-word variables are extracted from single poll cycles
+    def test_sync(self):
+        batches = []
+        for n in range(0, 50):
+            arm.poll_send_requests(self.d)
+            batches.append(arm.poll_get_responses(self.d))
+        self.assertGreater(self.check(batches), 150)
+
+    # Sub-word variables are extracted from pipelined cycles, completed in order
+    def test_pipeline(self):
+        batches = []
+        for n in range(0, 50):
+            batches += arm.poll_pipeline(self.d, None, 3)
+        batches += arm.poll_drain(self.d)
+        self.assertEqual(len(batches), 50)
+        self.assertEqual(sorted([b.cycle for b in batches]), [b.cycle for b in batches])
+        self.assertGreater(self.check(batches), 150)
+
+class EmuIoWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.d = emu_probe()
+        self.vals = [0x11111111, 0x22222222]
+        for n, val in enumerate(self.vals):
+            self.d.target.mem.write32(TEST_ADDR + n*4, val)
+            arm.poll_add_var(self.d, "V%u" % n, TEST_ADDR + n*4)
+        self.worker = None
+
+    def tearDown(self):
+        if self.worker:
+            self.worker.stop()
+        driver.close(self.d)
+
+    # Start a worker thread on the emulated device
+    def start(self, ringsize=driver.IO_RING_SIZE):
+        self.worker = driver.IoWorker(self.d, ringsize)
+        self.worker.start()
+
+    # Batches submitted to the worker are returned in order, with their values
+    def test_poll(self):
+        self.start()
+        sent = [arm.poll_submit(self.d, self.worker) for n in range(0, 20)]
+        for batch in sent:
+            got = arm.poll_collect(self.worker, 1.0)
+            self.assertIs(got, batch)
+            self.assertEqual(got.values, self.vals)
+
+    # With WAITs, replays are sent through the worker, and the batches
+    # are still returned in order
+    def test_poll_wait(self):
+        self.d.target.wait_prob = WAIT_PROB
+        self.start()
+        sent = [arm.poll_submit(self.d, self.worker) for n in range(0, 50)]
+        nvalues = 0
+        for batch in sent:
+            got = arm.poll_collect(self.worker, 1.0)
+            self.assertIs(got, batch)
+            for val, exp in zip(got.values, self.vals):
+                self.assertIn(val, (exp, None))
+                nvalues += val is not None
+        self.assertGreater(nvalues, 80)
+
+    # If the decoder falls behind, no more than the ring size is read ahead
+    def test_bounded(self):
+        self.start(2)
+        for n in range(0, 6):
+            arm.poll_submit(self.d, self.worker)
+        time.sleep(0.1)
+        self.assertEqual(self.worker.rxq.qsize(), 2)
+        for n in range(0, 6):
+            self.assertEqual(arm.poll_collect(self.worker, 1.0).values, self.vals)
+        self.assertRaises(Queue.Empty, self.worker.get, 0.01)
+
+    # Stopping the worker discards unread responses
+    def test_stop(self):
+        self.start(1)
+        for n in range(0, 4):
+            arm.poll_submit(self.d, self.worker)
+        self.worker.stop()
+        self.assertFalse(self.worker.is_alive())
+        self.worker = None
+
+if __name__ == "__main__":
+    unittest.main()
+
+# EOF
@@ -0,0 +1,121 @@
+# Unit tests of capture file recording & replay for Iosoft Reporta project
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest, os, shutil, random, tempfile
+import numpy as np
+import rp_capture
+
+TEST_CHUNK  = 64                # Records per chunk, so there are several
+
+# Class for a poll variable & batch, with the attributes used for capture
+class FakeVar(object):
+    def __init__(self, name, addr):
+        self.name, self.addr = name, addr
+class FakeBatch(object):
+    def __init__(self, t, pvs, values):
+        self.time, self.pvs, self.values = t, pvs, values
+
+class CaptureTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, "test.rpc")
+        self.pvs = [FakeVar("PB", 0x40010C08), FakeVar("ticks", 0x20000000),
+                    FakeVar(u"state.pts[12].a_long_member_name_\u00b0C", 0x20000104)]
+        rand = random.Random(1)
+        self.rows = []
+        for n in range(0, 1000):
+            vals = [None if rand.random() < 0.05 else rand.choice((0, 0xffffffff,
+                    n, rand.getrandbits(32))) for pv in self.pvs]
+            self.rows.append((1000.0 + n * 0.001, vals))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    # Write the rows to a capture file; close it unless it is to be truncated
+    def write(self, close=True):
+        w = rp_capture.CaptureWriter(self.fname, self.pvs, TEST_CHUNK)
+        for t, vals in self.rows:
+            w.add_batch(FakeBatch(t, self.pvs, vals))
+        if close:
+            w.close()
+        else:
+            w.flush()
+            w.f.close()
+
+    # Check the values read from a capture file
+    def check(self, times, values, valid, rows):
+        self.assertEqual(len(times), len(rows))
+        self.assertTrue(np.allclose(times, [r[0] for r in rows], atol=1e-6))
+        self.assertEqual(valid.tolist(), [[v is not None for v in r[1]] for r in rows])
+        self.assertEqual(np.where(valid, values, 0).tolist(),
+                         [[v or 0 for v in r[1]] for r in rows])
+
+    # Names (including long and non-ASCII names), addresses & values are
+    # read back as written
+    def test_round_trip(self):
+        self.write()
+        r = rp_capture.CaptureReader(self.fname)
+        self.assertEqual(r.names, [pv.name for pv in self.pvs])
+        self.assertEqual(r.addrs, [pv.addr for pv in self.pvs])
+        self.assertGreater(len(r), 1)
+        self.check(*(r.read() + (self.rows,)))
+        r.close()
+
+    # A time range only returns the records in that range
+    def test_time_range(self):
+        self.write()
+        r = rp_capture.CaptureReader(self.fname)
+        start, end = r.time_range()
+        self.assertAlmostEqual(start, self.rows[0][0], 5)
+        self.assertAlmostEqual(end, self.rows[-1][0], 5)
+        t0, t1 = self.rows[300][0], self.rows[450][0]
+        self.check(*(r.read(t0 - 1e-7, t1 - 1e-7) + (self.rows[300:450],)))
+        r.close()
+
+    # If the file isn't closed, the index is rebuilt from the chunks
+    def test_unclosed(self):
+        self.write(False)
+        r = rp_capture.CaptureReader(self.fname)
+        self.check(*(r.read() + (self.rows,)))
+        r.close()
+
+    # Replay emits the name & value for each change, None if invalid
+    def test_replay(self):
+        self.write()
+        r = rp_capture.CaptureReader(self.fname)
+        out = []
+        rp_capture.capture_replay(r, lambda name, val: out.append((name, val)), speed=0)
+        r.close()
+        expect, last = [], {}
+        for t, vals in self.rows:
+            for pv, val in zip(self.pvs, vals):
+                if pv.name not in last or last[pv.name] != val:
+                    if pv.name in last or val is not None:
+                        expect.append((pv.name, val))
+                    last[pv.name] = val
+        self.assertEqual(out, expect)
+
+    # An empty or truncated file gives a clear error
+    def test_empty(self):
+        for data in (b"", rp_capture.CAPTURE_MAGIC):
+            with open(self.fname, "wb") as f:
+                f.write(data)
+            with self.assertRaises(ValueError) as cm:
+                rp_capture.CaptureReader(self.fname)
+            self.assertIn("Empty capture file", str(cm.exception))
+
+if __name__ == "__main__":
+    unittest.main()
+
+# EOF
@@ -0,0 +1,104 @@
+# Unit tests of the headless command-line interface for Iosoft Reporta project
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os, sys, json, tempfile, shutil, subprocess, unittest
+import rp_arm as arm, rp_ftd2xx as driver, rp_cli
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Class for a poll variable & batch, with the attributes used by the writer
+class FakeVar(object):
+    def __init__(self, name):
+        self.name = name
+class FakeBatch(object):
+    def __init__(self, t, pvs, values):
+        self.time, self.pvs, self.values = t, pvs, values
+
+class ParseTest(unittest.TestCase):
+    # Addresses are hex, with or without 0x; ports need no address
+    def test_parse(self):
+        self.assertEqual(rp_cli.parse_var("X=20001000"), ("X", 0x20001000, arm.POLL_RATE))
+        self.assertEqual(rp_cli.parse_var("X=0x20001000@50"), ("X", 0x20001000, 50.0))
+        self.assertEqual(rp_cli.parse_var("20000010", 10), ("20000010", 0x20000010, 10))
+        self.assertEqual(rp_cli.parse_var("pb@20"), ("PB", arm.GPIOB+arm.GPIO_IDR, 20.0))
+        self.assertRaises(ValueError, rp_cli.parse_var, "X=2000zz")
+
+    # A name without an address is an ELF variable
+    def test_parse_elf(self):
+        self.assertEqual(rp_cli.parse_var("state.pts[1]@5"), ("state.pts[1]", None, 5.0))
+        self.assertEqual(rp_cli.parse_var("pa"), ("PA", arm.GPIOA+arm.GPIO_IDR, arm.POLL_RATE))
+        self.assertRaises(SystemExit, rp_cli.main, ["-e", "state"])
+
+class WriterTest(unittest.TestCase):
+    def setUp(self):
+        self.lines = []
+        self.f = self
+        self.pvs = [FakeVar("B"), FakeVar("A")]
+
+    # File write & flush, storing the lines
+    def write(self, s):
+        self.lines.append(s)
+    def flush(self):
+        pass
+
+    # CSV has a header, and a column for each variable, empty if failed
+    def test_csv(self):
+        w = rp_cli.SampleWriter(self, ["A", "B"])
+        w.write([FakeBatch(1.5, self.pvs, [7, None]), FakeBatch(2.0, self.pvs[:1], [8])])
+        self.assertEqual(self.lines, ["time,A,B\n", "1.500000,,7\n", "2.000000,,8\n"])
+
+    # JSON has the polled variables, null if failed
+    def test_json(self):
+        w = rp_cli.SampleWriter(self, ["A", "B"], "json")
+        w.write([FakeBatch(1.5, self.pvs, [7, None])])
+        self.assertEqual([json.loads(s) for s in self.lines], [dict(time=1.5, B=7, A=None)])
+
+class EmuCliTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.addCleanup(setattr, driver, "EMULATE", driver.EMULATE)
+
+    # Polling the emulated probe gives a line per poll cycle
+    def test_main(self):
+        fname = os.path.join(self.dir, "out.csv")
+        self.assertEqual(rp_cli.main(["-e", "-n", "20", "-o", fname,
+                                      "PB@1000", "T=20001000@1000"]), 0)
+        with open(fname) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], "time,PB,T")
+        self.assertGreaterEqual(len(lines), 21)
+        times = [float(s.split(",")[0]) for s in lines[1:]]
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(lines[1].split(",")[2], "0")
+
+    # reporta.py hands over to the CLI before PyQt is imported
+    def test_headless(self):
+        code = ("import sys, runpy; sys.argv = ['reporta.py', '--headless', '-e', "
+                "'-n', '5', '-f', 'json']\n"
+                "try:\n    runpy.run_path('reporta.py', run_name='__main__')\n"
+                "except SystemExit:\n    pass\n"
+                "sys.stderr.write('PyQt %s' % any(m.startswith('PyQt') for m in sys.modules))")
+        p = subprocess.Popen([sys.executable, "-c", code], cwd=TOP_DIR,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        lines = out.decode().splitlines()
+        self.assertGreaterEqual(len(lines), 5)
+        self.assertIn("PB", json.loads(lines[0]))
+        self.assertTrue(err.decode().endswith("PyQt False"))
+
+if __name__ == "__main__":
+    unittest.main()
+
+# EOF
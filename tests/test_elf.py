@@ -0,0 +1,191 @@
+# Unit tests of the ELF variable index for Iosoft Reporta project
+# A minimal ELF file is created with a symbol table; DWARF types are
+# added to the index directly
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest, os, json, shutil, struct, tempfile
+import rp_elf, rp_arm as arm, rp_swd as swd, rp_ftd2xx as driver
+
+EM_ARM      = 40                # ELF machine type
+SHT_STRTAB  = 3                 # Section type: string table
+
+# Symbols in the test file: name, address, size, type
+TEST_SYMS   = [("main", 0x08000201, 0x40, rp_elf.STT_FUNC),
+               ("counter", 0x20000000, 4, rp_elf.STT_OBJECT),
+               ("words", 0x20000010, 12, rp_elf.STT_OBJECT),
+               ("bytes", 0x20000020, 6, rp_elf.STT_OBJECT),
+               ("half", 0x20000028, 2, rp_elf.STT_OBJECT)]
+
+# Write a 32-bit little-endian ELF file with a symbol table of local
+# symbols, preceded by a source file symbol; the string table also holds
+# the section names
+def make_elf(fname, syms):
+    strtab, names = b"\0", []
+    for name in ["test.c"] + [s[0] for s in syms]:
+        names.append(len(strtab))
+        strtab += name.encode("utf-8") + b"\0"
+    symtab = struct.pack(rp_elf.ELF_SYM_FMT, 0, 0, 0, 0, 0, 0)
+    symtab += struct.pack(rp_elf.ELF_SYM_FMT, names[0], 0, 0, rp_elf.STT_FILE, 0, 0xfff1)
+    for (name, addr, size, typ), n in zip(syms, names[1:]):
+        symtab += struct.pack(rp_elf.ELF_SYM_FMT, n, addr, size, typ, 0, 1)
+    hlen, slen = struct.calcsize(rp_elf.ELF_HDR_FMT), struct.calcsize(rp_elf.ELF_SHDR_FMT)
+    stroff = hlen
+    symoff = (stroff + len(strtab) + 3) & ~3
+    shoff = symoff + len(symtab)
+    ident = rp_elf.ELF_MAGIC + b"\x01\x01\x01" + b"\0" * 9
+    data = struct.pack(rp_elf.ELF_HDR_FMT, ident, 2, EM_ARM, 1, 0, 0, shoff, 0,
+                       hlen, 0, 0, slen, 3, 2)
+    data += strtab + b"\0" * (symoff - stroff - len(strtab)) + symtab
+    data += struct.pack(rp_elf.ELF_SHDR_FMT, *([0] * 10))
+    data += struct.pack(rp_elf.ELF_SHDR_FMT, 0, rp_elf.SHT_SYMTAB, 0, 0, symoff,
+                        len(symtab), 2, 2, 4, struct.calcsize(rp_elf.ELF_SYM_FMT))
+    data += struct.pack(rp_elf.ELF_SHDR_FMT, 0, SHT_STRTAB, 0, 0, stroff,
+                        len(strtab), 0, 0, 1, 0)
+    with open(fname, "wb") as f:
+        f.write(data)
+
+class ElfTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, "test.elf")
+        make_elf(self.fname, TEST_SYMS)
+        self.index = rp_elf.ElfIndex(self.fname, None)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    # Add DWARF-style types to the index: a struct with an array of
+    # structs, and an 8-byte value
+    def add_types(self):
+        types = self.index.types = [["b", 4, 7], ["b", 2, 5], ["b", 8, 4]]
+        types.append(["s", 6, [["x", 0, 1], ["y", 2, 1], ["z", 4, 1]]])
+        types.append(["a", 18, 3, 3])
+        types.append(["s", 32, [["count", 0, 0], ["pts", 4, 4], ["total", 24, 2]]])
+        self.index.vars["state"] = [0x20000100, 5]
+
+    # Symbols are read, with the function address Thumb bit cleared
+    def test_symbols(self):
+        funcs = self.index.symbols(rp_elf.STT_FUNC)
+        self.assertEqual([(s.name, s.addr, s.fname) for s in funcs.syms],
+                         [("main", 0x08000200, "test.c")])
+        self.assertEqual(funcs.symbol(0x08000210).name, "main")
+        self.assertEqual(sorted(self.index.vars), ["bytes", "counter", "half", "words"])
+
+    # Without debug information, variables are expanded by symbol size
+    def test_expand_symbols(self):
+        self.assertEqual(self.index.expand("counter"), [("counter", 0x20000000, 4)])
+        self.assertEqual(self.index.expand("words"), [("words[%u]" % n, 0x20000010 + n*4, 4)
+                                                      for n in range(0, 3)])
+        self.assertEqual(len(self.index.expand("bytes")), 6)
+        self.assertEqual(self.index.expand("bytes[5]"), [("bytes[5]", 0x20000025, 1)])
+        self.assertEqual(self.index.expand("half"), [("half", 0x20000028, 2)])
+
+    # Structs & arrays are expanded into their base-type items
+    def test_expand_types(self):
+        self.add_types()
+        items = self.index.expand("state")
+        self.assertEqual(len(items), 1 + 9 + 1)
+        self.assertEqual(items[0], ("state.count", 0x20000100, 4))
+        self.assertEqual(items[1], ("state.pts[0].x", 0x20000104, 2))
+        self.assertEqual(items[9], ("state.pts[2].z", 0x20000104 + 12 + 4, 2))
+        self.assertEqual(items[10], ("state.total", 0x20000118, 8))
+        self.assertEqual(self.index.expand("state.pts[1]"),
+                         [("state.pts[1].%s" % m, 0x2000010A + n*2, 2)
+                          for n, m in enumerate("xyz")])
+        self.assertRaises(ValueError, self.index.expand, "state", 5)
+
+    # Invalid names & selectors raise ValueError
+    def test_resolve_errors(self):
+        self.add_types()
+        for path in ("nothing", "state.nothing", "state.pts[3]", "state.count.x",
+                     "state.pts[1]x", "state..count", "state-pts", " state", ""):
+            self.assertRaises(ValueError, self.index.resolve, path)
+
+    # Polling a symbol splits items larger than a word
+    def test_poll_symbol(self):
+        self.add_types()
+        h = arm.Probe(None)
+        pvs = arm.poll_add_symbol(h, self.index, "state.total")
+        self.assertEqual([(pv.name, pv.addr) for pv in pvs],
+                         [("state.total", 0x20000118), ("state.total+4", 0x2000011C)])
+
+    # The index is cached, and rebuilt if pyelftools availability changes
+    def test_cache(self):
+        cache = os.path.join(self.dir, "cache")
+        elftools = rp_elf.ELFFile
+        try:
+            rp_elf.ELFFile = None
+            rp_elf.ElfIndex(self.fname, cache)
+            cname = os.path.join(cache, rp_elf.elf_hash(self.fname) + ".json")
+            with open(cname) as f:
+                self.assertFalse(json.load(f)["elftools"])
+            rp_elf.ELFFile = elftools
+            index = rp_elf.ElfIndex(self.fname, cache)
+            self.assertEqual(sorted(index.vars), sorted(self.index.vars))
+            with open(cname) as f:
+                self.assertEqual(json.load(f)["elftools"], elftools is not None)
+        finally:
+            rp_elf.ELFFile = elftools
+
+class EmuElfTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, "test.elf")
+        make_elf(self.fname, TEST_SYMS)
+        self.index = rp_elf.ElfIndex(self.fname, None)
+        driver.EMULATE = True
+        self.d = arm.open()
+        driver.spi_init(self.d)
+        swd.swd_reset(self.d)
+        arm.cpu_swd_start(self.d)
+        arm.ap_config(self.d, 32)
+
+    def tearDown(self):
+        driver.close(self.d)
+        shutil.rmtree(self.dir)
+
+    # The words of an array are polled as one block from the emulated
+    # target, and the values are returned in variable order
+    def test_poll(self):
+        vals = [0x11111111, 0x22222222, 0x33333333]
+        for n, val in enumerate(vals):
+            self.d.target.mem.write32(0x20000010 + n*4, val)
+        pvs = arm.poll_add_symbol(self.d, self.index, "words")
+        arm.poll_add_var(self.d, "PB", arm.GPIOB+arm.GPIO_IDR)
+        batches = []
+        for n in range(0, 5):
+            batches += arm.poll_pipeline(self.d, None, 2)
+        batches += arm.poll_drain(self.d)
+        self.assertEqual(batches[0].plan.runs, [(0x20000010, 3), (arm.GPIOB+arm.GPIO_IDR, 1)])
+        self.assertEqual([pv.name for pv in batches[0].pvs][:3], ["words[0]", "words[1]", "words[2]"])
+        for b in batches:
+            self.assertEqual(b.values[:3], vals)
+            self.assertIsNotNone(b.values[3])
+
+    # Byte & halfword items are extracted from a single read of their words
+    def test_poll_bytes(self):
+        self.d.target.mem.write32(0x20000020, 0x44332211)
+        self.d.target.mem.write32(0x20000024, 0x88776655)
+        self.d.target.mem.write32(0x20000028, 0xCCBB1234)
+        arm.poll_add_symbol(self.d, self.index, "bytes")
+        arm.poll_add_symbol(self.d, self.index, "half")
+        arm.poll_send_requests(self.d)
+        batch = arm.poll_get_responses(self.d)
+        self.assertEqual(batch.plan.runs, [(0x20000020, 3)])
+        self.assertEqual(batch.values, [0x11, 0x22, 0x33, 0x44, 0x55, 0x66, 0x1234])
+
+if __name__ == "__main__":
+    unittest.main()
+
+# EOF
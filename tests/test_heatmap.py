@@ -0,0 +1,101 @@
+# Unit tests of the RAM activity heatmap for Iosoft Reporta project
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os, unittest
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+import numpy as np
+import rp_arm as arm, rp_swd as swd, rp_ftd2xx as driver, rp_pyqt as pyqt, rp_heatmap
+
+APP = pyqt.QtWidgets.QApplication.instance() or pyqt.QtWidgets.QApplication([])
+
+TEST_SIZE   = 1024              # Size of region (bytes)
+TEST_WIDTH  = 16                # Words in each row of the image
+TEST_CHUNK  = 64                # Words read in each chunk
+TEST_RATE   = 1e6               # Read rate, so every chunk is due
+
+class UpdateTest(unittest.TestCase):
+    def setUp(self):
+        self.heat = rp_heatmap.RamHeat(0x20000000, TEST_SIZE, TEST_WIDTH, chunk=TEST_CHUNK)
+
+    # The first read of a word is only stored, later changes are counted
+    def test_update(self):
+        data = np.arange(0, 8, dtype=np.uint32)
+        self.assertEqual(self.heat.update(data.tobytes(), 8), 0)
+        data[2] = 99
+        self.assertEqual(self.heat.update(data, 8), 1)
+        self.assertEqual(self.heat.update(data, 8), 0)
+        self.assertEqual(self.heat.counts[8:16].tolist(), [0, 0, 1, 0, 0, 0, 0, 0])
+        self.assertAlmostEqual(float(self.heat.heat[10]), self.heat.decay)
+        self.assertEqual(self.heat.update(None, 8), 0)
+        self.assertEqual((self.heat.reads, self.heat.failed), (3, 1))
+        self.heat.reset()
+        self.assertFalse(self.heat.counts.any())
+
+    # The image wraps the pixel buffer, with the background colour for
+    # words that have never changed
+    def test_render(self):
+        data = np.zeros(4, np.uint32)
+        self.heat.update(data)
+        self.heat.update(data + 1)
+        image = self.heat.render()
+        self.assertEqual((image.width(), image.height()), (TEST_WIDTH, TEST_SIZE // 4 // TEST_WIDTH))
+        self.assertEqual(image.pixel(0, 0), int(self.heat.pixels[0, 0]))
+        self.assertNotEqual(image.pixel(0, 0), rp_heatmap.HEAT_BACK)
+        self.assertEqual(image.pixel(4, 0), rp_heatmap.HEAT_BACK)
+        self.assertEqual(self.heat.word_addr(1, 2), 0x20000000 + (2*TEST_WIDTH + 1) * 4)
+        self.assertIsNone(self.heat.word_addr(TEST_WIDTH, 0))
+
+class EmuHeatTest(unittest.TestCase):
+    def setUp(self):
+        driver.EMULATE = True
+        self.d = arm.open()
+        driver.spi_init(self.d)
+        swd.swd_reset(self.d)
+        arm.cpu_swd_start(self.d)
+        arm.ap_config(self.d, 32)
+        self.heat = rp_heatmap.RamHeat(0x20000000, TEST_SIZE, TEST_WIDTH, chunk=TEST_CHUNK)
+
+    def tearDown(self):
+        driver.close(self.d)
+
+    # The region is read a chunk at a time; the emulated counter at the
+    # start of SRAM, and the words written by the emulator, are counted,
+    # and a chunk isn't read until it is due
+    def test_scan(self):
+        while self.heat.scans < 10:
+            self.assertTrue(self.heat.scan(self.d, TEST_RATE))
+        self.assertEqual(self.heat.reads, 10 * TEST_SIZE // 4 // TEST_CHUNK)
+        self.assertEqual(self.heat.failed, 0)
+        self.assertEqual(self.heat.counts[0], 9)
+        self.assertGreater(self.heat.counts[64:128].sum(), 0)
+        self.assertEqual(self.heat.counts[128:].sum(), 0)
+        self.assertTrue(self.heat.scan(self.d, 1.0))
+        self.assertFalse(self.heat.scan(self.d, 1.0))
+
+    # The view draws the image of the emulated region
+    def test_view(self):
+        while self.heat.scans < 3:
+            self.heat.scan(self.d, TEST_RATE)
+        view = rp_heatmap.HeatView(self.heat)
+        view.timer.stop()
+        view.resize(TEST_WIDTH * 8, self.heat.rows * 8)
+        image = view.grab().toImage()
+        self.assertEqual(view.reads, self.heat.reads)
+        self.assertEqual(image.pixel(1, image.height() - 1), rp_heatmap.HEAT_BACK)
+        self.assertNotEqual(self.heat.image.pixel(0, 0), rp_heatmap.HEAT_BACK)
+
+if __name__ == "__main__":
+    unittest.main()
+
+# EOF
@@ -0,0 +1,73 @@
+# Unit tests of multi-probe polling for Iosoft Reporta project
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import rp_arm as arm, rp_multi
+try:
+    import Queue
+except:
+    import queue as Queue
+
+class MergeTest(unittest.TestCase):
+    # Set up a poller for two probes, with reports put on a local queue
+    def setUp(self):
+        self.mp = rp_multi.MultiPoll([0, 1], [])
+        self.mp.outq = Queue.Queue()
+        self.mp.marks = {0: 0.0, 1: 0.0}
+
+    # Return a report of samples from a probe, given their times
+    def report(self, idx, mark, times):
+        return (idx, mark, [(t, idx, "V", n) for n, t in enumerate(times)])
+
+    # Samples are only released up to the lowest time mark of all the probes
+    def test_marks(self):
+        self.mp.outq.put(self.report(0, 3.0, [1.0, 2.0, 3.0]))
+        self.assertEqual(self.mp.get(0), [])
+        self.mp.outq.put(self.report(1, 2.5, [1.5, 2.5]))
+        self.assertEqual([s[0] for s in self.mp.get(0)], [1.0, 1.5, 2.0, 2.5])
+        self.mp.outq.put(self.report(1, 4.0, [3.5, 4.0]))
+        self.assertEqual([s[0] for s in self.mp.get(0)], [3.0])
+
+    # A final report removes the probe's mark, so the rest are released
+    def test_final(self):
+        self.mp.outq.put(self.report(0, 2.0, [1.0, 2.0]))
+        self.mp.outq.put(self.report(1, None, [0.5, 3.0]))
+        self.assertEqual([s[1] for s in self.mp.get(0)], [1, 0, 0])
+        self.assertTrue(self.mp.running())
+        self.mp.outq.put(self.report(0, None, [2.5]))
+        self.assertEqual([s[0] for s in self.mp.get(0)], [2.5, 3.0])
+        self.assertFalse(self.mp.running())
+
+    # Samples with the same time are kept in the order they were received
+    def test_same_time(self):
+        self.mp.outq.put(self.report(1, None, [1.0, 1.0]))
+        self.mp.outq.put(self.report(0, None, [1.0]))
+        self.assertEqual([(s[1], s[3]) for s in self.mp.get(0)], [(1, 0), (1, 1), (0, 0)])
+
+class EmuMultiTest(unittest.TestCase):
+    # Two emulated probes give a single stream of samples in time order
+    def test_poll(self):
+        pvars = [("PB", arm.GPIOB+arm.GPIO_IDR, 200)]
+        samples = list(rp_multi.multi_poll([0, 1], pvars, 0.5, True))
+        times = [s[0] for s in samples]
+        self.assertEqual(times, sorted(times))
+        self.assertEqual(set([s[1] for s in samples]), set([0, 1]))
+        self.assertEqual(set([s[2] for s in samples]), set(["PB"]))
+        self.assertGreater(len(samples), 50)
+        self.assertNotIn(None, [s[3] for s in samples])
+
+if __name__ == "__main__":
+    unittest.main()
+
+# EOF
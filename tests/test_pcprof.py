@@ -0,0 +1,84 @@
+# Unit tests of the PC-sampling profiler for Iosoft Reporta project
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import rp_arm as arm, rp_swd as swd, rp_ftd2xx as driver, rp_elf, rp_pcprof
+
+WAIT_PROB   = 0.05              # Probability of emulated WAIT response
+
+# Return a symbol table with functions at the emulated sample addresses
+def emu_table():
+    func = lambda name, addr, size: rp_elf.ElfSymbol(name, addr, size, rp_elf.STT_FUNC,
+                                                     name + ".c")
+    return rp_elf.SymbolTable([func("main", 0x08000200, 0x40), func("tick", 0x08000400, 0x100)])
+
+class HistogramTest(unittest.TestCase):
+    # Invalid samples, and those outside the code range, are counted apart
+    def test_add(self):
+        hist = rp_pcprof.PcHistogram(0x08000000, 0x1000)
+        hist.add([0x08000010, 0x08000010, 0x08000012, rp_pcprof.PCSR_INVALID, 0x20000000])
+        pcs, counts = hist.items()
+        self.assertEqual((pcs.tolist(), counts.tolist()), ([0x08000010, 0x08000012], [2, 1]))
+        self.assertEqual((hist.total, hist.invalid, hist.outside()), (4, 1, 1))
+
+    # PCs are grouped by function, or in address blocks if unknown
+    def test_functions(self):
+        hist = rp_pcprof.PcHistogram()
+        hist.add([0x08000202] * 3 + [0x08000400, 0x08000900, 0x08000902])
+        funcs = rp_pcprof.pc_functions(hist, emu_table())
+        self.assertEqual([(rp_pcprof.func_name(sym, pcs), n) for sym, n, pcs in funcs],
+                         [("main", 3), ("?08000900", 2), ("tick", 1)])
+        self.assertEqual(rp_pcprof.pc_folded(hist, emu_table())[0], "main.c;main;08000202 3")
+        self.assertIn("?;?08000900;08000902 1", rp_pcprof.pc_folded(hist, emu_table()))
+        self.assertEqual(rp_pcprof.pc_report(hist, emu_table())[1].split()[:3],
+                         ["3", "50.00", "08000202"])
+
+class EmuPcprofTest(unittest.TestCase):
+    def setUp(self):
+        driver.EMULATE = True
+        self.d = arm.open()
+        driver.spi_init(self.d)
+        swd.swd_reset(self.d)
+        arm.cpu_swd_start(self.d)
+        arm.ap_config(self.d, 32)
+
+    def tearDown(self):
+        driver.close(self.d)
+
+    # DWT is enabled, and the samples are in the emulated functions
+    def test_profile(self):
+        rp_pcprof.pc_sample_enable(self.d)
+        demcr = arm.cpu_mem_read32(self.d, rp_pcprof.DEMCR)
+        self.assertTrue(demcr & rp_pcprof.DEMCR_TRCENA)
+        hist = rp_pcprof.PcHistogram()
+        self.assertGreater(rp_pcprof.pc_profile(self.d, hist, 0.1, batch=256), 0)
+        self.assertEqual((hist.invalid, hist.outside()), (0, 0))
+        funcs = rp_pcprof.pc_functions(hist, emu_table())
+        self.assertEqual([sym.name if sym else None for sym, n, pcs in funcs],
+                         ["main", "tick", None])
+        self.assertEqual(sum([n for sym, n, pcs in funcs]), hist.total)
+
+    # With WAIT responses, the samples that are returned are still valid
+    def test_wait(self):
+        self.d.target.wait_prob = WAIT_PROB
+        pcs = arm.cpu_mem_sample(self.d, rp_pcprof.DWT_PCSR, 1000)
+        self.assertGreater(len(pcs), 500)
+        funcs = self.d.target.mem.funcs
+        for pc in pcs:
+            self.assertTrue([f for f in funcs if f[0] <= pc < f[0] + f[1]])
+
+if __name__ == "__main__":
+    unittest.main()
+
+# EOF
@@ -0,0 +1,216 @@
+# Unit tests of the PyQt display for Iosoft Reporta project
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os, sys, tempfile, shutil, threading, unittest
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+import rp_arm as arm, rp_swd as swd, rp_ftd2xx as driver, rp_pyqt as pyqt, rp_ring, rp_wave
+
+APP = pyqt.QtWidgets.QApplication.instance() or pyqt.QtWidgets.QApplication([])
+
+# Make a display window for a test, restoring stdout when the test ends,
+# since the window takes it over as the log
+def make_window(test):
+    test.addCleanup(setattr, sys, "stdout", sys.stdout)
+    return pyqt.MyWindow()
+
+class PortTest(unittest.TestCase):
+    def setUp(self):
+        self.win = make_window(self)
+        self.w = self.win.widget
+        self.pb = pyqt.port_id("PB")
+
+    # Return the port value shown by the animated items, from their opacity
+    def shown(self, port):
+        val = 0
+        for bit, items in enumerate(self.w.port_items[port]):
+            for p in items:
+                on = p.opacity() == pyqt.PIN_ON_OPACITY
+                val |= (1 << bit) if on else 0
+        return val
+
+    # The item tables only contain the pins that are drawn
+    def test_tables(self):
+        self.assertTrue(self.w.port_items[self.pb][11])
+        self.assertFalse(self.w.port_items[pyqt.port_id("PE")][0])
+        self.assertEqual(pyqt.pin_port("PB12"), (self.pb, 12))
+        self.assertIsNone(pyqt.pin_port("PB16"))
+        self.assertIsNone(pyqt.pin_port("GND"))
+
+    # Only the bits that toggle are redrawn, and the display follows the value
+    def test_update(self):
+        mask = sum([1 << n for n, items in enumerate(self.w.port_items[self.pb]) if items])
+        for val in (0x8D3E, 0x1234, 0x1234, 0xffff, 0):
+            self.w.update_port(self.pb, val)
+            self.assertEqual(self.w.port_values[self.pb], val)
+            self.assertEqual(self.shown(self.pb), val & mask)
+
+    # Port updates are timed, with the number of pins changed, and the
+    # statistics are shown in the panel
+    def test_stats(self):
+        pyqt.GUI_STAGE.reset()
+        self.w.update_port(self.pb, 0)
+        self.w.update_port(self.pb, 0x0808)
+        self.assertEqual((pyqt.GUI_STAGE.calls, pyqt.GUI_STAGE.items), (2, 2))
+        panel = pyqt.StatsPanel()
+        panel.timer.stop()
+        panel.refresh()
+        self.assertIn("gui", panel.toPlainText())
+
+    # The string path is decoded into port updates; unknown values are ignored
+    def test_set_ports(self):
+        self.w.set_ports("PB=12C PX=5")
+        self.assertEqual(self.w.port_values[self.pb], 0x12C)
+        self.w.set_ports("PB=?")
+        self.assertEqual(self.w.port_values[self.pb], 0x12C)
+        self.w.set_pin("PB3=0")
+        self.assertEqual(self.w.port_values[self.pb], 0x124)
+
+class LogTest(unittest.TestCase):
+    def setUp(self):
+        self.win = make_window(self)
+        self.w = self.win.widget
+        self.w.log_timer.stop()
+
+    # Text written from any thread is buffered until the timer flushes it,
+    # and the display keeps only the latest lines
+    def test_bounded(self):
+        def write(n):
+            for i in range(0, 1000):
+                print("%u %u" % (n, i))
+        tasks = [threading.Thread(target=write, args=(n,)) for n in range(0, 3)]
+        for t in tasks:
+            t.start()
+        for t in tasks:
+            t.join()
+        self.assertEqual(self.w.text.blockCount(), 1)
+        self.w.flush_text()
+        self.assertFalse(self.w.log_buff)
+        lines = str(self.w.text.toPlainText()).split("\n")
+        self.assertEqual(len(lines), pyqt.LOG_MAX_BLOCKS)
+        self.assertEqual(self.w.text.blockCount(), pyqt.LOG_MAX_BLOCKS)
+        self.assertEqual((lines[-2].split()[1], lines[-1]), ("999", ""))
+        for n in range(0, 3):
+            nums = [int(s.split()[1]) for s in lines[:-1] if s.split()[0] == str(n)]
+            self.assertEqual(nums, list(range(1000 - len(nums), 1000)))
+
+    # Closing the window flushes the buffer and stops the timer
+    def test_close(self):
+        print("Last line")
+        self.w.log_timer.start(pyqt.LOG_FLUSH_MSEC)
+        self.win.close()
+        self.assertFalse(self.w.log_timer.isActive())
+        self.assertIn("Last line", self.w.text.toPlainText())
+
+class LogFileTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.addCleanup(setattr, pyqt, "LOG_FILE", pyqt.LOG_FILE)
+        pyqt.LOG_FILE = os.path.join(self.dir, "test.log")
+
+    # With a log file, text is written to it, and the file is closed with
+    # the window
+    def test_file(self):
+        win = make_window(self)
+        print("Line 1\r\nLine 2")
+        win.close()
+        self.assertIsNone(win.widget.log_file)
+        with open(pyqt.LOG_FILE) as f:
+            self.assertEqual(f.read(), "Line 1\nLine 2\n")
+
+class CoalescerTest(unittest.TestCase):
+    def setUp(self):
+        self.win = make_window(self)
+        self.c = self.win.coalescer
+        self.c.timer.stop()
+        self.pb = pyqt.port_id("PB")
+
+    # Only the latest value of each variable is shown, once per interval
+    def test_latest(self):
+        for val in (1, 2, 3):
+            self.c.update("PB", val)
+        self.c.update("X", None)
+        self.assertEqual(list(self.c.changed.items()), [("PB", 3), ("X", None)])
+        self.c.flush()
+        self.assertEqual(self.win.widget.port_values[self.pb], 3)
+        self.assertEqual(self.c.shown, {"PB": 3, "X": None})
+        self.assertFalse(self.c.changed)
+        self.c.update("PB", 3)
+        self.assertFalse(self.c.changed)
+
+    # Bits that toggle and return to the displayed state are glitches
+    def test_glitches(self):
+        self.c.update("PB", 0x10)
+        self.c.flush()
+        for val in (0x11, 0x10, 0x12, 0x14):
+            self.c.update("PB", val)
+        self.c.flush()
+        self.assertEqual(self.c.stats["PB"], (5, 2))
+        self.assertEqual(self.win.widget.port_values[self.pb], 0x14)
+
+class EmuPortTest(unittest.TestCase):
+    def setUp(self):
+        driver.EMULATE = True
+        self.d = arm.open()
+        driver.spi_init(self.d)
+        swd.swd_reset(self.d)
+        arm.cpu_swd_start(self.d)
+        arm.ap_config(self.d, 32)
+        self.win = make_window(self)
+
+    def tearDown(self):
+        driver.close(self.d)
+
+    # Port values read from the emulated target are shown through the signal
+    def test_poll(self):
+        pb = pyqt.port_id("PB")
+        for n in range(0, 10):
+            val = arm.cpu_mem_read32(self.d, arm.GPIOB+arm.GPIO_IDR) & 0xffff
+            self.win.port_updater.emit(pb, val)
+            self.assertEqual(self.win.widget.port_values[pb], val)
+
+    # Polled values passed through the coalescer show the latest value
+    def test_coalesce(self):
+        c = self.win.coalescer
+        c.timer.stop()
+        for n in range(0, 20):
+            val = arm.cpu_mem_read32(self.d, arm.GPIOB+arm.GPIO_IDR)
+            c.update("PB", val)
+        c.flush()
+        self.assertEqual(self.win.widget.port_values[pyqt.port_id("PB")], val & 0xffff)
+        self.assertEqual(c.shown["PB"], val)
+
+    # Port values polled from the emulated target are drawn as waveforms,
+    # and traces for unknown variables are dropped
+    def test_wave(self):
+        arm.poll_add_var(self.d, "PB", arm.GPIOB+arm.GPIO_IDR)
+        self.d.ring = rp_ring.SampleRing(["PB"], 1024, (4, 16))
+        for n in range(0, 100):
+            arm.poll_pipeline(self.d)
+        arm.poll_drain(self.d)
+        view = rp_wave.WaveView(self.d.ring, ["PB0", "PB11", "PC1", "PB"])
+        view.timer.stop()
+        self.assertEqual([t[0] for t in view.traces], ["PB0", "PB11", "PB"])
+        view.resize(400, 120)
+        self.assertFalse(view.grab().isNull())
+        self.assertGreater(view.render_time, 0)
+        start, end, tpp = view.time_range()
+        self.assertEqual(end, self.d.ring.times[self.d.ring.count - 1])
+        path = view.trace_path("PB", 11, start, end, tpp, 0, 10)
+        self.assertGreater(path.elementCount(), 1)
+
+if __name__ == "__main__":
+    unittest.main()
+
+# EOF
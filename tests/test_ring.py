@@ -0,0 +1,172 @@
+# Unit tests of the poll sample ring buffer for Iosoft Reporta project
+# The block summaries are checked against a brute-force calculation
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest, random
+from functools import reduce
+import numpy as np
+import rp_arm as arm, rp_swd as swd, rp_ftd2xx as driver, rp_ring
+
+TEST_ADDR   = 0x20001000        # Emulated SRAM without simulated activity
+TEST_LEVELS = (4, 16)           # Summary block sizes
+
+# Class for a poll variable & batch, with the attributes used by the ring
+class FakeVar(object):
+    def __init__(self, name):
+        self.name = name
+class FakeBatch(object):
+    def __init__(self, t, pvs, values):
+        self.time, self.pvs, self.values = t, pvs, values
+
+# Return a list of (time, min, max, and, or, last) for the samples of a
+# variable in a time range, using block summaries if there are at least
+# npoints blocks in the range, in the same way as SampleRing.minmax.
+# Each row's time is its row number, and values are None if invalid
+def brute_minmax(values, capacity, levels, start, end, npoints):
+    count = len(values)
+    first = max(count - capacity, 0)
+    rows = [r for r in range(first, count) if start <= r < end]
+    for blk in sorted(levels, reverse=True):
+        done = count // blk * blk
+        blocks = [b for b in range(-(-first // blk) * blk, done, blk) if start <= b < end]
+        if len(blocks) >= max(npoints, 1):
+            result = []
+            for b in blocks:
+                v = [val for val in values[b:b+blk] if val is not None]
+                if v:
+                    result.append((b, min(v), max(v), reduce(lambda x, y: x & y, v),
+                                   reduce(lambda x, y: x | y, v), v[-1]))
+            rows = [r for r in rows if r >= done]
+            break
+    else:
+        result = []
+    return result + [(r,) + (values[r],) * 5 for r in rows if values[r] is not None]
+
+class RingTest(unittest.TestCase):
+    def setUp(self):
+        self.rand = random.Random(1)
+
+    # Return a random value, or None for an invalid sample
+    def random_value(self):
+        return (None if self.rand.random() < 0.1 else
+                self.rand.choice((0, 1, 0xffffffff, self.rand.getrandbits(32))))
+
+    # Add random rows to a ring, return list of the values of each variable
+    def fill(self, ring, nrows):
+        pvs = [FakeVar(name) for name in ring.names] + [FakeVar("other")]
+        hist = dict([(name, []) for name in ring.names])
+        for t in range(0, nrows):
+            vals = [self.random_value() for pv in pvs]
+            ring.add_batch(FakeBatch(float(t), pvs, vals))
+            for pv, val in zip(pvs, vals):
+                if pv.name in hist:
+                    hist[pv.name].append(val)
+        return hist
+
+    # Compare minmax output with the brute-force calculation
+    def check_minmax(self, ring, hist, start, end, npoints):
+        for name in ring.names:
+            res = ring.minmax(name, start, end, npoints)
+            expect = brute_minmax(hist[name], ring.capacity, TEST_LEVELS, start, end, npoints)
+            self.assertEqual([tuple([int(a[n]) for a in res]) for n in range(0, len(res[0]))],
+                             expect, "%s %s-%s %u" % (name, start, end, npoints))
+
+    # Summaries before the buffer has wrapped
+    def test_minmax(self):
+        ring = rp_ring.SampleRing(["A", "B"], 64, TEST_LEVELS)
+        hist = self.fill(ring, 50)
+        for start, end, npoints in ((0, 50, 1), (0, 50, 4), (3, 41, 2), (10, 12, 1),
+                                    (0, 50, 100)):
+            self.check_minmax(ring, hist, start, end, npoints)
+        self.assertLessEqual(len(ring.minmax("A", 0, 50, 1)[0]), 5)
+
+    # Summaries after the buffer has wrapped, at random time ranges
+    def test_minmax_wrapped(self):
+        ring = rp_ring.SampleRing(["A", "B", "C"], 64, TEST_LEVELS)
+        hist = self.fill(ring, 1000)
+        for n in range(0, 100):
+            start = self.rand.randrange(900, 1000)
+            end = start + self.rand.randrange(0, 120)
+            self.check_minmax(ring, hist, start, end, self.rand.choice((0, 1, 2, 4, 8, 64)))
+
+    # Windows contain the valid samples in time order, after wrapping
+    def test_window(self):
+        ring = rp_ring.SampleRing(["A"], 16, ())
+        hist = self.fill(ring, 40)
+        self.assertEqual(len(ring), 16)
+        t, v = ring.samples("A", 30, 38)
+        expect = [(r, hist["A"][r]) for r in range(30, 38) if hist["A"][r] is not None]
+        self.assertEqual(list(zip(t.astype(int).tolist(), v.tolist())), expect)
+        t, v, ok = ring.window()
+        self.assertEqual(t.tolist(), [float(r) for r in range(24, 40)])
+        self.assertEqual(ok[:, 0].tolist(), [val is not None for val in hist["A"][24:]])
+
+    # Changes include the first valid sample, then those that differ
+    def test_changes(self):
+        ring = rp_ring.SampleRing(["A"], 8, ())
+        for n, val in enumerate((None, 5, 5, 7, None, 7, 5, 5, 9, 9, 9)):
+            ring.add(float(n), [0], [val])
+        t, v = ring.changes("A")
+        self.assertEqual(list(zip(t.tolist(), v.tolist())), [(3.0, 7), (6.0, 5), (8.0, 9)])
+        t, v = ring.decimate("A", 2)
+        self.assertEqual(v.tolist(), [7, 5, 9, 9])
+
+    # A batch row marks unknown & missing variables as invalid
+    def test_add_batch(self):
+        ring = rp_ring.SampleRing(["A", "B"], 16, ())
+        ring.add_batch(FakeBatch(1.0, [FakeVar("B"), FakeVar("X")], [0xffffffff, 5]))
+        t, v, ok = ring.window()
+        self.assertEqual(v.tolist(), [[0, 0xffffffff]])
+        self.assertEqual(ok.tolist(), [[False, True]])
+        self.assertEqual(v.dtype, np.uint32)
+
+    # The columns for a list of variables are cached
+    def test_batch_cols(self):
+        ring = rp_ring.SampleRing(["A", "B"], 16, ())
+        pvs = [FakeVar("B"), FakeVar("X"), FakeVar("A")]
+        idx, cols = ring.batch_cols(pvs)
+        self.assertEqual((idx.tolist(), cols.tolist()), ([0, 2], [1, 0]))
+        self.assertIs(ring.batch_cols(list(pvs))[0], idx)
+
+class EmuRingTest(unittest.TestCase):
+    def setUp(self):
+        driver.EMULATE = True
+        self.d = arm.open()
+        driver.spi_init(self.d)
+        swd.swd_reset(self.d)
+        arm.cpu_swd_start(self.d)
+        arm.ap_config(self.d, 32)
+
+    def tearDown(self):
+        driver.close(self.d)
+
+    # Pipelined poll cycles are added to the probe's ring in cycle order
+    def test_poll(self):
+        self.d.target.mem.write32(TEST_ADDR, 0x12345678)
+        arm.poll_add_var(self.d, "A", TEST_ADDR)
+        arm.poll_add_var(self.d, "B", TEST_ADDR + 4)
+        self.d.ring = rp_ring.SampleRing(["A"], 16, ())
+        batches = []
+        for n in range(0, 20):
+            batches += arm.poll_pipeline(self.d, None, 3)
+        batches += arm.poll_drain(self.d)
+        t, v, ok = self.d.ring.window()
+        self.assertEqual(t.tolist(), [b.time for b in batches[-16:]])
+        self.assertEqual(v[:, 0].tolist(), [0x12345678] * 16)
+        self.assertTrue(ok.all())
+
+if __name__ == "__main__":
+    unittest.main()
+
+# EOF
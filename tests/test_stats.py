@@ -0,0 +1,111 @@
+# Unit tests of the performance statistics for Iosoft Reporta project
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os, json, time, tempfile, shutil, threading, unittest
+import rp_arm as arm, rp_swd as swd, rp_ftd2xx as driver, rp_stats
+
+WAIT_PROB   = 0.05              # Probability of emulated WAIT response
+
+class StageTest(unittest.TestCase):
+    # Latencies are put in power-of-2 microsecond bins
+    def test_hist(self):
+        s = rp_stats.Stage("test")
+        for secs in (0, 0.5e-6, 1e-6, 3e-6, 100e-6, 1000.0):
+            s.add(secs, 2)
+        r = s.results()
+        self.assertEqual((r["calls"], r["items"], r["max_us"]), (6, 12, 1e9))
+        self.assertEqual(list(r["hist_us"].items()), [("<1", 2), ("<2", 1), ("<4", 1),
+                         ("<128", 1), ("<%u" % (1 << (rp_stats.STATS_HIST_BINS-1)), 1)])
+        s.reset()
+        self.assertEqual((s.calls, s.total, s.results()["hist_us"]), (0, 0.0, {}))
+
+    # Stages & counters are created once, and listed by name
+    def test_registry(self):
+        self.assertIs(rp_stats.stage("poll_cycle"), arm.POLL_CYCLE)
+        self.assertIs(rp_stats.counter("replay"), arm.REPLAYS)
+        r = rp_stats.results()
+        for name in ("usb_write", "usb_read", "encode", "decode", "poll_cycle"):
+            self.assertIn(name, r["stages"])
+        for name in ("ack_wait", "ack_fail", "parity_err", "replay"):
+            self.assertIn(name, r["counters"])
+        self.assertEqual(len(rp_stats.stats_text().splitlines()), len(r["stages"]) + 2)
+
+class ProfilerTest(unittest.TestCase):
+    # The profiler finds the function that a thread is running
+    def test_profile(self):
+        stop = threading.Event()
+        def busy_loop():
+            while not stop.is_set():
+                sum(range(0, 1000))
+        t = threading.Thread(target=busy_loop)
+        t.start()
+        p = rp_stats.Profiler(0.001)
+        p.start()
+        time.sleep(0.2)
+        p.stop()
+        stop.set()
+        t.join()
+        r = p.results()
+        self.assertGreater(r["samples"], 10)
+        self.assertTrue([loc for loc in r["inclusive_pct"] if loc.startswith("busy_loop ")])
+
+class EmuStatsTest(unittest.TestCase):
+    def setUp(self):
+        driver.EMULATE = True
+        self.d = arm.open()
+        driver.spi_init(self.d)
+        swd.swd_reset(self.d)
+        arm.cpu_swd_start(self.d)
+        arm.ap_config(self.d, 32)
+        rp_stats.reset()
+
+    def tearDown(self):
+        driver.close(self.d)
+
+    # Polling updates the USB, encode, decode & poll cycle stages, and
+    # WAIT responses are counted, with the replays they cause
+    def test_poll(self):
+        arm.poll_add_var(self.d, "A", 0x20001000)
+        arm.poll_add_var(self.d, "PB", arm.GPIOB+arm.GPIO_IDR)
+        self.d.target.wait_prob = WAIT_PROB
+        batches = []
+        for n in range(0, 100):
+            batches += arm.poll_pipeline(self.d, None, 3)
+        batches += arm.poll_drain(self.d)
+        r = rp_stats.results()
+        self.assertEqual(r["stages"]["poll_cycle"]["calls"], len(batches))
+        self.assertEqual(r["stages"]["poll_cycle"]["items"], 2 * len(batches))
+        self.assertGreater(r["stages"]["usb_write"]["items"], 0)
+        self.assertGreater(r["stages"]["usb_read"]["items"], 0)
+        self.assertGreater(r["stages"]["encode"]["items"], 0)
+        self.assertGreater(r["stages"]["decode"]["calls"], 0)
+        self.assertGreater(r["counters"]["ack_wait"], 0)
+        self.assertGreater(arm.REPLAYS.n, 0)
+
+    # The statistics are written as JSON
+    def test_dump(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        fname = os.path.join(tmp, "stats.json")
+        arm.cpu_mem_read32(self.d, 0x20001000)
+        rp_stats.dump(fname)
+        with open(fname) as f:
+            r = json.load(f)
+        self.assertGreater(r["stages"]["usb_read"]["calls"], 0)
+        self.assertNotIn("profile", r)
+
+if __name__ == "__main__":
+    unittest.main()
+
+# EOF
@@ -0,0 +1,150 @@
+# Unit tests of SWD request encoding & decoding for Iosoft Reporta project
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import rp_arm as arm, rp_swd as swd, rp_ftd2xx as driver, rp_emul
+
+# Return the bits sent by MPSSE write commands, l.s.bit first
+# Each command is an opcode, a length, then data bytes or a single byte
+# of bits; read-only commands send no bits
+def mpsse_bits(cmds):
+    bits, i = [], 0
+    while i < len(cmds):
+        op, n = cmds[i], cmds[i+1]
+        if op & driver.FTDI_SPI_BIT_MODE:
+            data, nbits, i = [cmds[i+2]], n + 1, i + 3
+        else:
+            nbytes = cmds[i+1] + (cmds[i+2] << 8) + 1
+            data, nbits, i = cmds[i+3:i+3+nbytes], nbytes * 8, i + 3 + nbytes
+        if op & swd.SPI_WR_BYTES:
+            bits += [(data[k // 8] >> (k % 8)) & 1 for k in range(0, nbits)]
+    return bits
+
+# Return the integer value of a list of bits, l.s.bit first
+def bits_value(bits):
+    return sum([b << n for n, b in enumerate(bits)])
+
+class SwdEncodeTest(unittest.TestCase):
+    # Request headers, checked against the values in the ADIv5 spec
+    def test_header(self):
+        self.assertEqual(swd.swd_header(swd.SWD_DP, 1, arm.DPORT_IDCODE), 0xA5)
+        self.assertEqual(swd.swd_header(swd.SWD_DP, 0, arm.DPORT_ABORT), 0x81)
+        self.assertEqual(swd.swd_header(swd.SWD_DP, 1, arm.DPORT_RDBUFF), 0xBD)
+        self.assertEqual(swd.swd_header(swd.SWD_AP, 1, arm.APORT_DRW), 0x9F)
+        self.assertEqual(swd.swd_header(swd.SWD_AP, 0, arm.APORT_TAR), 0x8B)
+
+    # Header parity covers the AP/DP, R/W & address bits
+    def test_header_parity(self):
+        for ap in (0, 1):
+            for rd in (0, 1):
+                for addr in range(0, 16, 4):
+                    hdr = swd.swd_header(ap, rd, addr)
+                    self.assertEqual(bin(hdr & 0x3e).count("1") % 2, 0)
+                    self.assertEqual(hdr & 0xc1, 0x81)
+
+    # Data parity is even parity over 32 bits
+    def test_parity32(self):
+        for val in (0, 1, 3, 0x80000000, 0xffffffff, 0x12345678):
+            self.assertEqual(swd.parity32(val), bin(val).count("1") & 1)
+
+    # A write sends the header, turnaround & ack (as zero bits), turnaround,
+    # then 32 data bits & the parity bit
+    def test_write_bits(self):
+        req = swd.SwdRequest(swd.SWD_AP, arm.APORT_TAR, 0, 0x20000301)
+        bits = mpsse_bits(req.txdata())
+        self.assertEqual(bits_value(bits[0:8]), swd.swd_header(swd.SWD_AP, 0, arm.APORT_TAR))
+        self.assertEqual(bits_value(bits[13:45]), 0x20000301)
+        self.assertEqual(bits[45], swd.parity32(0x20000301))
+        self.assertEqual(req.rxlen(), swd.SWD_WR_RESP_LEN)
+
+    # A read sends the header, then zero bits while the target drives the line
+    def test_read_bits(self):
+        req = swd.SwdRequest(swd.SWD_DP, arm.DPORT_IDCODE, 1)
+        bits = mpsse_bits(req.txdata())
+        self.assertEqual(bits_value(bits[0:8]), 0xA5)
+        self.assertEqual(sum(bits[8:]), 0)
+        self.assertEqual(req.rxlen(), swd.SWD_RD_RESP_LEN)
+
+class SwdDecodeTest(unittest.TestCase):
+    # Return response bytes for a read: ack in the top 3 bits of the first
+    # byte, 4 data bytes, and the parity bit left-justified in the last byte
+    def read_resp(self, ack, val, par):
+        return bytearray((ack << 5, val & 0xff, (val >> 8) & 0xff,
+                          (val >> 16) & 0xff, val >> 24, par << 6))
+
+    def test_read_ok(self):
+        req = swd.SwdRequest(swd.SWD_AP, arm.APORT_DRW, 1)
+        self.assertTrue(req.decode(self.read_resp(swd.SWD_ACK_OK, 0x2BA01477, 0)))
+        self.assertEqual(req.ack, swd.SWD_ACK_OK)
+        self.assertEqual(req.data, 0x2BA01477)
+        self.assertTrue(req.parity_ok())
+
+    def test_read_parity_error(self):
+        req = swd.SwdRequest(swd.SWD_AP, arm.APORT_DRW, 1)
+        req.decode(self.read_resp(swd.SWD_ACK_OK, 0x2BA01477, 1))
+        self.assertFalse(req.parity_ok())
+
+    def test_read_wait(self):
+        req = swd.SwdRequest(swd.SWD_AP, arm.APORT_DRW, 1)
+        req.decode(self.read_resp(swd.SWD_ACK_WAIT, 0, 0))
+        self.assertEqual(req.ack, swd.SWD_ACK_WAIT)
+
+    # A short response gives the error value
+    def test_read_short(self):
+        req = swd.SwdRequest(swd.SWD_AP, arm.APORT_DRW, 1)
+        self.assertFalse(req.decode(self.read_resp(swd.SWD_ACK_OK, 5, 0)[:-1]))
+        self.assertEqual(req.data, swd.ERRVAL)
+        self.assertEqual(req.ack, 0)
+
+    # Responses to a batch are read together, and decoded at their offsets
+    def test_batch(self):
+        reqs = [swd.SwdRequest(swd.SWD_AP, arm.APORT_TAR, 0, 0x20000000),
+                swd.SwdRequest(swd.SWD_AP, arm.APORT_DRW, 1),
+                swd.SwdRequest(swd.SWD_DP, arm.DPORT_RDBUFF, 1)]
+        data = (bytearray((swd.SWD_ACK_OK << 5,)) +
+                self.read_resp(swd.SWD_ACK_OK, 5, 0) + self.read_resp(swd.SWD_ACK_OK, 7, 1))
+        i = 0
+        for req in reqs:
+            self.assertTrue(req.decode(data, i))
+            i += req.rxlen()
+        self.assertEqual([r.ack for r in reqs], [swd.SWD_ACK_OK] * 3)
+        self.assertEqual([r.data for r in reqs[1:]], [5, 7])
+        self.assertFalse(reqs[2].decode(data[:-1], i - reqs[2].rxlen()))
+        self.assertEqual(reqs[2].data, swd.ERRVAL)
+
+class SwdEmulatorTest(unittest.TestCase):
+    def setUp(self):
+        driver.EMULATE = True
+        self.d = arm.open()
+        driver.spi_init(self.d)
+        swd.swd_reset(self.d)
+
+    def tearDown(self):
+        driver.close(self.d)
+
+    # Requests sent through the emulated device reach the target registers
+    def test_round_trip(self):
+        self.assertEqual(arm.cpu_swd_start(self.d), "%08X" % rp_emul.DP_IDCODE)
+        r = swd.swd_wr(self.d, swd.SWD_DP, arm.DPORT_SELECT, 0xF0)
+        self.assertEqual(r.ack, swd.SWD_ACK_OK)
+        self.assertEqual(self.d.target.select, 0xF0)
+        r = swd.swd_rd(self.d, swd.SWD_DP, arm.DPORT_IDCODE)
+        self.assertEqual(r.ack, swd.SWD_ACK_OK)
+        self.assertTrue(r.parity_ok())
+        self.assertEqual(r.data, rp_emul.DP_IDCODE)
+
+if __name__ == "__main__":
+    unittest.main()
+
+# EOF
@@ -0,0 +1,74 @@
+# Unit tests of the link auto-tune for Iosoft Reporta project
+#
+# Copyright (c) Jeremy P Bentham 2018. See iosoft.blog for more information
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#    http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os, json, tempfile, shutil, unittest
+import rp_arm as arm, rp_swd as swd, rp_ftd2xx as driver, rp_emul, rp_tune
+
+TEST_CLOCKS = (1e6, 5e6, 10e6, 15e6, 30e6)
+
+class ClockDivTest(unittest.TestCase):
+    # The clock isn't above the requested value, and uses the 60 MHz base
+    # on H-series devices
+    def test_div(self):
+        self.assertEqual(driver.spi_clock_div(1e6), (driver.FTDI_BASE_CLOCK, 5))
+        self.assertEqual(driver.spi_clock_div(30e6, True), (driver.FTDI_HS_CLOCK, 0))
+        self.assertEqual(driver.spi_clock_div(7e6, True), (driver.FTDI_HS_CLOCK, 4))
+        self.assertEqual(driver.spi_clock_div(30e6), (driver.FTDI_BASE_CLOCK, 0))
+
+class EmuTuneTest(unittest.TestCase):
+    def setUp(self):
+        driver.EMULATE = True
+        self.d = arm.open()
+        driver.spi_init(self.d)
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, "tune.json")
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def tearDown(self):
+        driver.close(self.d)
+
+    # Above the emulator's maximum clock, reads are corrupted or incomplete,
+    # which fails the check, rather than raising an exception
+    def test_check(self):
+        self.assertTrue(rp_tune.link_check(self.d, rp_emul.EMU_MAX_CLOCK))
+        self.assertFalse(rp_tune.link_check(self.d, 2 * rp_emul.EMU_MAX_CLOCK))
+        self.assertTrue(rp_tune.link_check(self.d, 1e6))
+
+    # The chosen clock is one step below the fastest that works
+    def test_clock(self):
+        self.assertEqual(rp_tune.tune_clock(self.d, TEST_CLOCKS), 5e6)
+        self.assertEqual(rp_tune.tune_clock(self.d, TEST_CLOCKS, 0), 10e6)
+        self.assertIsNone(rp_tune.tune_clock(self.d, (15e6, 30e6)))
+
+    # Polls are measured with the variables at separate addresses
+    def test_poll_rate(self):
+        arm.ap_config(self.d, 32)
+        arm.poll_add_var(self.d, "PB", arm.GPIOB+arm.GPIO_IDR)
+        self.assertGreater(rp_tune.poll_rate(self.d, 0.05, 4), 0)
+        self.assertEqual([pv.name for pv in self.d.poll_vars], ["PB"])
+
+    # The tuned profile is cached, and reused by the next setup
+    def test_setup(self):
+        profile = rp_tune.link_setup(self.d, fname=self.fname)
+        self.assertLessEqual(profile["clock_hz"], rp_emul.EMU_MAX_CLOCK)
+        self.assertIn(profile["latency"], rp_tune.TUNE_LATENCIES)
+        with open(self.fname) as f:
+            self.assertEqual(json.load(f), {driver.device_serial(self.d): profile})
+        self.assertEqual(rp_tune.link_setup(self.d, fname=self.fname), profile)
+        self.assertEqual(arm.cpu_mem_read32(self.d, 0x20001000), 0)
+
+if __name__ == "__main__":
+    unittest.main()
+
+# EOF